@@ -17,6 +17,7 @@ import threading
 import time
 import io
 from utils.code import get_code_as_string, edit_code
+from utils.streaming import is_streamable, stream_code_answer, make_client, build_messages
 
 # agent and task setup
 from tasksolver.agent import Agent
@@ -30,6 +31,12 @@ from tasksolver.keychain import KeyChain
 from tqdm import tqdm
 
 
+def get_cache_scope(vision_model:str, task:TaskSpec) -> str:
+    """ What, besides the question, decides the answer: the model, and the task it's prompted with. """
+    return "|".join([str(vision_model), str(getattr(task, "name", "")), str(getattr(task, "description", "")),
+                     str(getattr(getattr(task, "answer_type", None), "__name__", ""))])
+
+
 class GeneralAgent(Agent): 
     """
     Agent that answers questions in a certain format.
@@ -40,10 +47,46 @@ class GeneralAgent(Agent):
         super().__init__(api_key=api_key,  task=task,
                         vision_model=vision_model,
                         followup_func=self.followup_func)
+        self.cache_scope = get_cache_scope(vision_model, task)
+        self.response_cache = None # see utils/response_cache.py
+        self.api_key = api_key
+        self.task_spec = task
+        self.vision_model = vision_model
+        self.stream_max_chars_without_code = None # streaming off, see enable_streaming
+        self.stream_client = None
+
+    def enable_streaming(self, max_chars_without_code:int=2000) -> bool:
+        """
+        Stream the answers of this agent, if it writes code on an OpenAI model (see utils/streaming.py).
+
+        Returns:
+            whether streaming is on.
+        Raises:
+            UnrecognizedQuestionException if the task's background can't be read, which every
+            streamed request would have to send.
+        """
+        if not (is_streamable(self.vision_model) and self.task_spec.answer_type is PythonExecutableAnswer):
+            return False
+        build_messages(self.task_spec, Question([""])) # fails here rather than on every request
+        self.stream_client = make_client(self.api_key)
+        # streamed prompts are laid out by build_messages, not TaskSolver: their answers are kept apart
+        self.cache_scope = self.cache_scope + "|streamed"
+        self.stream_max_chars_without_code = max_chars_without_code
+        return True
                         
     def think(self, question: Question, num_tokens: int, agent_idx: int) -> ParsedAnswer:
-        p_ans, ans, meta, p = self.visual_interface.run_once(question, max_tokens=num_tokens)
-        return p_ans
+        def request():
+            if self.stream_client is not None:
+                # parsed as soon as the code block closes, see utils/streaming.py
+                return stream_code_answer(self.stream_client, self.vision_model, self.task_spec, question,
+                                          max_tokens=num_tokens,
+                                          max_chars_without_code=self.stream_max_chars_without_code)
+            p_ans, ans, meta, p = self.visual_interface.run_once(question, max_tokens=num_tokens)
+            return p_ans
+        if self.response_cache is None:
+            return request()
+        return self.response_cache.ask(request, question, self.cache_scope,
+                                       params={"max_tokens": num_tokens}, sample=agent_idx)
 
     def act(self, p_ans:ParsedAnswer, script_save:Path, render_save:Path, iteration:int,
             blender_file:str, blender_script:str, config:dict, blender_step):
@@ -99,6 +142,19 @@ class EditCodeAgent(object):
                                     api_key,
                                     task=self.code_delta_task,
                                     vision_model=vision_model).visual_interface
+
+        self.vision_model = vision_model
+        self.response_cache = None # see utils/response_cache.py
+
+    def rough_guess(self, model, task:TaskSpec, question:Question, agent_idx=None) -> ParsedAnswer:
+        """ model.rough_guess(question), through the response cache if there's one. """
+        def request():
+            p_ans, _, _, _ = model.rough_guess(question)
+            return p_ans
+        if self.response_cache is None:
+            return request()
+        return self.response_cache.ask(request, question, get_cache_scope(self.vision_model, task),
+                                       sample=agent_idx)
                                 
     def think(self, question:Question,
                 num_tokens: int, agent_idx=None) -> ParsedAnswer:
@@ -121,7 +177,7 @@ Describe, in a bullet-point list (using * as the bullet points), which lines you
 
         while not done and tries < max_tries: 
             logger.info(f"PLANNING ATTEMPT #{tries}")
-            list_of_diffs, _, _, _ = self.brainstorming_model.rough_guess(question)
+            list_of_diffs = self.rough_guess(self.brainstorming_model, self.brainstorming_task, question, agent_idx)
             tries += 1
             if len(list_of_diffs.list_items) == 0:
                 logger.warning(prepend_string + f"retrying ({tries})...")
@@ -164,7 +220,7 @@ a = 2
                 delta_max_tries = 10
                 while not delta_done and delta_tries < delta_max_tries:
                     try:
-                        diff, _, _, _ = self.code_delta_model.rough_guess(delta_question)
+                        diff = self.rough_guess(self.code_delta_model, self.code_delta_task, delta_question, agent_idx)
                         tries += 1
                         delta_done = True
                     except GPTOutputParseException as e:
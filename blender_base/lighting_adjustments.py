@@ -9,6 +9,10 @@ import os
 import sys
 from sys import platform
 
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from render_utils import configure_compute_devices, use_cycles, apply_render_settings, run_script, render_to, run_manifest
+from render_utils import get_render_settings_from_argv, bake_scene
+
 
 # def get_material_from_code(code_fpath):
 #     assert os.path.exists(code_fpath)
@@ -19,58 +23,44 @@ from sys import platform
 #     return material 
 
 
-if __name__ == "__main__":
-
-    code_fpath = sys.argv[6]  # TODO: allow a folder to be given, each with a possible guess.
-    rendering_fpath = sys.argv[7] # rendering
+def configure():
+    """ Once per Blender process. """
+    configure_compute_devices()
 
 
-    bpy.context.scene.render.engine = "CYCLES"
-    # setting up Rendering settings
-    if platform == "linux" or platform == "linux2":
-        # linux
-        bpy.context.preferences.addons[
-            "cycles"
-        ].preferences.compute_device_type = "CUDA"
-        bpy.context.scene.cycles.device = "GPU"   
-        
-    elif platform == "darwin":
-        # OS X
-        bpy.context.preferences.addons[
-            "cycles"
-        ].preferences.compute_device_type = "METAL"
-        
-    elif platform == "win32":
-        # Windows...
-        raise NotImplemented("Not supported")
-    
+def prepare_scene(render_settings=None):
+    """
+    Once per candidate, on a freshly loaded scene.
+    Returns the namespace the candidate script is executed in.
+    """
+    use_cycles()
+    apply_render_settings(render_settings)
+    return dict(globals())
 
-    bpy.context.preferences.addons["cycles"].preferences.get_devices()
-    print(bpy.context.preferences.addons["cycles"].preferences.compute_device_type)
-    for d in bpy.context.preferences.addons["cycles"].preferences.devices:
-        d["use"] = 1 # Using all devices, include GPU and CPU
-        print(d["name"], d["use"])
 
-    bpy.context.scene.render.resolution_x = 512
-    bpy.context.scene.render.resolution_y = 512
+def render_candidate(code_fpath, rendering_fpath, render_settings=None):
+    namespace = prepare_scene(render_settings)
+    # run script to create the lights
+    run_script(code_fpath, namespace)
+    render_to(rendering_fpath)
 
 
-    # run script to create the lights
-    with open(code_fpath, "r") as f:
-        code = f.read()
+if __name__ == "__main__":
 
-    try:
-        exec(code)
-    except:
-        raise ValueError
-    
-    # render, and save.
-    bpy.context.scene.render.image_settings.file_format = 'PNG'
-    bpy.context.scene.render.filepath = rendering_fpath
-    bpy.ops.render.render(write_still=True)
+    configure()
+    if sys.argv[6] == "--manifest":
+        # batch mode: many (script, output) pairs in one Blender session
+        run_manifest(sys.argv[7], render_candidate)
+    elif sys.argv[6] == "--bake":
+        # save the scene a script produces as a snapshot .blend: -- --bake [SCRIPT] [SNAPSHOT] [SETTINGS]
+        bake_scene(sys.argv[7], sys.argv[8], prepare_scene, get_render_settings_from_argv(sys.argv, 9))
+    else:
+        code_fpath = sys.argv[6]
+        rendering_fpath = sys.argv[7] # rendering
+        render_settings = get_render_settings_from_argv(sys.argv)
+        render_candidate(code_fpath, rendering_fpath, render_settings)
 
 
     # print( f"Poppping material at index {material_index}")
     # # save to disk
     # material_obj.data.materials.pop(index=material_index)
-
@@ -0,0 +1,49 @@
+"""
+Record the bpy/infinigen API surface that an example script relies on, for the static
+validation of candidate scripts (utils/validation.py, run_config.api_stub):
+
+    blender --background [STARTER_BLEND] --python blender_base/record_api_stub.py -- [EXAMPLE_SCRIPT] [STUB_JSON]
+
+The stub lists, for every module the example imports from, the names it exports; for every
+imported class, its attributes (e.g. all node types on infinigen's `Nodes`); and the objects
+and shape keys present in the starter blend.
+"""
+
+import bpy
+import ast
+import sys
+import json
+import inspect
+import importlib
+
+
+if __name__ == "__main__":
+
+    example_fpath = sys.argv[6]
+    stub_fpath = sys.argv[7]
+
+    with open(example_fpath, "r") as f:
+        tree = ast.parse(f.read())
+
+    stub = {"modules": {}, "attributes": {}}
+    for node in ast.walk(tree):
+        if isinstance(node, ast.ImportFrom) and node.module is not None:
+            try:
+                module = importlib.import_module(node.module)
+            except ImportError:
+                print(f"couldn't import {node.module}, skipping.")
+                continue
+            stub["modules"][node.module] = sorted(dir(module))
+            for alias in node.names:
+                imported = getattr(module, alias.name, None)
+                if inspect.isclass(imported):
+                    stub["attributes"][alias.asname or alias.name] = sorted(dir(imported))
+
+    stub["objects"] = sorted([obj.name for obj in bpy.data.objects])
+    stub["shape_keys"] = sorted(set([key_block.name
+                                     for shape_key in bpy.data.shape_keys
+                                     for key_block in shape_key.key_blocks]))
+
+    with open(stub_fpath, "w") as f:
+        json.dump(stub, f, indent=1)
+    print(f"API stub written to {stub_fpath}")
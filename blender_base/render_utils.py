@@ -0,0 +1,374 @@
+"""
+Helpers shared by the blender_base entry scripts and the long-lived Blender worker.
+These run inside Blender, so only bpy, the standard library and Blender's bundled numpy are available.
+"""
+
+import bpy
+import os
+import re
+import json
+import time
+import random
+import struct
+import traceback
+from sys import platform
+
+
+def configure_compute_devices():
+    """
+    Pick the Cycles compute backend and enable every device. This only touches
+    user preferences, so it survives reloading the .blend and only needs to run
+    once per Blender process.
+    """
+    if platform == "linux" or platform == "linux2":
+        # linux
+        bpy.context.preferences.addons[
+            "cycles"
+        ].preferences.compute_device_type = "CUDA"
+
+    elif platform == "darwin":
+        # OS X
+        bpy.context.preferences.addons[
+            "cycles"
+        ].preferences.compute_device_type = "METAL"
+
+    elif platform == "win32":
+        # Windows...
+        raise NotImplemented("Not supported")
+
+    bpy.context.preferences.addons["cycles"].preferences.get_devices()
+    print(bpy.context.preferences.addons["cycles"].preferences.compute_device_type)
+    for d in bpy.context.preferences.addons["cycles"].preferences.devices:
+        d["use"] = 1 # Using all devices, include GPU and CPU
+        print(d["name"], d["use"])
+
+
+def use_cycles():
+    """
+    Scene-level half of the device setup. Stored in the .blend, so this has to be
+    redone every time the scene is reloaded.
+    """
+    bpy.context.scene.render.engine = "CYCLES"
+    if platform == "linux" or platform == "linux2":
+        bpy.context.scene.cycles.device = "GPU"
+
+
+def set_resolution(resolution_x:int=512, resolution_y:int=512):
+    bpy.context.scene.render.resolution_x = resolution_x
+    bpy.context.scene.render.resolution_y = resolution_y
+
+
+def seed_everything(seed:int):
+    """ Candidate scripts run right after this, so their random draws are seeded too. """
+    import numpy as np # bundled with Blender
+
+    random.seed(seed)
+    np.random.seed(seed % (1 << 32))
+    bpy.context.scene.cycles.seed = seed % (1 << 31)
+    bpy.context.scene.cycles.use_animated_seed = False
+
+
+def apply_render_settings(render_settings:dict=None):
+    """
+    Args:
+        render_settings: optional overrides of the default render settings. None keeps
+            the defaults. Understood keys:
+                "resolution": [X, Y]
+                "samples": number of Cycles samples
+                "simplify": if True, enable scene simplification (subdivision levels,
+                    child particles, texture size) for cheap preview renders.
+                "device": Cycles device, "CPU" or "GPU".
+                "threads": fixed number of render threads, so that concurrent Blender
+                    processes on one machine don't each grab every core.
+                "adaptive_sampling": enable/disable Cycles adaptive sampling.
+                "adaptive_threshold": noise threshold of adaptive sampling.
+                "denoiser": Cycles denoiser (e.g. "OPENIMAGEDENOISE"), or false to disable denoising.
+                "seed": seed of Python's and numpy's random generators and of Cycles, so
+                    that the same script always renders the same image.
+                "subject_border": margin (fraction of the frame). Scripts that know their
+                    subject pass it to set_border_subjects, and only the subject's screen-space
+                    bounding box, grown by the margin, is rendered.
+                "time_limit": render budget in seconds. Cycles renders progressively and
+                    stops at the budget, or earlier once adaptive sampling (turned on unless
+                    "adaptive_sampling" says otherwise) finds the noise under its threshold.
+    """
+    render_settings = render_settings or {}
+    resolution = render_settings.get("resolution") or (512, 512)
+    set_resolution(*resolution)
+
+    if render_settings.get("samples") is not None:
+        bpy.context.scene.cycles.samples = render_settings["samples"]
+
+    if render_settings.get("simplify", False):
+        bpy.context.scene.render.use_simplify = True
+        bpy.context.scene.render.simplify_subdivision_render = 1
+        bpy.context.scene.render.simplify_child_particles_render = 0.2
+        bpy.context.scene.cycles.texture_limit_render = "512"
+
+    if render_settings.get("device") is not None:
+        bpy.context.scene.cycles.device = render_settings["device"]
+
+    if render_settings.get("threads") is not None:
+        bpy.context.scene.render.threads_mode = "FIXED"
+        bpy.context.scene.render.threads = render_settings["threads"]
+
+    if render_settings.get("adaptive_sampling") is not None:
+        bpy.context.scene.cycles.use_adaptive_sampling = render_settings["adaptive_sampling"]
+    if render_settings.get("adaptive_threshold") is not None:
+        bpy.context.scene.cycles.adaptive_threshold = render_settings["adaptive_threshold"]
+
+    if render_settings.get("time_limit") is not None:
+        bpy.context.scene.cycles.time_limit = render_settings["time_limit"]
+        if render_settings.get("adaptive_sampling") is None:
+            bpy.context.scene.cycles.use_adaptive_sampling = True
+
+    if render_settings.get("seed") is not None:
+        seed_everything(render_settings["seed"])
+
+    if "denoiser" in render_settings:
+        if render_settings["denoiser"]:
+            bpy.context.scene.cycles.use_denoising = True
+            bpy.context.scene.cycles.denoiser = render_settings["denoiser"]
+        else:
+            bpy.context.scene.cycles.use_denoising = False
+
+
+def get_render_settings_from_argv(argv, index:int=8):
+    """ Entry scripts take an optional json string of render settings after the render path. """
+    if len(argv) > index:
+        return json.loads(argv[index])
+    return None
+
+
+def restore_pristine_scene(starter_blend:str):
+    """ Throw away everything the previous candidate did to the scene. """
+    bpy.ops.wm.open_mainfile(filepath=starter_blend)
+
+
+def run_script(code_fpath:str, namespace:dict):
+    """
+    Args:
+        code_fpath: path to the candidate bpy script.
+        namespace: globals the script is executed in. Entry scripts pass a copy of
+            their own globals plus whatever the candidate expects (e.g. `material_obj`).
+    """
+    with open(code_fpath, "r") as f:
+        code = f.read()
+    # exceptions propagate as they are, so that the traceback points into the candidate.
+    exec(compile(code, code_fpath, "exec"), namespace)
+
+
+RAW_MAGIC = b"BARW"
+
+
+def write_raw_render(tga_fpath:str, raw_fpath:str):
+    """
+    Convert an uncompressed Targa into the raw RGBA layout read by utils/render_handoff.py:
+    b"BARW", width, height (little-endian uint32), then RGBA rows, top row first.
+    """
+    import numpy as np # bundled with Blender
+
+    with open(tga_fpath, "rb") as f:
+        data = f.read()
+    id_length = data[0]
+    width, height = struct.unpack("<HH", data[12:16])
+    channels = data[16] // 8
+    top_down = bool(data[17] & 0x20)
+    pixels = np.frombuffer(data, dtype=np.uint8, count=width*height*channels,
+                           offset=18+id_length).reshape(height, width, channels)
+    if not top_down:
+        pixels = pixels[::-1]
+    rgba = np.empty((height, width, 4), dtype=np.uint8)
+    rgba[..., :3] = pixels[..., 2::-1] # BGR(A) -> RGB
+    rgba[..., 3] = pixels[..., 3] if channels == 4 else 255
+
+    tmp_fpath = raw_fpath + ".tmp"
+    with open(tmp_fpath, "wb") as f:
+        f.write(RAW_MAGIC + struct.pack("<II", width, height))
+        f.write(rgba.tobytes())
+    os.replace(tmp_fpath, raw_fpath)
+    os.unlink(tga_fpath)
+
+
+_border_subjects = None # (object names, margin) of the subject to crop renders to
+
+
+def set_border_subjects(object_names, render_settings:dict=None):
+    """
+    Restrict the renders of this scene to the screen-space bounds of object_names when
+    render_settings asks for a "subject_border". Called by prepare_scene, on every fresh scene.
+    """
+    global _border_subjects
+    margin = (render_settings or {}).get("subject_border")
+    if margin is None or len(object_names) == 0:
+        _border_subjects = None
+    else:
+        _border_subjects = (list(object_names), float(margin))
+
+
+def get_subject_border():
+    """
+    Returns:
+        (min_x, min_y, max_x, max_y) of the subjects as seen from the scene camera, in
+        normalized frame coordinates (origin at the bottom left), or None for the full frame.
+    """
+    from bpy_extras.object_utils import world_to_camera_view
+    from mathutils import Vector
+
+    if _border_subjects is None:
+        return None
+    scene = bpy.context.scene
+    if scene.camera is None:
+        return None
+    object_names, margin = _border_subjects
+    depsgraph = bpy.context.evaluated_depsgraph_get()
+    xs, ys = [], []
+    for name in object_names:
+        obj = bpy.data.objects.get(name)
+        if obj is None:
+            continue
+        evaluated = obj.evaluated_get(depsgraph) # shape keys, modifiers
+        for corner in evaluated.bound_box:
+            projected = world_to_camera_view(scene, scene.camera, evaluated.matrix_world @ Vector(corner))
+            if projected.z <= 0:
+                return None # partly behind the camera
+            xs.append(projected.x)
+            ys.append(projected.y)
+    if len(xs) == 0:
+        return None
+    border = (max(min(xs) - margin, 0.0), max(min(ys) - margin, 0.0),
+              min(max(xs) + margin, 1.0), min(max(ys) + margin, 1.0))
+    if border[0] >= border[2] or border[1] >= border[3]:
+        return None # out of frame
+    return border
+
+
+def apply_subject_border():
+    """
+    Enable the render border around the subjects, if any were set.
+    Returns:
+        the border, as in get_subject_border.
+    """
+    render = bpy.context.scene.render
+    border = get_subject_border()
+    render.use_border = border is not None
+    if border is not None:
+        render.use_crop_to_border = False # full-size image, the rest is composited by the caller
+        render.border_min_x, render.border_min_y, render.border_max_x, render.border_max_y = border
+    return border
+
+
+SAMPLE_PATTERN = re.compile(r"Sample (\d+)\s*/\s*(\d+)")
+
+
+def get_render_stats_path(rendering_fpath:str) -> str:
+    return os.path.splitext(rendering_fpath)[0] + ".stats.json"
+
+
+def render_with_stats(rendering_fpath:str):
+    """
+    bpy.ops.render.render(write_still=True), recording the number of samples Cycles actually
+    took (which time_limit and adaptive sampling can cut short) next to the render, as
+    {"samples", "max_samples", "time_limit", "render_time", "stopped_by", "border"}, where
+    stopped_by is "samples", "time_limit" or "converged", and border is the region that was
+    actually rendered (see apply_subject_border), or None for the whole frame.
+    """
+    scene = bpy.context.scene
+    border = apply_subject_border()
+    progress = {"samples": None}
+
+    def on_render_stats(stats):
+        match = SAMPLE_PATTERN.search(str(stats))
+        if match is not None:
+            progress["samples"] = int(match.group(1))
+
+    bpy.app.handlers.render_stats.append(on_render_stats)
+    start = time.time()
+    try:
+        bpy.ops.render.render(write_still=True)
+    finally:
+        bpy.app.handlers.render_stats.remove(on_render_stats)
+    render_time = time.time() - start
+
+    max_samples = scene.cycles.samples
+    time_limit = scene.cycles.time_limit if scene.render.engine == "CYCLES" else 0
+    samples = progress["samples"]
+    if samples is None or samples >= max_samples:
+        stopped_by = "samples"
+    elif time_limit > 0 and render_time >= time_limit:
+        stopped_by = "time_limit"
+    else:
+        stopped_by = "converged"
+    with open(get_render_stats_path(rendering_fpath), "w") as f:
+        json.dump({"samples": samples, "max_samples": max_samples, "time_limit": time_limit,
+                   "render_time": render_time, "stopped_by": stopped_by, "border": border}, f)
+
+
+def render_to(rendering_fpath:str):
+    """
+    Render, and save. Paths ending in .rgba get the raw pixels (see write_raw_render)
+    instead of a PNG, skipping compression. Either way, the render's stats are saved
+    alongside (see render_with_stats).
+    """
+    if rendering_fpath.endswith(".rgba"):
+        bpy.context.scene.render.image_settings.file_format = 'TARGA_RAW'
+        bpy.context.scene.render.image_settings.color_mode = 'RGBA'
+        bpy.context.scene.render.use_file_extension = False
+        bpy.context.scene.render.filepath = rendering_fpath + ".tga"
+        render_with_stats(rendering_fpath)
+        write_raw_render(rendering_fpath + ".tga", rendering_fpath)
+        return
+    bpy.context.scene.render.image_settings.file_format = 'PNG'
+    bpy.context.scene.render.filepath = rendering_fpath
+    render_with_stats(rendering_fpath)
+
+
+def bake_scene(code_fpath:str, snapshot_fpath:str, prepare_scene, render_settings=None):
+    """
+    Run a candidate on the scene and save the result as a .blend, without rendering, so
+    that scripts which extend this candidate can start from its scene.
+
+    Args:
+        prepare_scene: the entry script's prepare_scene(render_settings), returning the namespace.
+        render_settings: those the candidate was rendered with, so that its seed (and with it,
+            whatever the script draws at random) is the same as in its render.
+    """
+    namespace = prepare_scene(render_settings)
+    run_script(code_fpath, namespace)
+    bpy.ops.wm.save_as_mainfile(filepath=snapshot_fpath, copy=True)
+
+
+def run_manifest(manifest_fpath:str, render_candidate):
+    """
+    Render every entry of a manifest in this Blender session, starting each one from
+    the pristine starter scene. The manifest is a json list of entries:
+        {"script": [PATH], "output": [PATH], "status": [PATH],
+         "resolution": [X, Y] (optional), "render_settings": {...} (optional)}
+    A json status file is written for every entry, so that one failing script doesn't
+    take down the rest of the batch.
+
+    Args:
+        manifest_fpath: path to the manifest json.
+        render_candidate: the entry script's render_candidate(code_fpath, rendering_fpath, render_settings).
+    """
+    with open(manifest_fpath, "r") as f:
+        entries = json.load(f)
+
+    starter_blend = bpy.data.filepath
+    for entry_idx, entry in enumerate(entries):
+        status = {"script": entry["script"], "output": entry["output"]}
+        try:
+            if entry_idx > 0:
+                restore_pristine_scene(starter_blend)
+            render_settings = dict(entry.get("render_settings") or {})
+            if entry.get("resolution") is not None:
+                render_settings["resolution"] = entry["resolution"]
+            render_candidate(entry["script"], entry["output"], render_settings)
+            status["status"] = "ok"
+        except Exception:
+            status["status"] = "error"
+            status["error"] = traceback.format_exc()
+            print(status["error"])
+
+        with open(entry["status"], "w") as f:
+            json.dump(status, f)
@@ -0,0 +1,106 @@
+"""
+Long-lived Blender worker. Loads the starter blend and a blender_base script once,
+then renders candidate scripts sent over stdin, one JSON job per line:
+
+    blender --background [STARTER_BLEND] --python blender_base/worker.py -- [BLENDER_BASE_SCRIPT]
+
+Every job starts from the pristine starter scene, except for delta jobs: those carry the
+property writes that turn a parent script's scene into the candidate's (see
+utils.code.get_assignment_delta). The worker keeps the scene built by the last parent,
+applies the writes, renders, and writes the parent's values back.
+
+Responses are single stdout lines starting with RESPONSE_PREFIX, so that Blender's own
+logging can be told apart. Every job's response reports the worker's resident memory, so
+that the pool can recycle workers that keep growing.
+"""
+
+import bpy
+import importlib.util
+import json
+import os
+import sys
+import traceback
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from render_utils import restore_pristine_scene, run_script, render_to, seed_everything
+
+RESPONSE_PREFIX = "@@BLENDERALCHEMY_WORKER@@ "
+
+
+def load_base_module(base_script_path):
+    # loaded under a name other than __main__, so the script's own entry point doesn't fire.
+    spec = importlib.util.spec_from_file_location("blender_base_task", base_script_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def get_rss_mb():
+    """ Current resident memory of this Blender process, in MB. """
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1 << 20)
+    except (FileNotFoundError, IndexError, ValueError):
+        import resource # peak rather than current, where /proc isn't available
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss / (1 << 20) if sys.platform == "darwin" else maxrss / 1024
+
+
+def respond(payload:dict):
+    sys.stdout.write(RESPONSE_PREFIX + json.dumps(payload) + "\n")
+    sys.stdout.flush()
+
+
+if __name__ == "__main__":
+
+    base_script_path = sys.argv[6]
+    starter_blend = bpy.data.filepath
+
+    base = load_base_module(base_script_path)
+    base.configure()
+    respond({"status": "ready", "pid": os.getpid()})
+
+    scene_is_pristine = True
+    parent_state = None # (parent script, render settings, namespace) of the scene currently built
+    for line in sys.stdin:
+        if len(line.strip()) == 0:
+            continue
+        job = json.loads(line)
+        if job.get("command") == "shutdown":
+            break
+
+        delta = job.get("delta")
+        try:
+            if delta is None:
+                if not scene_is_pristine:
+                    restore_pristine_scene(starter_blend)
+                scene_is_pristine = False
+                parent_state = None
+                base.render_candidate(job["script"], job["render"], job.get("render_settings"))
+            else:
+                # the seed of deterministic renders is per script, so it doesn't make a different parent scene.
+                render_settings = dict(job.get("render_settings") or {})
+                seed = render_settings.pop("seed", None)
+                if parent_state is None or parent_state[:2] != (delta["parent"], render_settings):
+                    if not scene_is_pristine:
+                        restore_pristine_scene(starter_blend)
+                    scene_is_pristine = False
+                    parent_state = None
+                    namespace = base.prepare_scene(job.get("render_settings"))
+                    run_script(delta["parent"], namespace)
+                    parent_state = (delta["parent"], render_settings, namespace)
+
+                namespace = parent_state[2]
+                if seed is not None:
+                    seed_everything(seed)
+                try:
+                    for statement in delta["statements"]:
+                        exec(statement, namespace)
+                    render_to(job["render"])
+                finally:
+                    for statement in delta["inverse"]:
+                        exec(statement, namespace)
+            respond({"id": job["id"], "status": "ok", "render": job["render"], "rss_mb": get_rss_mb()})
+        except Exception:
+            parent_state = None # can't trust the scene anymore
+            respond({"id": job["id"], "status": "error", "error": traceback.format_exc(), "rss_mb": get_rss_mb()})
@@ -0,0 +1,78 @@
+"""
+Diff mode of the tuner and leap questions (run_config.diff_prompts): instead of the full
+current script, the question starts with the original script, identical at every depth and
+in every parallel request (so providers can cache it as a prompt prefix), followed by the
+changes the winning lineage has made to it so far. The answer is a unified diff against the
+current script, applied locally (see utils.code.apply_unified_diff).
+
+Tuner questions are recognized by their instruction to copy the script (COPY_INSTRUCTION),
+leap questions by their instruction to edit it (LEAP_INSTRUCTION), and both instructions are
+turned into asking for a diff. Questions that don't look as expected (parts that can't be read,
+no full current script, neither instruction) are sent as they are, and answered with the full script.
+"""
+
+from loguru import logger
+from tasksolver.common import Question
+
+from utils.code import get_unified_diff
+from utils.question import get_question_parts, UnrecognizedQuestionException
+
+
+CURRENT_SCRIPT_PLACEHOLDER = "# (the current script: the original script above, with the changes so far applied)"
+
+COPY_INSTRUCTION = "Copy the code above (COPY ALL OF IT) and replace the assignments of such fields/variables accordingly!"
+DIFF_COPY_INSTRUCTION = "Write the changes to the assignments of such fields/variables as a unified diff against the current script."
+LEAP_INSTRUCTION = "edit the code above to reflect this desired change."
+DIFF_LEAP_INSTRUCTION = "write the edits to the current script that reflect this desired change as a unified diff against it."
+REWRITE_WARNING = 'DO NOT BE BRIEF IN YOUR CODE. DO NOT ABBREVIATE YOUR CODE WITH "..." -- TYPE OUT EVERYTHING.'
+
+DIFF_ANSWER_FORMAT = """
+Instead of the whole script, answer with your changes to the current script as a unified diff: hunks starting with `@@`, \
+lines to remove starting with `-`, lines to add starting with `+`, and 2 unchanged lines of context around each change \
+starting with a space, copied exactly from the current script. Put the diff in the python code block of your answer."""
+
+
+def to_diff_question(question:Question, original_code_str:str, current_code_str:str) -> Question:
+    """
+    Args:
+        question: a tuner or leap question (see the craft_*_question of the prompting modules)
+            showing current_code_str in full.
+        original_code_str: the script the refinement started from.
+        current_code_str: the script the question asks to edit.
+    Returns:
+        the diff-mode question, or question itself if it doesn't have the expected structure.
+    """
+    try:
+        question_parts = get_question_parts(question)
+    except UnrecognizedQuestionException as e:
+        logger.warning(f"Sending the full script, the question can't be read: {e}")
+        return question
+    text_parts = [part for part in question_parts if isinstance(part, str)]
+    if not any([current_code_str in part for part in text_parts]):
+        logger.warning("Sending the full script, the question doesn't show it.")
+        return question
+    if not any([COPY_INSTRUCTION in part or LEAP_INSTRUCTION in part for part in text_parts]):
+        logger.warning("Sending the full script, the question doesn't ask to copy or edit it.")
+        return question
+
+    prefix = f"The original Blender script, which every version below derives from:\n```python\n{original_code_str}\n```"
+    diff = get_unified_diff(original_code_str, current_code_str)
+    if len(diff) == 0:
+        changes = "No changes have been made to it so far: the current script is the original script."
+    else:
+        changes = f"The changes made to it so far, which give the current script:\n```diff\n{diff}\n```"
+
+    parts = []
+    for part in question_parts:
+        if isinstance(part, str):
+            part = part.replace(current_code_str, CURRENT_SCRIPT_PLACEHOLDER)
+            part = part.replace(COPY_INSTRUCTION, DIFF_COPY_INSTRUCTION)
+            part = part.replace(LEAP_INSTRUCTION, DIFF_LEAP_INSTRUCTION)
+            part = part.replace(REWRITE_WARNING, "")
+        parts.append(part)
+    # the answer format goes last, after the task-specific instructions
+    for idx in range(len(parts) - 1, -1, -1):
+        if isinstance(parts[idx], str):
+            parts[idx] = parts[idx] + DIFF_ANSWER_FORMAT
+            break
+    return Question([prefix, changes, *parts])
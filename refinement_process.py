@@ -12,15 +12,34 @@ from PIL import Image
 import random
 from loguru import logger
 import threading
+import asyncio
+import queue
 import time
 import io
-
-from utils.image import plot_image_grid
-from utils.code import get_code_as_string
+import shlex
+import shutil
+import hashlib
+from functools import partial
+
+from utils.image import plot_image_grid, get_dhash, get_hash_distance, get_pixel_difference, paste_border
+from utils.code import get_code_as_string, get_assignment_delta, get_residual_code, get_normalized_code, get_code_fingerprint
+from utils.code import apply_unified_diff, is_unified_diff
+from utils.blender import get_worker_pool, run_blender, get_render_deadlines, RenderTimeoutException
+from utils.blender import BlenderExecutionException, classify_failure, DETERMINISTIC_FAILURES
+from utils.render_cache import get_render_cache, get_file_hash, get_render_key
+from utils.render_farm import get_render_farm_address, get_farm_token, submit_render, DEFAULT_QUEUE_TIMEOUT
+from utils.render_handoff import get_raw_render_path, publish_raw_render, open_render, render_exists, wait_for_png
+from utils.render_handoff import read_raw_render, raw_to_image, write_raw_image
+from utils.validation import get_script_validator, ScriptValidationException
+from utils.async_engine import use_async_engine, run_in_engine, call_blocking
+from utils.rate_limit import get_rate_limiter, get_provider
+from utils.response_cache import get_response_cache
+from utils.streaming import StreamAbortedException
+from prompting.diff_prompts import to_diff_question
 
 from tasksolver.event import *
 from tasksolver.common import  Question
-from tasksolver.exceptions import  CodeExecutionException
+from tasksolver.exceptions import  CodeExecutionException, ToolCallException
 from tasksolver.agent import Agent
 from tqdm import tqdm
 
@@ -40,149 +59,772 @@ TASKSETTING2PROMPTMODULE = {TaskSetting.GEONODES: "geonodes",
                             TaskSetting.SHAPEKEY: "shapekey",
                             TaskSetting.PLACEMENT: "placement"}
 
+def get_fidelity_ladder(config:dict) -> list:
+    '''
+    run_config.fidelity_ladder is a list of render settings, from the cheapest preview
+    (used for the first round of the bracket) to full quality (used for the winner).
+    Without a ladder, everything renders at the blender_base defaults.
+    '''
+    return config["run_config"].get("fidelity_ladder") or [None]
+
+
+def get_render_settings(config:dict, fidelity_level:int=None):
+    '''
+    Render settings of a level of the fidelity ladder. Levels past the end of the ladder,
+    and fidelity_level=None, mean full quality (the last level).
+    '''
+    ladder = get_fidelity_ladder(config)
+    if fidelity_level is None or fidelity_level >= len(ladder):
+        fidelity_level = len(ladder) - 1
+    return ladder[fidelity_level]
+
+
+def get_render_profile(config:dict):
+    '''
+    run_config.render_profile holds render settings applied to every render of the run,
+    e.g. {"device": "CPU", "samples": 64, "adaptive_sampling": True, "denoiser": "OPENIMAGEDENOISE"}.
+    CPU profiles without an explicit "threads" split the machine's cores evenly between the
+    Blender processes that render concurrently.
+    Returns:
+        the render settings of the profile, or None without one.
+    '''
+    run_config = config["run_config"]
+    profile = run_config.get("render_profile")
+    if profile is None:
+        return None
+    profile = dict(profile)
+    if profile.get("device", "CPU") == "CPU":
+        profile["device"] = "CPU"
+        if profile.get("threads") is None:
+            if run_config.get("use_worker_pool", False):
+                num_processes = run_config.get("num_blender_workers", run_config["max_concurrent_rendering_processes"])
+            else:
+                num_processes = run_config["max_concurrent_rendering_processes"]
+            profile["threads"] = max(1, (os.cpu_count() or 1) // num_processes)
+    return profile
+
+
+def with_render_profile(config:dict, render_settings:dict=None):
+    '''
+    Layer render_settings (e.g. a level of the fidelity ladder) on top of the render profile.
+    '''
+    profile = get_render_profile(config)
+    if profile is None:
+        return render_settings
+    profile.update(render_settings or {})
+    return profile
+
+
+def get_render_seed(config:dict, script_path:str):
+    '''
+    With run_config.deterministic_renders, every render of a script is seeded (Python, numpy
+    and Cycles) from a hash of its normalized code, so identical scripts give identical images.
+    Returns:
+        the seed of script_path, or None when renders aren't deterministic.
+    '''
+    if not config["run_config"].get("deterministic_renders", False):
+        return None
+    code_hash = hashlib.sha256(get_normalized_code(get_code_as_string(script_path)).encode("utf-8"))
+    return int(code_hash.hexdigest()[:8], 16)
+
+
+def with_render_seed(config:dict, render_settings:dict, script_path:str):
+    seed = get_render_seed(config, script_path)
+    if seed is None:
+        return render_settings
+    return dict(render_settings or {}, seed=seed)
+
+
+def promote_candidates(candidates, fidelity_level:int, config:dict,
+                       blender_file:str, blender_script:str):
+    '''
+    Re-render candidates (code_path, render_path, ...) at a level of the fidelity ladder.
+    Level 0 renders are the ones made by tree_branch; higher levels are rendered next to them
+    as [script_id]_f[level].png, and reused if they already exist.
+    '''
+    ladder = get_fidelity_ladder(config)
+    fidelity_level = min(fidelity_level, len(ladder) - 1)
+    if fidelity_level == 0:
+        return candidates
+
+    render_semaphore = threading.Semaphore(config["run_config"]["max_concurrent_rendering_processes"])
+    promoted = list(candidates)
+
+    def thread(idx):
+        code_path, render_path = candidates[idx][0], candidates[idx][1]
+        promoted_path = str(Path(render_path).with_name(Path(code_path).stem + f"_f{fidelity_level}.png"))
+        if not render_exists(promoted_path):
+            with render_semaphore:
+                try:
+                    blender_step(config, blender_file, blender_script, code_path, promoted_path,
+                                 render_settings=get_render_settings(config, fidelity_level))
+                except CodeExecutionException:
+                    logger.warning(f"Re-rendering {code_path} at fidelity level {fidelity_level} failed, keeping {render_path}")
+                    return
+        promoted[idx] = (code_path, promoted_path, *candidates[idx][2:])
+
+    render_threads = [threading.Thread(target=thread, args=(idx,)) for idx in range(len(candidates))]
+    for x in render_threads:
+        x.start()
+    for x in render_threads:
+        x.join()
+    return promoted
+
+
+class ProposalDeduplicator(object):
+    '''
+    With run_config.dedup_code, proposals of one tree_branch are fingerprinted (see
+    utils.code.get_code_fingerprint, numbers snapped to run_config.dedup_code_tolerance) before
+    rendering, and only the first slot proposing a given fingerprint renders it. Proposals that
+    are the parent script again are duplicates too.
+    '''
+    def __init__(self, config:dict, parent_code_path:str=None):
+        self.tolerance = config["run_config"].get("dedup_code_tolerance")
+        self.owners = {}     # fingerprint -> slot rendering it
+        self.claims = {}     # slot -> fingerprint
+        self.lock = threading.Lock()
+        if parent_code_path is not None:
+            self.owners[get_code_fingerprint(get_code_as_string(parent_code_path), self.tolerance)] = "parent"
+
+    def claim(self, idx:int, code_str:str):
+        '''
+        Returns:
+            None if slot idx gets to render code_str, otherwise the slot (or "parent") it duplicates.
+        '''
+        fingerprint = get_code_fingerprint(code_str, self.tolerance)
+        with self.lock:
+            owner = self.owners.setdefault(fingerprint, idx)
+            if owner != idx:
+                return owner
+            self.claims[idx] = fingerprint
+            return None
+
+    def release(self, idx:int):
+        ''' Slot idx failed to render its proposal, so someone else may propose it again. '''
+        with self.lock:
+            fingerprint = self.claims.pop(idx, None)
+            if fingerprint is not None:
+                del self.owners[fingerprint]
+
+
+def get_proposal_deduplicator(config:dict, parent_code_path:str=None):
+    if not config["run_config"].get("dedup_code", False):
+        return None
+    return ProposalDeduplicator(config, parent_code_path=parent_code_path)
+
+
+def get_dedup_reference(config:dict, code_path:str, render_path:str, blender_file:str, blender_script:str):
+    '''
+    The render of the parent that dedup_candidates compares candidates with. Candidates are
+    rendered at the first level of a fidelity ladder, so the parent is too: rendered once
+    next to its render as [script_id]_f0.png, and reused by every round it's the parent of.
+    Otherwise, a preview would be compared with a full-quality render, and the difference in
+    noise alone would keep no-op edits from being caught.
+
+    Returns:
+        the path of the parent's render at the candidates' fidelity level.
+    '''
+    if not config["run_config"].get("dedup_renders", False) or len(get_fidelity_ladder(config)) <= 1:
+        return render_path
+    preview_path = str(Path(render_path).with_name(Path(code_path).stem + "_f0.png"))
+    if not render_exists(preview_path):
+        try:
+            blender_step(config, blender_file, blender_script, code_path, preview_path,
+                         render_settings=get_render_settings(config, 0))
+        except CodeExecutionException:
+            logger.warning(f"Re-rendering {code_path} at fidelity level 0 failed, comparing with {render_path}")
+            return render_path
+    return preview_path
+
+
+def dedup_candidates(candidates, parent_render_path:str, config:dict):
+    '''
+    With run_config.dedup_renders, drop candidates (code_path, render_path, ...) whose render
+    looks the same as the parent's (no-op edits), and collapse candidates that look the same
+    as each other into the first of them, so that they don't cost comparisons in the bracket.
+    Two renders look the same when their difference hashes are at most
+    run_config.dedup_max_hash_distance bits apart (default 2) and their pixels differ by at most
+    run_config.dedup_max_pixel_diff on average (default 1.0, out of 255).
+
+    Returns:
+        (kept candidates, dropped) where dropped lists {"code", "image", "duplicate_of"}.
+    '''
+    run_config = config["run_config"]
+    if not run_config.get("dedup_renders", False) or len(candidates) == 0:
+        return candidates, []
+    max_hash_distance = run_config.get("dedup_max_hash_distance", 2)
+    max_pixel_diff = run_config.get("dedup_max_pixel_diff", 1.0)
+
+    def looks_the_same(entrant1, entrant2):
+        # the hash is a cheap filter, the pixel difference confirms.
+        return (get_hash_distance(entrant1[1], entrant2[1]) <= max_hash_distance
+                and get_pixel_difference(entrant1[0], entrant2[0]) <= max_pixel_diff)
+
+    parent_image = open_render(parent_render_path)
+    parent = (parent_image, get_dhash(parent_image), parent_render_path)
+    kept, kept_entrants, dropped = [], [], []
+    for candidate in candidates:
+        image = open_render(candidate[1])
+        entrant = (image, get_dhash(image), candidate[1])
+        duplicate_of = None
+        for other in [parent] + kept_entrants:
+            if looks_the_same(entrant, other):
+                duplicate_of = other[2]
+                break
+        if duplicate_of is None:
+            kept.append(candidate)
+            kept_entrants.append(entrant)
+        else:
+            dropped.append({"code": candidate[0], "image": candidate[1], "duplicate_of": duplicate_of})
+
+    if len(dropped) > 0:
+        logger.info(f"{len(dropped)}/{len(candidates)} renders are near-duplicates of the parent or a sibling, "
+                    f"{len(kept)} go to the bracket.")
+    return kept, dropped
+
+
+def use_diff_prompts(config:dict) -> bool:
+    ''' run_config.diff_prompts, for agents that rewrite code (see prompting/diff_prompts.py). '''
+    return config["run_config"].get("diff_prompts", False) and config["run_config"]["edit_style"] == "rewrite_code"
+
+
+def get_answer_resolver(config:dict, parent_code_path:str=None):
+    '''
+    Returns:
+        a function turning the code of a diff-mode answer into the full script, in place, or
+        None outside of diff mode. It raises ScriptValidationException when the diff doesn't apply.
+    '''
+    if not use_diff_prompts(config) or parent_code_path is None:
+        return None
+    parent_code_str = get_code_as_string(parent_code_path)
+
+    def resolve(p_ans):
+        if not is_unified_diff(p_ans.code):
+            return # the whole script after all
+        try:
+            p_ans.code = apply_unified_diff(parent_code_str, p_ans.code)
+        except ToolCallException as e:
+            raise ScriptValidationException(f"the diff doesn't apply: {str(e)}")
+    return resolve
+
+
+def get_request_delay(limiter, num_tokens:int) -> float:
+    ''' Seconds to wait before sending a VLM request, under run_config.rate_limits (see utils/rate_limit.py). '''
+    return 0.0 if limiter is None else limiter.reserve(num_tokens)
+
+
+def get_retry_delay(limiter, exception:Exception) -> float:
+    ''' Seconds to back off after a failed VLM request: 30, or exponential with jitter under run_config.rate_limits. '''
+    if limiter is None:
+        return 30
+    return limiter.on_error(exception)
+
+
 def tree_branch(branching_factor:int, question_to_agent:Question, agent:Agent,
                 script_save:Path, render_save:Path, thoughtprocess_save:Path,
                 blender_file:str, blender_script:str,
-                iteration:int, config:dict):
+                iteration:int, config:dict, validator=None, parent_code_path=None):
     '''
     For a given question, generate a list of runnable modifications by think and act
+
+    validator, if given, statically checks each proposal (see utils/validation.py) and
+    raises ScriptValidationException for scripts that would fail in Blender, before any render.
+    parent_code_path is the script the proposals are edits of (see blender_step).
     '''
 
-    query_and_act_semaphore = threading.Semaphore(
-        min(config["run_config"]["max_concurrent_rendering_processes"], 
-            config["run_config"]["max_concurrent_generator_requests"]) )
-    
+    if config["run_config"].get("batch_render", False):
+        return tree_branch_batched(branching_factor, question_to_agent, agent,
+                                   script_save=script_save, render_save=render_save,
+                                   blender_file=blender_file, blender_script=blender_script,
+                                   iteration=iteration, config=config, validator=validator,
+                                   parent_code_path=parent_code_path)
+    if use_async_engine(config):
+        return run_in_engine(tree_branch_async(branching_factor, question_to_agent, agent,
+                                               script_save=script_save, render_save=render_save,
+                                               blender_file=blender_file, blender_script=blender_script,
+                                               iteration=iteration, config=config, validator=validator,
+                                               parent_code_path=parent_code_path), config)
+
+    # Two stages connected by queues: generator threads only wait on the LLM, render threads
+    # only wait on Blender, so neither kind of slot is held while waiting on the other.
+    # A proposal that fails to render goes back to the generation stage, up to max_tries.
+    num_generators = min(config["run_config"]["max_concurrent_generator_requests"], branching_factor)
+    num_renderers = min(config["run_config"]["max_concurrent_rendering_processes"], branching_factor)
+    max_tries = 3
+    generation_queue = queue.Queue()    # (idx, num_tries)
+    render_queue = queue.Queue()        # (idx, num_tries, p_ans)
+
     results = [None] * branching_factor     # each slot is a position for a proposed modification
-    def thread(question_to_agent, idx, results):
-        # Fill one spot in the list results with a potential code change
-        # The code change must be runnable, as checked by agent.act
-        with query_and_act_semaphore: 
-            #logger.info(f"thread {idx} acquired semaphore lock.")
-            done = False
-            num_tries = 0 
-            max_tries = 3
-            while not done and num_tries < max_tries:
-                num_tries += 1
+    raw_answers = [None] * branching_factor
+    render_stats = [{"render_timeouts": 0, "validation_failures": 0, "code_duplicates": 0, "failures": []} for _ in range(branching_factor)]
+    num_pending = [branching_factor]
+    pending_lock = threading.Lock()
+    deduplicator = get_proposal_deduplicator(config, parent_code_path)
+    replace_duplicates = config["run_config"].get("dedup_code_replace", False)
+    skip_doomed_retries = config["run_config"].get("skip_doomed_retries", False)
+    limiter = get_rate_limiter(config, get_provider(agent.vision_model))
+    resolve_answer = get_answer_resolver(config, parent_code_path)
+
+    def finish(idx, code_path, render_path):
+        results[idx] = (code_path, render_path, raw_answers[idx], render_stats[idx])  # the 4-tuple
+        with pending_lock:
+            num_pending[0] -= 1
+            all_done = num_pending[0] == 0
+        if all_done:
+            for _ in range(num_generators):
+                generation_queue.put(None)
+            for _ in range(num_renderers):
+                render_queue.put(None)
+
+    def release(idx):
+        if deduplicator is not None:
+            deduplicator.release(idx)
+
+    def retry(idx, num_tries):
+        if num_tries < max_tries:
+            generation_queue.put((idx, num_tries))
+        else:
+            finish(idx, None, None)
+
+    def generation_thread():
+        # Generate the code by think, the whole trunk
+        while True:
+            item = generation_queue.get()
+            if item is None:
+                return
+            idx, num_tries = item
+            num_tries += 1
+            try:
+                time.sleep(get_request_delay(limiter, 3000))
+                p_ans = agent.think(question_to_agent, num_tokens=3000, agent_idx=idx)
+                if limiter is not None:
+                    limiter.on_success()
+                if len(p_ans.code) == 0:
+                    logger.warning(f"The following response didn't parse into any code:\n{idx, script_save}")
+            except StreamAbortedException as e:
+                # not the provider's fault, ask again right away
+                logger.warning(f"thread {idx} response cut short: {e.reason}")
+                retry(idx, num_tries)
+                continue
+            except Exception as e: # TODO  ratelimitexception
+                print(e)
+                logger.warning(f"thread {idx} LLM querying failed with error:\n{str(e)}") 
+                # back off without holding this generator, which moves on to other slots
+                timer = threading.Timer(get_retry_delay(limiter, e), retry, args=(idx, num_tries))
+                timer.daemon = True
+                timer.start()
+                continue
+            try:
+                raw_answers[idx] = p_ans.raw
+                if resolve_answer is not None:
+                    resolve_answer(p_ans)
+                if validator is not None:
+                    validator(p_ans.code)
+                duplicate_of = None if deduplicator is None else deduplicator.claim(idx, p_ans.code)
+            except ScriptValidationException as e:
+                # rejected without going near blender
+                render_stats[idx]["validation_failures"] += 1
+                logger.warning(f"thread {idx} proposal rejected before rendering: {e.reason}")
+                retry(idx, num_tries)
+                continue
+            except Exception as e:
+                # a proposal that can't even be checked counts as a failed try, rather than
+                # taking down this generator and leaving the pipeline waiting on the slot.
+                logger.warning(f"thread {idx} failed while checking its proposal:\n{str(e)}")
+                release(idx)
+                retry(idx, num_tries)
+                continue
+            if duplicate_of is not None:
+                # the same code as another slot (or the parent) renders the same image
+                render_stats[idx]["code_duplicates"] += 1
+                logger.info(f"thread {idx} proposed the same code as {duplicate_of}.")
+                if replace_duplicates:
+                    retry(idx, num_tries)
+                else:
+                    finish(idx, None, None)
+                continue
+            render_queue.put((idx, num_tries, p_ans))
+
+    def render_thread():
+        # Execute the code by act, which has to be runnable
+        while True:
+            item = render_queue.get()
+            if item is None:
+                return
+            idx, num_tries, p_ans = item
+            try:
+                code_path, render_path = agent.act(p_ans, 
+                                                script_save=script_save, 
+                                                render_save=render_save, 
+                                                iteration=iteration,
+                                                blender_file=blender_file,
+                                                blender_script=blender_script,
+                                                config=config,
+                                                blender_step=partial(blender_step,
+                                                    render_settings=get_render_settings(config, fidelity_level=0),
+                                                    parent_script_path=parent_code_path))
+            except RenderTimeoutException:
+                # the render was killed at its deadline, count it and try another proposal.
+                render_stats[idx]["render_timeouts"] += 1
+                logger.warning(f"thread {idx} render timed out.")
+                release(idx)
+                retry(idx, num_tries)
+                continue
+            except BlenderExecutionException as e:
+                render_stats[idx]["failures"].append(e.kind)
+                release(idx)
+                if skip_doomed_retries and e.kind in DETERMINISTIC_FAILURES:
+                    # another proposal to the same question would most likely fail the same way
+                    logger.warning(f"thread {idx} script failed with a {e.kind}, not retrying.")
+                    finish(idx, None, None)
+                else:
+                    retry(idx, num_tries)
+                continue
+            except CodeExecutionException:
+                # blender execution failed, try another proposal.
+                render_stats[idx]["failures"].append("crash")
+                release(idx)
+                retry(idx, num_tries)
+                continue
+            except Exception as e:
+                # anything else gives up on the slot, rather than leaving the pipeline waiting on it.
+                logger.warning(f"thread {idx} failed while executing its proposal:\n{str(e)}")
+                release(idx)
+                finish(idx, None, None)
+                continue
+            finish(idx, code_path, render_path)
+
+    for idx in range(branching_factor):
+        generation_queue.put((idx, 0))
+    stage_threads = ([threading.Thread(target=generation_thread) for _ in range(num_generators)] +
+                     [threading.Thread(target=render_thread) for _ in range(num_renderers)])
+    for x in stage_threads:
+        x.start()
+    for x in stage_threads:
+        x.join() # wait till they all finish
+
+    assert all([el is not None for el in results])
+    
+        
+    return results
+
+
+async def tree_branch_async(branching_factor:int, question_to_agent:Question, agent:Agent,
+                            script_save:Path, render_save:Path,
+                            blender_file:str, blender_script:str,
+                            iteration:int, config:dict, validator=None, parent_code_path=None):
+    '''
+    tree_branch on the async engine (see utils/async_engine.py): one coroutine per slot instead
+    of per-stage threads, with the same generation and render limits, retries and results.
+    '''
+    generation_semaphore = asyncio.Semaphore(config["run_config"]["max_concurrent_generator_requests"])
+    render_semaphore = asyncio.Semaphore(config["run_config"]["max_concurrent_rendering_processes"])
+    max_tries = 3
+
+    raw_answers = [None] * branching_factor
+    render_stats = [{"render_timeouts": 0, "validation_failures": 0, "code_duplicates": 0, "failures": []} for _ in range(branching_factor)]
+    deduplicator = get_proposal_deduplicator(config, parent_code_path)
+    replace_duplicates = config["run_config"].get("dedup_code_replace", False)
+    skip_doomed_retries = config["run_config"].get("skip_doomed_retries", False)
+    limiter = get_rate_limiter(config, get_provider(agent.vision_model))
+    resolve_answer = get_answer_resolver(config, parent_code_path)
+
+    def release(idx):
+        if deduplicator is not None:
+            deduplicator.release(idx)
+
+    async def slot(idx):
+        num_tries = 0
+        while num_tries < max_tries:
+            num_tries += 1
+            await asyncio.sleep(get_request_delay(limiter, 3000))
+            error = None
+            async with generation_semaphore:
                 try:
-                    # Generate the code by think, the whole trunk
-                    p_ans = agent.think(question_to_agent, num_tokens=3000, agent_idx=idx)
+                    p_ans = await call_blocking(agent.think, question_to_agent, num_tokens=3000, agent_idx=idx)
+                    if limiter is not None:
+                        limiter.on_success()
                     if len(p_ans.code) == 0:
                         logger.warning(f"The following response didn't parse into any code:\n{idx, script_save}")
-                        pass
+                except StreamAbortedException as e:
+                    logger.warning(f"slot {idx} response cut short: {e.reason}")
+                    continue
                 except Exception as e: # TODO  ratelimitexception
-                    print(e)
-                    logger.warning(f"thread {idx} LLM querying failed with error:\n{str(e)}") 
-                    time.sleep(30)
+                    logger.warning(f"slot {idx} LLM querying failed with error:\n{str(e)}")
+                    error = e
+            if error is not None:
+                await asyncio.sleep(get_retry_delay(limiter, error)) # without holding a generation slot
+                continue
+            try:
+                raw_answers[idx] = p_ans.raw
+                if resolve_answer is not None:
+                    resolve_answer(p_ans)
+                if validator is not None:
+                    validator(p_ans.code)
+                duplicate_of = None if deduplicator is None else deduplicator.claim(idx, p_ans.code)
+            except ScriptValidationException as e:
+                render_stats[idx]["validation_failures"] += 1
+                logger.warning(f"slot {idx} proposal rejected before rendering: {e.reason}")
+                continue
+            except Exception as e:
+                logger.warning(f"slot {idx} failed while checking its proposal:\n{str(e)}")
+                release(idx)
+                continue
+            if duplicate_of is not None:
+                render_stats[idx]["code_duplicates"] += 1
+                logger.info(f"slot {idx} proposed the same code as {duplicate_of}.")
+                if replace_duplicates:
                     continue
+                return (None, None)
+
+            async with render_semaphore:
+                try:
+                    return await call_blocking(agent.act, p_ans,
+                                               script_save=script_save,
+                                               render_save=render_save,
+                                               iteration=iteration,
+                                               blender_file=blender_file,
+                                               blender_script=blender_script,
+                                               config=config,
+                                               blender_step=partial(blender_step,
+                                                    render_settings=get_render_settings(config, fidelity_level=0),
+                                                    parent_script_path=parent_code_path))
+                except RenderTimeoutException:
+                    render_stats[idx]["render_timeouts"] += 1
+                    logger.warning(f"slot {idx} render timed out.")
+                    release(idx)
+                except BlenderExecutionException as e:
+                    render_stats[idx]["failures"].append(e.kind)
+                    release(idx)
+                    if skip_doomed_retries and e.kind in DETERMINISTIC_FAILURES:
+                        logger.warning(f"slot {idx} script failed with a {e.kind}, not retrying.")
+                        return (None, None)
+                except CodeExecutionException:
+                    render_stats[idx]["failures"].append("crash")
+                    release(idx)
+                except Exception as e:
+                    logger.warning(f"slot {idx} failed while executing its proposal:\n{str(e)}")
+                    release(idx)
+                    return (None, None)
+        return (None, None)
+
+    slot_results = await asyncio.gather(*[slot(idx) for idx in range(branching_factor)])
+    return [(code_path, render_path, raw_answers[idx], render_stats[idx])  # the 4-tuple
+            for idx, (code_path, render_path) in enumerate(slot_results)]
+
+
+def tree_branch_batched(branching_factor:int, question_to_agent:Question, agent:Agent,
+                        script_save:Path, render_save:Path,
+                        blender_file:str, blender_script:str,
+                        iteration:int, config:dict, validator=None, parent_code_path=None):
+    '''
+    Same contract as tree_branch, but all candidates of a round are rendered by a single
+    Blender launch (see blender_batch_step). Slots whose script failed are regenerated
+    and rendered in the next round, for up to 3 rounds.
+    '''
+    generation_semaphore = threading.Semaphore(config["run_config"]["max_concurrent_generator_requests"])
+
+    results = [None] * branching_factor
+    raw_answers = [None] * branching_factor
+    render_stats = [{"render_timeouts": 0, "validation_failures": 0, "code_duplicates": 0, "failures": []} for _ in range(branching_factor)]
+    pending = list(range(branching_factor))
+    max_tries = 3
+    deduplicator = get_proposal_deduplicator(config, parent_code_path)
+    replace_duplicates = config["run_config"].get("dedup_code_replace", False)
+    skip_doomed_retries = config["run_config"].get("skip_doomed_retries", False)
+    limiter = get_rate_limiter(config, get_provider(agent.vision_model))
+    resolve_answer = get_answer_resolver(config, parent_code_path)
+
+    for num_tries in range(max_tries):
+        jobs = [None] * branching_factor
+        retry_after = [] # time.time() at which each slot that failed to query may ask again
+        def thread(question_to_agent, idx, jobs):
+            time.sleep(get_request_delay(limiter, 3000))
+            with generation_semaphore:
                 try:
-                    # Execute the code by act
-                    code_path, render_path = agent.act(p_ans, 
-                                                    script_save=script_save, 
-                                                    render_save=render_save, 
+                    p_ans = agent.think(question_to_agent, num_tokens=3000, agent_idx=idx)
+                    if limiter is not None:
+                        limiter.on_success()
+                except StreamAbortedException as e:
+                    logger.warning(f"thread {idx} response cut short: {e.reason}")
+                    return
+                except Exception as e: # TODO  ratelimitexception
+                    logger.warning(f"thread {idx} LLM querying failed with error:\n{str(e)}")
+                    # the next round of the batch starts after the longest backoff
+                    retry_after.append(time.time() + get_retry_delay(limiter, e))
+                    return
+                try:
+                    raw_answers[idx] = p_ans.raw
+                    if resolve_answer is not None:
+                        resolve_answer(p_ans)
+                    if validator is not None:
+                        validator(p_ans.code)
+                    duplicate_of = None if deduplicator is None else deduplicator.claim(idx, p_ans.code)
+                    if duplicate_of is not None:
+                        render_stats[idx]["code_duplicates"] += 1
+                        logger.info(f"thread {idx} proposed the same code as {duplicate_of}.")
+                        if not replace_duplicates:
+                            results[idx] = (None, None, raw_answers[idx], render_stats[idx])
+                        return
+                    # only save the script here -- rendering happens once for the whole batch
+                    code_path, render_path = agent.act(p_ans,
+                                                    script_save=script_save,
+                                                    render_save=render_save,
                                                     iteration=iteration,
                                                     blender_file=blender_file,
                                                     blender_script=blender_script,
                                                     config=config,
-                                                    blender_step=blender_step)
-                    done = True
-                except CodeExecutionException:
-                    # blender execution failed, count failure.
-                    # code_exec_exceptions += 1 
-                    #logger.warning(f"thread {idx} code execution failed.")
-                    continue
-            if not done: 
-                code_path = None
-                render_path = None 
-            results[idx] = (code_path, render_path, p_ans.raw)  # The in-place modification of results with the 3-tuple
-        logger.info(f"thread {idx} released semaphore lock.")
-
-    # FOR DEBUGGING
-    # thread(question_to_agent, 0, results)    
-
-    # Run the think-act pipeline for branching_factor(width) times
-    llm_threads = [threading.Thread(target=thread,
-                     args=(question_to_agent, i, results))
-                     for i in range(branching_factor)]
-    for idx, x in enumerate(llm_threads):
-        x.start()
-        #logger.info(f"starting thread {idx}...")
-
-    for x in llm_threads:
-        x.join() # wait till they all finish
-    #logger.info(f"joined all threads")
-    
-    assert all([el is not None for el in results])
-    
-        
+                                                    blender_step=lambda *args, **kwargs: None)
+                except ScriptValidationException as e:
+                    render_stats[idx]["validation_failures"] += 1
+                    logger.warning(f"thread {idx} proposal rejected before rendering: {e.reason}")
+                    return
+                except Exception as e:
+                    # the slot goes to the next round, like a failed render
+                    logger.warning(f"thread {idx} failed while checking its proposal:\n{str(e)}")
+                    if deduplicator is not None:
+                        deduplicator.release(idx)
+                    return
+                jobs[idx] = (code_path, render_path)
+
+        llm_threads = [threading.Thread(target=thread, args=(question_to_agent, idx, jobs))
+                        for idx in pending]
+        for x in llm_threads:
+            x.start()
+        for x in llm_threads:
+            x.join()
+
+        batch = [idx for idx in pending if jobs[idx] is not None]
+        if len(batch) > 0:
+            outcomes = blender_batch_step(config, blender_file, blender_script,
+                                          [jobs[idx] for idx in batch], render_save,
+                                          render_settings=get_render_settings(config, fidelity_level=0))
+            for idx, outcome in zip(batch, outcomes):
+                if outcome == "ok":
+                    results[idx] = (*jobs[idx], raw_answers[idx], render_stats[idx])
+                elif outcome == "timeout":
+                    render_stats[idx]["render_timeouts"] += 1
+                else:
+                    render_stats[idx]["failures"].append(outcome)
+                    if skip_doomed_retries and outcome in DETERMINISTIC_FAILURES:
+                        results[idx] = (None, None, raw_answers[idx], render_stats[idx])
+                if outcome != "ok" and deduplicator is not None:
+                    deduplicator.release(idx)
+
+        pending = [idx for idx in pending if results[idx] is None]
+        if len(pending) == 0:
+            break
+        logger.info(f"{len(pending)}/{branching_factor} candidates failed in batch round {num_tries}, regenerating.")
+        if num_tries + 1 < max_tries and len(retry_after) > 0:
+            time.sleep(max(0.0, max(retry_after) - time.time())) # what's left of it after the batch render
+
+    for idx in pending:
+        results[idx] = (None, None, raw_answers[idx], render_stats[idx])
     return results
 
 
+def craft_match(candidate1, candidate2, target_image, craft_eval_question, target_description, use_vision):
+    '''
+    Put two candidates side by side, in random order, in a question to the judge.
+    Returns:
+        (order, (left render, right render), question)
+    '''
+    order = random.sample([0,1], 2)
+
+    left_code = get_code_as_string([candidate1[0], candidate2[0]][order[0]])
+    left_img_file = [candidate1[1], candidate2[1]][order[0]]
+    left_img = open_render(left_img_file)
+
+    right_code = get_code_as_string([candidate1[0], candidate2[0]][order[1]])
+    right_img_file = [candidate1[1], candidate2[1]][order[1]]
+    right_img = open_render(right_img_file)
+
+    assert left_img is not None
+    assert right_img is not None
+    assert left_code is not None
+    assert right_code is not None
+    if target_description is None:
+        print("target description is None -- intended?")
+
+    question_to_critic = craft_eval_question(
+                            target_image=target_image,
+                            left_image=left_img,
+                            right_image=right_img,
+                            left_code=left_code,
+                            right_code=right_code,
+                            target_description=target_description,
+                            use_vision=use_vision)
+
+    if target_description is None and target_image is None:
+        raise ValueError("No target provided to the competition_thread, either textual or image")
+    return order, (left_img_file, right_img_file), question_to_critic
+
+
+def settle_match(candidate1, candidate2, order, img_files, p_ans, question_to_critic):
+    '''
+    Returns:
+        a tuple of (winner, (left_img, right_img), raw answer(left or right), question)
+    '''
+    if p_ans.data == "left":
+        winner_index = order[0]
+    elif p_ans.data == "right":
+        winner_index = order[1]
+    return ([candidate1, candidate2][winner_index], img_files, p_ans.raw, question_to_critic)
+
+
 def get_top_candidate(candidates, target, judge, task_setting:TaskSetting, config:dict, 
-                            target_description=None, use_vision=True,):
+                            target_description=None, use_vision=True,
+                            blender_file=None, blender_script=None, fidelity_level=None):
+    '''
+    Knockout bracket between candidates. When fidelity_level is given, the candidates of
+    this round are first re-rendered at that level of the fidelity ladder, and every
+    following round goes one level up. fidelity_level=None compares the renders as they are.
+    '''
+    if use_async_engine(config):
+        return run_in_engine(get_top_candidate_async(candidates, target, judge, task_setting=task_setting,
+                                                     config=config, target_description=target_description,
+                                                     use_vision=use_vision, blender_file=blender_file,
+                                                     blender_script=blender_script, fidelity_level=fidelity_level), config)
+
+    if fidelity_level is not None and len(get_fidelity_ladder(config)) > 1:
+        candidates = promote_candidates(candidates, fidelity_level, config,
+                                        blender_file=blender_file, blender_script=blender_script)
 
     prompting_submodule = importlib.import_module("prompting."+TASKSETTING2PROMPTMODULE[task_setting])
     craft_eval_question = getattr(prompting_submodule, "craft_eval_question")
     evaluation_semaphore = threading.Semaphore(config["run_config"]["max_concurrent_evaluation_requests"])
 
+    limiter = get_rate_limiter(config, get_provider(judge.vision_model))
+
     def competition_thread(candidate1, candidate2, results, index, target_image=target):
         # Takes in two candidates and return left or right
 
-        with evaluation_semaphore:
-            # randomize the ordering
-            done = False
-            num_tries = 0
-            max_tries = 3
-
-            while not done and num_tries < max_tries:
-                num_tries += 1
-                order = random.sample([0,1], 2)
-
-                left_code = get_code_as_string([candidate1[0], candidate2[0]][order[0]])
-                left_img_file = [candidate1[1], candidate2[1]][order[0]]
-                left_img = Image.open(left_img_file)
-
-                right_code = get_code_as_string([candidate1[0], candidate2[0]][order[1]])
-                right_img_file = [candidate1[1], candidate2[1]][order[1]]
-                right_img = Image.open(right_img_file)
-
-                assert left_img is not None
-                assert right_img is not None
-                assert left_code is not None
-                assert right_code is not None
-                if target_description is None:
-                    print("target description is None -- intended?")
-
-                question_to_critic = craft_eval_question(
-                                        target_image=target_image,
-                                        left_image=left_img,
-                                        right_image=right_img,
-                                        left_code=left_code,
-                                        right_code=right_code,
-                                        target_description=target_description,
-                                        use_vision=use_vision)
-                
-                if target_description is None and target is None:
-                    raise ValueError("No target provided to the competition_thread, either textual or image")
-
+        # randomize the ordering
+        done = False
+        num_tries = 0
+        max_tries = 3
+
+        while not done and num_tries < max_tries:
+            num_tries += 1
+            order, img_files, question_to_critic = craft_match(candidate1, candidate2, target_image,
+                                                               craft_eval_question, target_description, use_vision)
+            time.sleep(get_request_delay(limiter, 500))
+            # the evaluation slot is only held for the request itself, not while backing off
+            with evaluation_semaphore:
                 try: 
                     p_ans = judge.think(question_to_critic, num_tokens=500, agent_idx=index)
                     done = True
+                    if limiter is not None:
+                        limiter.on_success()
                 except Exception as e: # TODO  ratelimitexception
-                    logger.warning(f"Sleep for 30s, {str(e)}")
-                    time.sleep(30)
-                    continue
-
-            if done:
-                if p_ans.data == "left":
-                    winner_index = order[0]
-                elif p_ans.data == "right":
-                    winner_index = order[1]
-                
-                # return a tuple of (winner, (left_img, right_img), raw answer(left or right), question )
-                results[index] = ([candidate1, candidate2][winner_index], 
-                                (left_img_file, right_img_file),
-                                p_ans.raw, 
-                                question_to_critic)             
+                    error = e
+            if not done:
+                delay = get_retry_delay(limiter, error)
+                logger.warning(f"Sleep for {delay:.0f}s, {str(error)}")
+                time.sleep(delay)
+
+        if done:
+            results[index] = settle_match(candidate1, candidate2, order, img_files, p_ans, question_to_critic)
             
     # assert len(candidates)%2 == 0, "Number candidates should be even, otherwise not handled."
     assert len(candidates) > 0, "the candidate list is empty"
@@ -239,7 +881,89 @@ def get_top_candidate(candidates, target, judge, task_setting:TaskSetting, confi
     if len(winners) > 1:
         winner, _intermediates = get_top_candidate(winners, target, judge, config=config,
                     target_description=target_description, task_setting=task_setting,
-                    use_vision=use_vision) 
+                    use_vision=use_vision, blender_file=blender_file, blender_script=blender_script,
+                    fidelity_level=(None if fidelity_level is None else fidelity_level + 1)) 
+        return winner, intermediates + _intermediates
+    else:
+        return winners[0], intermediates # the only winner
+
+
+async def get_top_candidate_async(candidates, target, judge, task_setting:TaskSetting, config:dict,
+                                  target_description=None, use_vision=True,
+                                  blender_file=None, blender_script=None, fidelity_level=None):
+    '''
+    get_top_candidate on the async engine: one coroutine per match of a round, bounded by
+    max_concurrent_evaluation_requests, instead of one thread per match.
+    '''
+    if fidelity_level is not None and len(get_fidelity_ladder(config)) > 1:
+        candidates = await call_blocking(promote_candidates, candidates, fidelity_level, config,
+                                         blender_file=blender_file, blender_script=blender_script)
+
+    prompting_submodule = importlib.import_module("prompting."+TASKSETTING2PROMPTMODULE[task_setting])
+    craft_eval_question = getattr(prompting_submodule, "craft_eval_question")
+    evaluation_semaphore = asyncio.Semaphore(config["run_config"]["max_concurrent_evaluation_requests"])
+
+    limiter = get_rate_limiter(config, get_provider(judge.vision_model))
+
+    async def match(candidate1, candidate2, index):
+        for _ in range(3):
+            order, img_files, question_to_critic = await call_blocking(
+                craft_match, candidate1, candidate2, target, craft_eval_question, target_description, use_vision)
+            await asyncio.sleep(get_request_delay(limiter, 500))
+            error = None
+            async with evaluation_semaphore:
+                try:
+                    p_ans = await call_blocking(judge.think, question_to_critic, num_tokens=500, agent_idx=index)
+                    if limiter is not None:
+                        limiter.on_success()
+                except Exception as e: # TODO  ratelimitexception
+                    error = e
+            if error is not None:
+                delay = get_retry_delay(limiter, error)
+                logger.warning(f"Sleep for {delay:.0f}s, {str(error)}")
+                await asyncio.sleep(delay)
+                continue
+            try:
+                return settle_match(candidate1, candidate2, order, img_files, p_ans, question_to_critic)
+            except Exception as e:
+                logger.warning(f"Match {index} has no winner: {str(e)}")
+                return None
+        return None
+
+    assert len(candidates) > 0, "the candidate list is empty"
+
+    odd_one_out = None
+    if len(candidates)%2 == 1: # number of candidates is odd
+        odd_one_out = candidates[-1]
+        candidates = candidates[:-1]
+    num_candidates = len(candidates)
+
+    winners = []
+    intermediates = []
+    for _ in range(3):
+        results = await asyncio.gather(*[match(candidates[2*i], candidates[2*i+1], i)
+                                         for i in range(num_candidates//2)])
+        winners = [winner[0] for winner in results if winner is not None]
+        intermediates = [{"left": winner[1][0],
+                          "right": winner[1][1],
+                          "winner": winner[0][1],
+                          "inbound_question": str(winner[3]),
+                          "thought_string": winner[2]}
+                         for winner in results if winner is not None]
+        if len(winners) > 0 or num_candidates//2 == 0:
+            break
+
+    if not(len(winners) > 0 or num_candidates//2 == 0):
+        raise ValueError("All comparisons between samples seem to have failed.")
+
+    if odd_one_out is not None:
+        winners += [odd_one_out]
+
+    if len(winners) > 1:
+        winner, _intermediates = await get_top_candidate_async(winners, target, judge, config=config,
+                    target_description=target_description, task_setting=task_setting,
+                    use_vision=use_vision, blender_file=blender_file, blender_script=blender_script,
+                    fidelity_level=(None if fidelity_level is None else fidelity_level + 1))
         return winner, intermediates + _intermediates
     else:
         return winners[0], intermediates # the only winner
@@ -251,32 +975,398 @@ def make_if_nonexistent(folder):
     return folder
 
 
+DELTA_APPLY_TASKS = ("shapekey", "lighting")
+
+
+def get_render_delta(config, script_path, parent_script_path):
+    '''
+    Returns:
+        the delta job (see utils.blender.BlenderWorker.run_job) that renders script_path by
+        replaying its property writes on the scene of parent_script_path, or None when
+        run_config.delta_apply is off, the task isn't covered, or the edit isn't a pure delta.
+    '''
+    run_config = config["run_config"]
+    if (parent_script_path is None or not run_config.get("delta_apply", False)
+            or not run_config.get("use_worker_pool", False)
+            or config["task"]["type"] not in DELTA_APPLY_TASKS):
+        return None
+    delta = get_assignment_delta(get_code_as_string(parent_script_path), get_code_as_string(script_path))
+    if delta is None:
+        return None
+    return {"parent": os.path.abspath(parent_script_path), "statements": delta[0], "inverse": delta[1]}
+
+
+SNAPSHOT_TASKS = ("placement", "geonodes")
+_snapshot_locks = {}
+_snapshot_locks_lock = threading.Lock()
+# script path -> (blend, script) it was rendered from, see get_snapshot_source
+_render_sources = {}
+
+
+def bake_snapshot(config, blender_file, blender_script, script_path):
+    '''
+    Save the scene that script_path builds on blender_file as a .blend under
+    [output_dir]/snapshots, named after the content of all three. Baked once, then reused.
+    The bake replays the render of script_path: from the same (blend, script) it was rendered
+    from (a snapshot of its own parent, if it had one) and with the same seed, so that what
+    the script draws at random is what the judged render showed.
+
+    Returns:
+        the path of the snapshot, or None if the script couldn't be baked.
+    '''
+    source_blend, source_script = _render_sources.get(os.path.abspath(script_path), (blender_file, script_path))
+    seed = get_render_seed(config, script_path)
+    sha = hashlib.sha256()
+    sha.update(get_file_hash(source_blend).encode("utf-8"))
+    sha.update(get_file_hash(blender_script).encode("utf-8"))
+    sha.update(get_normalized_code(get_code_as_string(source_script)).encode("utf-8"))
+    sha.update(str(seed).encode("utf-8"))
+    snapshot_path = Path(config["output"]["output_dir"])/"snapshots"/f"{sha.hexdigest()}.blend"
+
+    with _snapshot_locks_lock:
+        lock = _snapshot_locks.setdefault(str(snapshot_path), threading.Lock())
+    with lock:
+        if snapshot_path.is_file():
+            return str(snapshot_path)
+        snapshot_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = snapshot_path.with_name(snapshot_path.stem + ".tmp.blend")
+        command = shlex.split(config["run_config"]["blender_command"]) + [
+                        "--background", source_blend,
+                        "--python-exit-code", "1",
+                        "--python", blender_script,
+                        "--", "--bake", source_script, str(tmp_path)]
+        if seed is not None:
+            command.append(json.dumps({"seed": seed}))
+        timeout, cpu_timeout = get_render_deadlines(config)
+        log = ""
+        try:
+            _, log = run_blender(command, timeout=timeout, cpu_timeout=cpu_timeout)
+        except RenderTimeoutException:
+            pass
+        if not tmp_path.is_file():
+            logger.warning(f"Couldn't bake a snapshot of {script_path}, its children replay the full script.\n{log}")
+            return None
+        os.replace(tmp_path, snapshot_path)
+        logger.info(f"Baked the scene of {script_path} into {snapshot_path}")
+        return str(snapshot_path)
+
+
+def get_snapshot_source(config, blender_file, blender_script, script_path, parent_script_path):
+    '''
+    With run_config.bake_snapshots, for placement and geonodes, a script that only adds
+    statements after the ones of its parent runs from a snapshot of the parent's scene, and
+    only executes what it adds (see utils.code.get_residual_code).
+
+    Returns:
+        (blend, script) to render script_path from: (parent snapshot, residual script) when
+        possible, (blender_file, script_path) otherwise.
+    '''
+    if (parent_script_path is None or not config["run_config"].get("bake_snapshots", False)
+            or config["task"]["type"] not in SNAPSHOT_TASKS):
+        return blender_file, script_path
+    residual = get_residual_code(get_code_as_string(parent_script_path), get_code_as_string(script_path))
+    if residual is None:
+        return blender_file, script_path
+    snapshot_path = bake_snapshot(config, blender_file, blender_script, parent_script_path)
+    if snapshot_path is None:
+        return blender_file, script_path
+    residual_path = str(Path(script_path).with_name(Path(script_path).stem + "_residual.py"))
+    with open(residual_path, "w") as f:
+        f.write(residual)
+    return snapshot_path, residual_path
+
+
 def blender_step(config, blender_file, blender_script, script_path, render_path, 
-                verify_render_path=True):
+                verify_render_path=True, render_settings=None, parent_script_path=None,
+                crop_to_subject=True):
 
     '''
     Generate a rendered image with given script_path at render_path
+
+    render_settings, if given, are forwarded to the blender_base script (see
+    render_utils.apply_render_settings), e.g. a level of the fidelity ladder.
+    parent_script_path, if given, is the script that script_path is an edit of. With
+    run_config.delta_apply, edits that only change property values are rendered by a warm
+    worker that replays just those writes on the parent's scene. With run_config.bake_snapshots,
+    placement and geonodes edits that only add statements run from a snapshot of the parent's scene.
+    With run_config.crop_to_subject (and crop_to_subject), only the subject's part of the frame is
+    rendered, and composited onto a background render (see get_subject_background).
     '''
 
     if verify_render_path  and os.path.isfile(render_path):
         raise ValueError(f"verify_render_path is True but {render_path} already exists before blender process.")
 
     assert blender_file is not None and blender_script is not None
+    render_settings = with_render_seed(config, with_render_profile(config, render_settings), script_path)
+
+    render_farm_address = get_render_farm_address(config)
+    background_path = None
+    if crop_to_subject and render_farm_address is None:
+        background_path = get_subject_background(config, blender_file, blender_script, render_settings)
+    if background_path is not None:
+        render_settings = dict(render_settings or {},
+                               subject_border=config["run_config"].get("subject_border_margin", 0.05))
+
+    render_cache = get_render_cache(config)
+    if render_cache is not None:
+        cache_key = render_cache.make_key(blender_file, blender_script, get_code_as_string(script_path),
+                                          render_settings=render_settings)
+        if render_cache.fetch(cache_key, render_path):
+            logger.info(f"Render cache hit, skipping blender for {script_path}")
+            return None
     
-    # Enter the blender code
-    command = [config["run_config"]["blender_command"], "--background", blender_file, 
-                    "--python", blender_script, 
-                    "--", script_path, render_path]
-    command = ' '.join(command)
-    command_run = subprocess.run(command, shell=True, check=True)
-    
-    if verify_render_path  and not os.path.isfile(render_path):
-        logger.warning(f"The following bpy script didn't run correctly in blender:{script_path}")
-        raise CodeExecutionException 
+    # Raises RenderTimeoutException when a deadline is hit. The process is killed on the spot,
+    # so the caller gets its slot back instead of waiting on a hung Blender.
+    timeout, cpu_timeout = get_render_deadlines(config)
+    source_blend, source_script = get_snapshot_source(config, blender_file, blender_script,
+                                                      script_path, parent_script_path)
+    _render_sources[os.path.abspath(script_path)] = (source_blend, source_script)
+    # With run_config.raw_handoff, local renders come back as raw pixels in shared memory (see
+    # utils/render_handoff.py), and the png at render_path is written in the background.
+    raw_handoff = config["run_config"].get("raw_handoff", False) and render_farm_address is None
+    output_path = get_raw_render_path(render_path) if raw_handoff else render_path
+    if raw_handoff and os.path.isfile(output_path):
+        os.unlink(output_path) # stale, from an earlier run
+    log = None
+    try:
+        if render_farm_address is not None:
+            # Ship the script to whichever render box of the farm is free
+            farm_config = config["run_config"]["render_farm"]
+            submit_render(render_farm_address, source_blend, blender_script, source_script, render_path,
+                          render_settings, timeout=timeout, cpu_timeout=cpu_timeout,
+                          max_attempts=farm_config.get("max_attempts", 3),
+                          queue_timeout=farm_config.get("queue_timeout", DEFAULT_QUEUE_TIMEOUT),
+                          token=get_farm_token(farm_config.get("token")))
+        elif config["run_config"].get("use_worker_pool", False) and source_blend == blender_file:
+            # Hand the script to a warm Blender that already has the blend and base script loaded
+            get_worker_pool(config, blender_file, blender_script).render(script_path, output_path, render_settings,
+                                                                         timeout=timeout, cpu_timeout=cpu_timeout,
+                                                                         delta=get_render_delta(config, script_path, parent_script_path))
+        else:
+            # Enter the blender code
+            # (snapshots change from one depth to the next, so they're rendered one-shot)
+            command = shlex.split(config["run_config"]["blender_command"]) + [
+                            "--background", source_blend, 
+                            "--python-exit-code", "1",
+                            "--python", blender_script, 
+                            "--", source_script, output_path]
+            if render_settings is not None:
+                command.append(json.dumps(render_settings))
+            _, log = run_blender(command, timeout=timeout, cpu_timeout=cpu_timeout)
+
+        if verify_render_path  and not os.path.isfile(output_path):
+            kind = "crash" if log is None else classify_failure(log)
+            logger.warning(f"The following bpy script didn't run correctly ({kind}) in blender:{script_path}")
+            raise BlenderExecutionException(kind, log or "")
+    except BlenderExecutionException as e:
+        # kept with the candidate, so the real traceback isn't lost
+        with open(os.path.splitext(render_path)[0] + ".log", "w") as f:
+            f.write(e.log)
+        raise
+
+    if background_path is not None and os.path.isfile(output_path):
+        border = (read_render_stats(output_path) or {}).get("border")
+        if border is not None:
+            composite_onto_background(output_path, background_path, border)
+    if raw_handoff and os.path.isfile(get_render_stats_path(output_path)):
+        os.replace(get_render_stats_path(output_path), get_render_stats_path(render_path))
+    if raw_handoff and os.path.isfile(output_path):
+        publish_raw_render(output_path, render_path,
+                           on_png_written=(None if render_cache is None else partial(render_cache.store, cache_key)))
+    elif render_cache is not None and os.path.isfile(render_path):
+        render_cache.store(cache_key, render_path)
 
     return None
 
 
+def get_render_stats_path(render_path:str) -> str:
+    ''' Where the blender_base scripts record how a render went (see render_utils.render_with_stats). '''
+    return os.path.splitext(render_path)[0] + ".stats.json"
+
+
+def read_render_stats(render_path:str):
+    '''
+    Returns:
+        the stats of the render at render_path, e.g. {"samples": 212, "max_samples": 4096,
+        "stopped_by": "converged", ...}, or None if there are none (cache hits, render farm).
+    '''
+    if render_path is None:
+        return None
+    try:
+        with open(get_render_stats_path(render_path), "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def blender_batch_step(config, blender_file, blender_script, jobs, manifest_save:Path,
+                       render_settings=None):
+    '''
+    Render many (script_path, render_path) jobs in one Blender session, via the manifest
+    mode of the blender_base scripts.
+
+    Returns:
+        a list with the outcome of each job: "ok", "timeout" when the batch went past its
+        deadline (the per-render deadlines, times the number of jobs to render) before
+        reaching it, or the kind of failure (see utils.blender.BlenderExecutionException).
+    '''
+    assert blender_file is not None and blender_script is not None
+    render_settings = with_render_profile(config, render_settings)
+    job_settings = [with_render_seed(config, render_settings, script_path) for script_path, _ in jobs]
+
+    render_cache = get_render_cache(config)
+    cache_keys = [None] * len(jobs)
+    outcomes = ["error"] * len(jobs)
+    if render_cache is not None:
+        for job_idx, (script_path, render_path) in enumerate(jobs):
+            cache_keys[job_idx] = render_cache.make_key(blender_file, blender_script, get_code_as_string(script_path),
+                                                        render_settings=job_settings[job_idx])
+            if render_cache.fetch(cache_keys[job_idx], render_path):
+                outcomes[job_idx] = "ok"
+
+    manifest_path = str(manifest_save / f"manifest_{ObjectId()}.json")
+    entries = [{"script": script_path,
+                "output": render_path,
+                "status": os.path.splitext(render_path)[0] + ".status.json",
+                "render_settings": settings}
+                for (script_path, render_path), settings, outcome in zip(jobs, job_settings, outcomes) if outcome != "ok"]
+    if len(entries) == 0:
+        return outcomes
+    with open(manifest_path, "w") as f:
+        json.dump(entries, f)
+
+    command = shlex.split(config["run_config"]["blender_command"]) + [
+                    "--background", blender_file,
+                    "--python", blender_script,
+                    "--", "--manifest", manifest_path]
+    timeout, cpu_timeout = get_render_deadlines(config)
+    timed_out = False
+    try:
+        # the exit code is ignored: a failing entry is reported in its status file
+        run_blender(command,
+                    timeout=(None if timeout is None else timeout * len(entries)),
+                    cpu_timeout=(None if cpu_timeout is None else cpu_timeout * len(entries)))
+    except RenderTimeoutException:
+        timed_out = True
+
+    for job_idx, (script_path, render_path) in enumerate(jobs):
+        if outcomes[job_idx] == "ok":
+            continue # cache hit
+        status_path = os.path.splitext(render_path)[0] + ".status.json"
+        if os.path.isfile(status_path):
+            with open(status_path, "r") as f:
+                status = json.load(f)
+            if status["status"] == "ok" and os.path.isfile(render_path):
+                outcomes[job_idx] = "ok"
+            else:
+                outcomes[job_idx] = classify_failure(status.get("error", ""))
+        elif timed_out:
+            outcomes[job_idx] = "timeout"
+        else:
+            outcomes[job_idx] = "crash" # blender died before reaching the entry
+
+        if outcomes[job_idx] != "ok":
+            logger.warning(f"The following bpy script didn't run correctly ({outcomes[job_idx]}) in blender:{script_path}")
+        elif render_cache is not None:
+            render_cache.store(cache_keys[job_idx], render_path)
+    return outcomes
+
+
+_base_render_locks = {}
+_base_render_locks_lock = threading.Lock()
+
+
+def link_render(src:str, dst:str):
+    """ Hardlink src to dst, or copy it where links aren't possible (e.g. across filesystems). """
+    tmp_dst = f"{dst}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        os.link(src, tmp_dst)
+    except OSError:
+        shutil.copyfile(src, tmp_dst)
+    os.replace(tmp_dst, dst)
+
+
+def get_base_render(config, blender_file, blender_script, script_path, render_settings=None) -> str:
+    '''
+    Render script_path once under [output_dir]/base_renders, named after the content of the
+    blend, base script, script and render settings.
+    Returns:
+        the path of the shared render.
+    '''
+    key_settings = with_render_seed(config, with_render_profile(config, render_settings), script_path)
+    key = get_render_key(blender_file, blender_script, get_code_as_string(script_path), key_settings)
+    shared_path = Path(config["output"]["output_dir"])/"base_renders"/f"{key}.png"
+
+    with _base_render_locks_lock:
+        lock = _base_render_locks.setdefault(str(shared_path), threading.Lock())
+    with lock:
+        if not shared_path.is_file():
+            shared_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = str(shared_path.with_name(f"{key}.{os.getpid()}.tmp.png"))
+            if os.path.isfile(tmp_path):
+                os.unlink(tmp_path) # left over by a run that was killed
+            blender_step(config, blender_file, blender_script, script_path, tmp_path, verify_render_path=True,
+                         render_settings=render_settings, crop_to_subject=False)
+            wait_for_png(tmp_path)
+            os.replace(tmp_path, shared_path)
+        else:
+            logger.info(f"Reusing the render of {script_path} from {shared_path}")
+    return str(shared_path)
+
+
+def render_base(config, blender_file, blender_script, script_path, render_path):
+    '''
+    Render script_path to render_path, like blender_step, for the renders every instance and
+    variant folder of a run starts from (init and target renders). These are rendered once
+    (see get_base_render) and linked into each folder. Off with run_config.share_base_renders = false.
+    '''
+    if not config["run_config"].get("share_base_renders", True):
+        return blender_step(config, blender_file, blender_script, script_path, render_path,
+                            verify_render_path=True, crop_to_subject=False)
+    link_render(get_base_render(config, blender_file, blender_script, script_path), render_path)
+
+
+_subject_backgrounds = {} # (blend, base script) -> script whose render is the background of cropped renders
+
+
+def set_subject_background(blender_file, blender_script, script_path):
+    with _base_render_locks_lock:
+        _subject_backgrounds[(blender_file, blender_script)] = script_path
+
+
+def get_subject_background(config, blender_file, blender_script, render_settings=None):
+    '''
+    With run_config.crop_to_subject, candidate renders only path-trace the subject's screen-space
+    bounding box (see render_utils.set_border_subjects), and the rest of the frame is taken from
+    the render of the init script with the same settings, rendered once.
+    Returns:
+        the path of that background render, or None when renders aren't cropped.
+    '''
+    if not config["run_config"].get("crop_to_subject", False):
+        return None
+    with _base_render_locks_lock:
+        script_path = _subject_backgrounds.get((blender_file, blender_script))
+    if script_path is None:
+        return None
+    return get_base_render(config, blender_file, blender_script, script_path, render_settings)
+
+
+def composite_onto_background(output_path:str, background_path:str, border):
+    ''' Fill everything of the render at output_path (png or raw) outside of border from the background. '''
+    background = open_render(background_path)
+    if output_path.endswith(".rgba"):
+        render = raw_to_image(read_raw_render(output_path))
+    else:
+        render = Image.open(output_path)
+    composite = paste_border(render, background, border)
+    if output_path.endswith(".rgba"):
+        write_raw_image(composite, output_path)
+    else:
+        tmp_path = output_path + ".tmp.png"
+        composite.save(tmp_path, format="PNG")
+        os.replace(tmp_path, output_path)
+
+
 def refinement(config, credentials, breadth, depth, blender_file, blender_script, 
                 init_code, method_variation, output_folder, overwrite=True):        
     
@@ -319,15 +1409,16 @@ def refinement(config, credentials, breadth, depth, blender_file, blender_script
     
     assert init_code is not None
     if not os.path.exists(init_render_file):
-        blender_step(config, blender_file, blender_script, init_code, init_render_file, verify_render_path=True)
+        render_base(config, blender_file, blender_script, init_code, init_render_file)
+    set_subject_background(blender_file, blender_script, init_code)
         
-    init_image = Image.open(init_render_file)      # Keep an record of original image
+    init_image = open_render(init_render_file)      # Keep an record of original image
 
 
     if target_render_file is not None:      # If provided with a path to ideal target image
         if target_code is not None and not os.path.exists(target_render_file):  # If target_code is also provided and no image provided
-            blender_step(config, blender_file, blender_script, target_code, target_render_file,  verify_render_path=True)  # Render and overwrite the dalle generated images
-        target_image = Image.open(target_render_file)      
+            render_base(config, blender_file, blender_script, target_code, target_render_file)  # Render and overwrite the dalle generated images
+        target_image = open_render(target_render_file)      
     else:
         target_image = None
 
@@ -378,6 +1469,15 @@ def refinement(config, credentials, breadth, depth, blender_file, blender_script
     else:
         raise ValueError(f"Invalid evaluator: {run_config['state_evaluator_type']}")
 
+    # replay the answers to questions already asked, with run_config.response_cache_dir
+    for llm_agent in (param_tuner, agent, judge):
+        llm_agent.response_cache = get_response_cache(config)
+    # with run_config.stream_responses, code-writing GeneralAgents parse their answer as soon as the code block closes
+    if run_config.get("stream_responses", False):
+        for llm_agent in (param_tuner, agent):
+            if isinstance(llm_agent, GeneralAgent):
+                llm_agent.enable_streaming(run_config.get("stream_max_chars_without_code", 2000))
+
 
 
 
@@ -387,6 +1487,9 @@ def refinement(config, credentials, breadth, depth, blender_file, blender_script
 
     
 
+    # static checks of proposals against the starter script, before they reach blender
+    validator = get_script_validator(config, init_code)
+
     # start of simulation
     code_path = init_code       # original starter code
     render_path = init_render_file      # path of original rendered image
@@ -421,10 +1524,13 @@ def refinement(config, credentials, breadth, depth, blender_file, blender_script
             # Craft a question based on the image and text input
             tuner_question = craft_tuner_question(
                 blender_init_code_str=get_code_as_string(code_path),
-                init_image=Image.open(render_path), 
+                init_image=open_render(render_path), 
                 target_image=target_image,
                 target_description=target_description,
                 use_vision=thinker_is_visual)
+            if use_diff_prompts(config):
+                # the original script once, then the changes of this lineage
+                tuner_question = to_diff_question(tuner_question, get_code_as_string(init_code), get_code_as_string(code_path))
             
             logger.info(f"tuner_question_formed")
 
@@ -439,11 +1545,20 @@ def refinement(config, credentials, breadth, depth, blender_file, blender_script
                                         thoughtprocess_save=process_json,
                                         blender_file=blender_file, 
                                         blender_script=blender_script,
-                                        iteration=i, config=config)
+                                        iteration=i, config=config,
+                                        validator=validator,
+                                        parent_code_path=code_path)
             
             logger.info(f"Runnable modifications generated for iteration {i}/{depth-1}(0-indexed) of depth")
 
+            render_timeouts = sum([res[3]["render_timeouts"] for res in results])
+            validation_failures = sum([res[3]["validation_failures"] for res in results])
+            code_duplicates = sum([res[3]["code_duplicates"] for res in results])
+            failures = [kind for res in results for kind in res[3]["failures"]]
             results = [el for el in results if el[0] is not None]       # Take out the code_path
+            # near-duplicates of the parent or of each other don't go to the bracket
+            kept_results, duplicates = dedup_candidates(
+                results, get_dedup_reference(config, code_path, render_path, blender_file, blender_script), config)
 
             # Register all the potential modifications to the json file
             process_json.append(
@@ -453,9 +1568,17 @@ def refinement(config, credentials, breadth, depth, blender_file, blender_script
                     "inbound_question": str(tuner_question),
                     "choices_image": [res[1] for res in results],
                     "choices_code": [res[0] for res in results],
-                    "thought_strings": [res[2] for res in results]
+                    "thought_strings": [res[2] for res in results],
+                    "render_timeouts": render_timeouts,
+                    "validation_failures": validation_failures,
+                    "code_duplicates": code_duplicates,
+                    "failures": failures,
+                    "render_seeds": [get_render_seed(config, res[0]) for res in results],
+                    "render_samples": [(read_render_stats(res[1]) or {}).get("samples") for res in results],
+                    "duplicates": duplicates
                 }   
             )
+            results = kept_results
 
             # Get the top candidate by state evaluator
             if len(results) > 0:
@@ -465,7 +1588,12 @@ def refinement(config, credentials, breadth, depth, blender_file, blender_script
                                 target_image, judge, config=config, 
                                 target_description=target_description, 
                                 task_setting=task_type,
-                                use_vision=evaluator_is_visual)
+                                use_vision=evaluator_is_visual,
+                                blender_file=blender_file, blender_script=blender_script,
+                                fidelity_level=0)
+                # the winner is always carried forward at full quality
+                top_candidate = promote_candidates([top_candidate], len(get_fidelity_ladder(config)) - 1, config,
+                                blender_file=blender_file, blender_script=blender_script)[0]
                 process_json.append(
                     {
                         "phase": "selection",
@@ -486,10 +1614,12 @@ def refinement(config, credentials, breadth, depth, blender_file, blender_script
             #  Craft a question based on the image and text input
             question_to_agent = craft_leap_question(
                 blender_init_code_str = get_code_as_string(code_path),
-                init_image = Image.open(render_path),
+                init_image = open_render(render_path),
                 target_image=target_image,
                 target_description=target_description,
                 use_vision=thinker_is_visual) 
+            if use_diff_prompts(config):
+                question_to_agent = to_diff_question(question_to_agent, get_code_as_string(init_code), get_code_as_string(code_path))
 
             results = tree_branch(breadth, question_to_agent, 
                                         agent=agent,
@@ -498,10 +1628,19 @@ def refinement(config, credentials, breadth, depth, blender_file, blender_script
                                         thoughtprocess_save=process_json,
                                         blender_file=blender_file, 
                                         blender_script=blender_script,
-                                        iteration=i, config=config)
+                                        iteration=i, config=config,
+                                        validator=validator,
+                                        parent_code_path=code_path)
             logger.info(f"Runnable modifications generated for iteration {i}/{depth} of depth")
 
+            render_timeouts = sum([res[3]["render_timeouts"] for res in results])
+            validation_failures = sum([res[3]["validation_failures"] for res in results])
+            code_duplicates = sum([res[3]["code_duplicates"] for res in results])
+            failures = [kind for res in results for kind in res[3]["failures"]]
             results = [el for el in results if el[0] is not None]
+            # near-duplicates of the parent or of each other don't go to the bracket
+            kept_results, duplicates = dedup_candidates(
+                results, get_dedup_reference(config, code_path, render_path, blender_file, blender_script), config)
             process_json.append(
                 {
                     "phase": "explode_options_LEAP",
@@ -509,16 +1648,29 @@ def refinement(config, credentials, breadth, depth, blender_file, blender_script
                     "inbound_question": str(question_to_agent),
                     "choices_image": [res[1] for res in results],
                     "choices_code": [res[0] for res in results],
-                    "thought_strings": [res[2] for res in results]
+                    "thought_strings": [res[2] for res in results],
+                    "render_timeouts": render_timeouts,
+                    "validation_failures": validation_failures,
+                    "code_duplicates": code_duplicates,
+                    "failures": failures,
+                    "render_seeds": [get_render_seed(config, res[0]) for res in results],
+                    "render_samples": [(read_render_stats(res[1]) or {}).get("samples") for res in results],
+                    "duplicates": duplicates
                 }   
             )
+            results = kept_results
 
             if len(results) > 0:
                 top_candidate, intermediates = get_top_candidate(results, 
                                 target_image, judge, config=config, 
                                 target_description=target_description,
                                 task_setting=task_type,
-                                use_vision=evaluator_is_visual)
+                                use_vision=evaluator_is_visual,
+                                blender_file=blender_file, blender_script=blender_script,
+                                fidelity_level=0)
+                # the winner is always carried forward at full quality
+                top_candidate = promote_candidates([top_candidate], len(get_fidelity_ladder(config)) - 1, config,
+                                blender_file=blender_file, blender_script=blender_script)[0]
                 process_json.append(
                     {
                         "phase": "selection",
@@ -571,8 +1723,9 @@ def refinement(config, credentials, breadth, depth, blender_file, blender_script
                                 "iteration": i})
 
 
-    fig = plot_image_grid([(Image.open(el["render_path"]) if el is not None else None) 
+    fig = plot_image_grid([(open_render(el["render_path"]) if el is not None else None) 
                 for el in intermediary_outputs], 
                 rows=1, cols=len(intermediary_outputs))
     fig.savefig(str(output_folder/"best_of.png"))
+    wait_for_png() # renders handed off raw are archived by now
     
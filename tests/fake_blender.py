@@ -0,0 +1,25 @@
+"""
+Stand-in for a one-shot Blender render, for testing without Blender:
+
+    python tests/fake_blender.py --background [BLEND] --python-exit-code 1 --python [BASE_SCRIPT] -- [SCRIPT] [RENDER] [SETTINGS]
+
+The "render" is the base script's name, the blend and the candidate script, so tests can
+tell what reached Blender. A candidate script containing "fail" fails with a Python traceback.
+"""
+
+import sys
+from pathlib import Path
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    blend_path = args[args.index("--background") + 1]
+    base_script = args[args.index("--python") + 1]
+    script_path, render_path = args[args.index("--") + 1:][:2]
+
+    script = Path(script_path).read_bytes()
+    if b"fail" in script:
+        print("Traceback (most recent call last):\n  File \"candidate.py\", line 1\nKeyError: 'Material'")
+        sys.exit(1)
+    Path(render_path).write_bytes(Path(base_script).name.encode("utf-8") + b"\n"
+                                  + Path(blend_path).read_bytes() + b"\n" + script)
@@ -0,0 +1,48 @@
+"""
+Stand-in for `blender --background ... --python blender_base/worker.py`, speaking the same
+JSON-line protocol, for testing BlenderWorkerPool without Blender:
+
+    python tests/fake_blender_worker.py [--rss-mb MB]
+
+The job's script path says what to do: "ok" renders (an empty file), "error" fails with a
+Python traceback, "die" exits without answering, "sleep:[SECONDS]" renders after a while.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+
+RESPONSE_PREFIX = "@@BLENDERALCHEMY_WORKER@@ "
+
+
+def respond(payload:dict):
+    sys.stdout.write(RESPONSE_PREFIX + json.dumps(payload) + "\n")
+    sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rss-mb", type=float, default=100)
+    args = parser.parse_args()
+
+    respond({"status": "ready", "pid": os.getpid()})
+    for line in sys.stdin:
+        if len(line.strip()) == 0:
+            continue
+        job = json.loads(line)
+        if job.get("command") == "shutdown":
+            break
+
+        action = os.path.basename(job["script"])
+        if action == "die":
+            os._exit(1)
+        if action.startswith("sleep:"):
+            time.sleep(float(action.split(":")[1]))
+        if action == "error":
+            respond({"id": job["id"], "status": "error", "rss_mb": args.rss_mb,
+                     "error": "Traceback (most recent call last):\n  File \"die.py\", line 1\nKeyError: 'Material'\n"})
+            continue
+        open(job["render"], "w").close()
+        respond({"id": job["id"], "status": "ok", "render": job["render"], "rss_mb": args.rss_mb})
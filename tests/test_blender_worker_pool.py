@@ -0,0 +1,93 @@
+import sys
+import threading
+from pathlib import Path
+
+import pytest
+
+from utils.blender import BlenderWorkerPool, BlenderExecutionException, RenderTimeoutException
+
+
+FAKE_WORKER = [sys.executable, str(Path(__file__).resolve().parent/"fake_blender_worker.py")]
+JOIN_TIMEOUT = 30
+
+
+@pytest.fixture
+def make_pool():
+    pools = []
+    def make(num_workers, **kwargs):
+        pool = BlenderWorkerPool(FAKE_WORKER, num_workers, **kwargs)
+        pools.append(pool)
+        return pool
+    yield make
+    for pool in pools:
+        pool.close()
+
+
+def render_concurrently(pool, tmp_path, scripts, **kwargs):
+    """
+    Returns:
+        the exception (or None) of each render, in order. Fails if any render hangs.
+    """
+    results = [None] * len(scripts)
+    def render(idx, script):
+        try:
+            pool.render(script, str(tmp_path/f"render_{idx}.png"), **kwargs)
+        except Exception as e:
+            results[idx] = e
+    threads = [threading.Thread(target=render, args=(idx, script), daemon=True) for idx, script in enumerate(scripts)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=JOIN_TIMEOUT)
+        assert not thread.is_alive(), "a render is stuck waiting for a worker"
+    return results
+
+
+def test_acquire_and_release(make_pool, tmp_path):
+    pool = make_pool(2)
+    pool.render("ok", str(tmp_path/"first.png"))
+    pool.render("ok", str(tmp_path/"second.png"))
+    assert (tmp_path/"first.png").exists() and (tmp_path/"second.png").exists()
+    assert pool.num_spawned == 1 and len(pool.idle) == 1 # the idle worker was reused
+
+    assert render_concurrently(pool, tmp_path, ["ok"] * 6) == [None] * 6
+    assert pool.num_spawned <= 2
+
+
+def test_script_error(make_pool, tmp_path):
+    pool = make_pool(1)
+    with pytest.raises(BlenderExecutionException) as e:
+        pool.render("error", str(tmp_path/"render.png"))
+    assert e.value.kind == "scene_state"
+    assert len(pool.idle) == 1 # the worker survives a failing script
+
+
+def test_worker_dies_while_others_wait(make_pool, tmp_path):
+    pool = make_pool(1)
+    results = render_concurrently(pool, tmp_path, ["die"] + ["sleep:0.2"] * 3)
+    assert sum([isinstance(result, BlenderExecutionException) and result.kind == "crash" for result in results]) == 1
+    assert sum([result is None for result in results]) == 3
+    assert pool.num_spawned == 1
+
+
+def test_recycling_without_spare(make_pool, tmp_path):
+    pool = make_pool(1, max_jobs=1, num_spares=0)
+    assert render_concurrently(pool, tmp_path, ["sleep:0.1"] * 4) == [None] * 4
+    # every worker retired after its job, freeing its slot for the next caller
+    assert pool.num_spawned == 0 and len(pool.idle) == 0
+
+
+def test_recycling_by_memory(make_pool, tmp_path):
+    pool = make_pool(1, max_rss_mb=50, num_spares=1)
+    assert render_concurrently(pool, tmp_path, ["ok"] * 3) == [None] * 3
+    assert render_concurrently(pool, tmp_path, ["ok"] * 3) == [None] * 3
+    assert pool.num_spawned <= 1
+    assert len(pool.idle) <= 1 and all([worker.jobs_done == 0 for worker in pool.idle]) # only spares left
+
+
+def test_timeout_kill(make_pool, tmp_path):
+    pool = make_pool(1)
+    results = render_concurrently(pool, tmp_path, ["sleep:60", "ok", "ok"], timeout=2)
+    assert sum([isinstance(result, RenderTimeoutException) for result in results]) == 1
+    assert sum([result is None for result in results]) == 2
+    assert pool.num_spawned == 1
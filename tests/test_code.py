@@ -0,0 +1,213 @@
+import ast
+from pathlib import Path
+
+import pytest
+from tasksolver.exceptions import ToolCallException
+
+from utils.code import get_assignment_delta, get_code_fingerprint, get_residual_code, get_unified_diff, is_unified_diff, apply_unified_diff
+
+
+LIGHTS = '''import bpy
+
+bpy.data.worlds["World"].node_tree.nodes["Background"].inputs[1].default_value = 0.9
+light_data = bpy.data.lights.new("light", type="AREA")
+light = bpy.data.objects.new("Area", light_data)
+light.location = (0.7, -0.3, 0.3)
+light.data.energy = 12.0
+light.data.color = (1, 1, 1)
+bpy.context.collection.objects.link(light)
+'''
+
+
+def edit(code_str, before, after):
+    assert code_str.count(before) == 1
+    return code_str.replace(before, after)
+
+
+def test_delta_of_property_writes():
+    child = edit(edit(LIGHTS, "energy = 12.0", "energy = 8.0"), "(1, 1, 1)", "(1.0, 0.8, 0.6)")
+    assert get_assignment_delta(LIGHTS, child) == (["light.data.energy = 8.0", "light.data.color = (1.0, 0.8, 0.6)"],
+                                                   ["light.data.energy = 12.0", "light.data.color = (1, 1, 1)"])
+    # other chains from the same root don't read the world's strength
+    child = edit(LIGHTS, "default_value = 0.9", "default_value = 0.5")
+    assert get_assignment_delta(LIGHTS, child) is not None
+    assert get_assignment_delta(LIGHTS, LIGHTS) == ([], [])
+
+
+def test_delta_of_every_write_of_an_example():
+    # every light is linked after it's set up, which doesn't read what was written to it
+    code_str = (Path(__file__).resolve().parent.parent/"blender_scripts"/"lighting_examples"/"lotion.py").read_text()
+    tree = ast.parse(code_str)
+    writes = [idx for idx, stmt in enumerate(tree.body)
+              if isinstance(stmt, ast.Assign) and isinstance(stmt.targets[0], (ast.Attribute, ast.Subscript))
+              and isinstance(stmt.value, (ast.Constant, ast.Tuple))]
+    assert len(writes) > 30
+    for idx in writes:
+        child_tree = ast.parse(code_str)
+        child_tree.body[idx].value = ast.Constant(value=0.5)
+        delta = get_assignment_delta(code_str, ast.unparse(child_tree))
+        assert delta is not None and len(delta[0]) == 1, ast.unparse(tree.body[idx])
+
+
+def test_no_delta_for_other_edits():
+    assert get_assignment_delta(LIGHTS, edit(LIGHTS, "energy = 12.0", "energy = 6.0 * 2")) is None
+    assert get_assignment_delta(LIGHTS, edit(LIGHTS, '"AREA"', '"POINT"')) is None
+    assert get_assignment_delta(LIGHTS, LIGHTS + "light.data.shape = 'SQUARE'\n") is None
+    assert get_assignment_delta(LIGHTS, LIGHTS + "light.data.energy = 4.0\n") is None # and a later write wins
+
+
+@pytest.mark.parametrize("later_read", [
+    "total = light.data.energy + 1.0",  # the chain itself
+    "print(light.data.energy.real)",  # something under it
+    "copy = light.data",  # the object it's written on
+    "light.data.update()",  # a method of that object
+    "other = bpy.data.lights['light']\nprint(other.energy)",  # the same attribute, some other way
+    "bpy.ops.object.select_all(action='SELECT')",  # the whole scene
+])
+def test_no_delta_when_the_write_is_read_later(later_read):
+    parent = LIGHTS + later_read + "\n"
+    assert get_assignment_delta(parent, edit(parent, "energy = 12.0", "energy = 8.0")) is None
+
+
+PARENT = '''import bpy
+import math
+
+def move(name, x, y):
+    obj = bpy.data.objects[name]
+    obj.location.x = x
+    obj.location.y = y
+
+sofa = bpy.data.objects["Sofa"]
+move("Sofa", 1.0, 2.0)
+sofa.rotation_euler.z = math.pi / 2
+'''
+
+
+def statements(code_str):
+    return [ast.dump(stmt) for stmt in ast.parse(code_str).body]
+
+
+def test_residual_keeps_definitions_and_new_actions():
+    child = PARENT + 'move("Lamp", 0.5, 0.5)\n'
+    residual = get_residual_code(PARENT, child)
+    assert statements(residual) == statements('''import bpy
+import math
+
+def move(name, x, y):
+    obj = bpy.data.objects[name]
+    obj.location.x = x
+    obj.location.y = y
+
+sofa = bpy.data.objects["Sofa"]
+move("Lamp", 0.5, 0.5)
+''')
+
+
+def test_residual_drops_property_writes_the_parent_ran():
+    # a property write is an action: it isn't re-run on the snapshot, nor moved around
+    child = PARENT + 'sofa.location.z = 0.0\n'
+    residual = get_residual_code(PARENT, child)
+    assert "rotation_euler" not in residual
+    assert statements(residual)[-1] == statements('sofa.location.z = 0.0\n')[0]
+
+
+def test_residual_keeps_the_order_of_new_actions():
+    child = PARENT + 'sofa.location.z = 0.0\nmove("Sofa", 3.0, 4.0)\n'
+    residual = get_residual_code(PARENT, child)
+    assert statements(residual)[-2:] == statements('sofa.location.z = 0.0\nmove("Sofa", 3.0, 4.0)\n')
+
+
+def test_no_residual_when_an_earlier_action_changed():
+    child = PARENT.replace("math.pi / 2", "math.pi") + 'move("Lamp", 0.5, 0.5)\n'
+    assert get_residual_code(PARENT, child) is None
+    # property writes count as actions, so changing one is caught too
+    parent = PARENT + 'sofa.location.z = 1.0\n'
+    assert get_residual_code(parent, PARENT + 'sofa.location.z = 2.0\nmove("Lamp", 0.5, 0.5)\n') is None
+
+
+def test_no_residual_when_a_definition_changed():
+    child = PARENT.replace("obj.location.y = y", "obj.location.y = -y") + 'move("Lamp", 0.5, 0.5)\n'
+    assert get_residual_code(PARENT, child) is None
+
+
+def test_no_residual_when_new_actions_need_a_dropped_name():
+    parent = PARENT + 'lamp = bpy.data.objects.get("Lamp")\n'
+    child = parent + 'lamp.location.x = 1.0\n'
+    assert get_residual_code(parent, child) is None
+
+
+def test_no_residual_when_a_dropped_action_rebinds_a_definition():
+    parent = 'import bpy\nscale = 1.0\nscale *= 2\nbpy.data.objects["Sofa"].scale.x = scale\n'
+    child = parent + 'bpy.data.objects["Lamp"].scale.x = scale\n'
+    assert get_residual_code(parent, child) is None
+
+
+def test_no_residual_for_invalid_code():
+    assert get_residual_code(PARENT, PARENT + "move(\n") is None
+
+
+SCRIPT = """import bpy
+
+def setup():
+    light = bpy.data.lights["Key"]
+    light.energy = 5.0
+    light.color = (1.0, 1.0, 1.0)
+
+setup()
+"""
+
+
+def test_diff_round_trip():
+    edited = SCRIPT.replace("energy = 5.0", "energy = 8.0").replace("setup()\n", "setup()\nbpy.ops.render.render()\n")
+    diff = get_unified_diff(SCRIPT, edited)
+    assert is_unified_diff(diff)
+    assert apply_unified_diff(SCRIPT, diff) == edited
+    assert get_unified_diff(SCRIPT, SCRIPT) == ""
+    assert not is_unified_diff(SCRIPT)
+
+
+def test_diff_hunks_are_found_by_content():
+    # wrong line numbers, no file headers: hunks are located by their lines
+    diff = "@@ -40,3 +40,3 @@\n     light = bpy.data.lights[\"Key\"]\n-    light.energy = 5.0\n+    light.energy = 8.0\n"
+    assert apply_unified_diff(SCRIPT, diff) == SCRIPT.replace("energy = 5.0", "energy = 8.0")
+
+
+def test_diff_falls_back_to_ignoring_whitespace():
+    # the LLM lost the indentation of the context and removed lines
+    diff = "@@ -1 +1 @@\n light = bpy.data.lights[\"Key\"]\n-light.energy = 5.0\n+    light.energy = 8.0\n"
+    assert apply_unified_diff(SCRIPT, diff) == SCRIPT.replace("energy = 5.0", "energy = 8.0")
+
+
+def test_diff_that_doesnt_apply():
+    diff = "@@ -1 +1 @@\n-light.energy = 7.0\n+light.energy = 8.0\n"
+    with pytest.raises(ToolCallException):
+        apply_unified_diff(SCRIPT, diff)
+
+
+def test_fingerprint_ignores_how_code_is_written():
+    code_str = 'def f():\n    """Docstring."""\n    return 1\n\nx = f() # comment\n'
+    assert get_code_fingerprint(code_str) == get_code_fingerprint("def f():\n  return 1\nx=f()\n")
+    assert get_code_fingerprint(code_str) != get_code_fingerprint("def f():\n  return 2\nx=f()\n")
+    # code that doesn't parse is still fingerprinted, by its text
+    assert get_code_fingerprint("x = (\n") == get_code_fingerprint("\nx = (\n\n")
+    assert get_code_fingerprint("x = (\n") != get_code_fingerprint("y = (\n")
+
+
+def test_fingerprint_tolerance_snaps_floats():
+    assert get_code_fingerprint("a = 0.5", 1e-3) == get_code_fingerprint("a = 0.5000001", 1e-3)
+    assert get_code_fingerprint("a = 0.5", 1e-3) != get_code_fingerprint("a = 0.51", 1e-3)
+    assert get_code_fingerprint("a = 0.5") != get_code_fingerprint("a = 0.5000001")
+
+
+def test_fingerprint_tolerance_leaves_ints_exact():
+    assert get_code_fingerprint("a = nodes[1]", 10.0) != get_code_fingerprint("a = nodes[2]", 10.0)
+    assert get_code_fingerprint("a = 1", 10.0) != get_code_fingerprint("a = 1.0", 10.0)
+    assert get_code_fingerprint("a = True", 10.0) != get_code_fingerprint("a = 1", 10.0)
+
+
+@pytest.mark.parametrize("value", ["1e999", "-1e999", "1e308"])
+def test_fingerprint_of_floats_off_the_grid(value):
+    # inf, and floats that overflow the grid, are compared exactly instead of raising
+    fingerprint = get_code_fingerprint(f"a = {value}", 1e-3)
+    assert fingerprint == get_code_fingerprint(f"a = {value}", 1e-3)
+    assert fingerprint != get_code_fingerprint("a = 0.0", 1e-3)
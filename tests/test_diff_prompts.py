@@ -0,0 +1,56 @@
+import importlib
+
+import pytest
+from tasksolver.common import Question
+
+from prompting.diff_prompts import (to_diff_question, CURRENT_SCRIPT_PLACEHOLDER, DIFF_ANSWER_FORMAT,
+                                    COPY_INSTRUCTION, DIFF_COPY_INSTRUCTION, LEAP_INSTRUCTION, DIFF_LEAP_INSTRUCTION)
+
+
+PROMPTING_MODULES = ["prompting.geonodes", "prompting.lighting", "prompting.material",
+                     "prompting.placement", "prompting.shapekey"]
+ORIGINAL_CODE = 'import bpy\nlight = bpy.data.lights["Key"]\nlight.energy = 5.0\n'
+CURRENT_CODE = 'import bpy\nlight = bpy.data.lights["Key"]\nlight.energy = 8.0\n'
+
+
+def craft_question(module_name, kind):
+    craft = getattr(importlib.import_module(module_name), f"craft_{kind}_question")
+    return craft(blender_init_code_str=CURRENT_CODE, init_image=None, target_image=None,
+                 target_description="a warmer scene", use_vision=False)
+
+
+@pytest.mark.parametrize("module_name", PROMPTING_MODULES)
+@pytest.mark.parametrize("kind, instruction, diff_instruction", [
+    ("tuner", COPY_INSTRUCTION, DIFF_COPY_INSTRUCTION),
+    ("leap", LEAP_INSTRUCTION, DIFF_LEAP_INSTRUCTION),
+])
+def test_tuner_and_leap_questions_switch_to_diffs(module_name, kind, instruction, diff_instruction):
+    question = craft_question(module_name, kind)
+    assert instruction in str(question)
+
+    diff_question = to_diff_question(question, ORIGINAL_CODE, CURRENT_CODE)
+    text = str(diff_question)
+    assert diff_question is not question
+    assert text.startswith("The original Blender script")
+    assert ORIGINAL_CODE in text
+    assert "-light.energy = 5.0\n+light.energy = 8.0" in text
+    assert CURRENT_CODE not in text and CURRENT_SCRIPT_PLACEHOLDER in text
+    assert instruction not in text and diff_instruction in text
+    assert "TYPE OUT EVERYTHING" not in text
+    assert text.rstrip().endswith(DIFF_ANSWER_FORMAT.strip())
+
+
+def test_unchanged_lineage():
+    diff_question = to_diff_question(craft_question("prompting.lighting", "leap"), CURRENT_CODE, CURRENT_CODE)
+    assert "No changes have been made to it so far" in str(diff_question)
+
+
+def test_questions_not_as_expected_are_sent_as_they_are():
+    # no instruction to copy or edit the script
+    question = Question([f"What does this do?\n```python\n{CURRENT_CODE}\n```"])
+    assert to_diff_question(question, ORIGINAL_CODE, CURRENT_CODE) is question
+    # the current script isn't shown in full
+    question = craft_question("prompting.lighting", "leap")
+    assert to_diff_question(question, ORIGINAL_CODE, CURRENT_CODE + "light.color = (1, 0, 0)\n") is question
+    # not a Question at all
+    assert to_diff_question("a string", ORIGINAL_CODE, CURRENT_CODE) == "a string"
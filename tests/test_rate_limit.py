@@ -0,0 +1,80 @@
+import random
+
+import pytest
+
+from utils.rate_limit import TokenBucket, RateLimiter, parse_duration, get_provider, get_rate_limiter
+
+
+class RateLimitError(Exception):
+    def __init__(self, headers=None):
+        super().__init__("Error code: 429 - rate limit exceeded")
+        self.status_code = 429
+        self.response = type("Response", (), {"headers": headers or {}, "status_code": 429})()
+
+
+def test_bucket_arithmetic():
+    bucket = TokenBucket(60) # one per second
+    assert bucket.reserve(60, now=bucket.updated) == 0.0 # a minute's worth is there from the start
+    assert bucket.reserve(1, now=bucket.updated) == pytest.approx(1.0)
+    assert bucket.reserve(1, now=bucket.updated) == pytest.approx(2.0) # the overdraft adds up
+    assert bucket.reserve(0, now=bucket.updated + 10) == 0.0 # paid back after waiting
+    assert bucket.reserve(1000, now=bucket.updated + 1000) == pytest.approx(940) # refills to a minute's worth at most
+
+
+def test_unlimited_bucket():
+    bucket = TokenBucket(None)
+    assert bucket.reserve(10 ** 9, now=bucket.updated) == 0.0
+    bucket.set_rate(60)
+    assert bucket.reserve(60, now=bucket.updated) == 0.0
+    assert bucket.reserve(1, now=bucket.updated) == pytest.approx(1.0)
+
+
+@pytest.mark.parametrize("value, seconds", [("1.5s", 1.5), ("6m0s", 360), ("20ms", 0.02), ("1h2m", 3720),
+                                            ("3", 3.0), (None, None), ("soon", None)])
+def test_parse_duration(value, seconds):
+    assert parse_duration(value) == (None if seconds is None else pytest.approx(seconds))
+
+
+def test_headers_configure_unset_buckets():
+    limiter = RateLimiter("openai", requests_per_minute=500)
+    limiter.on_error(RateLimitError({"x-ratelimit-limit-tokens": "30000"}))
+    assert limiter.tokens.rate_per_minute == 30000
+    limiter.blocked_until = 0.0
+    assert limiter.reserve(1000) == 0.0
+
+
+def test_headers_block_until_reset():
+    limiter = RateLimiter("openai", requests_per_minute=500)
+    limiter.update_from_headers({"x-ratelimit-remaining-requests": "0", "x-ratelimit-reset-requests": "20s"})
+    assert 19 < limiter.reserve() <= 20 + limiter.base_backoff
+
+
+def test_backoff_is_exponential_with_jitter():
+    random.seed(0)
+    limiter = RateLimiter("openai", base_backoff=2, max_backoff=10)
+    delays = [limiter.on_error(RateLimitError()) for _ in range(5)]
+    for num_failures, delay in enumerate(delays, start=1):
+        backoff = min(10, 2 * 2 ** (num_failures - 1))
+        assert backoff / 2 <= delay <= backoff
+    limiter.on_success()
+    assert limiter.num_failures == 0
+
+
+def test_backoff_honors_retry_after():
+    limiter = RateLimiter("openai", base_backoff=1, max_backoff=60)
+    assert limiter.on_error(RateLimitError({"retry-after": "30"})) >= 15
+
+
+def test_other_errors_dont_count():
+    limiter = RateLimiter("openai", base_backoff=2)
+    assert 0 <= limiter.on_error(ValueError("bad request")) <= 2
+    assert limiter.num_failures == 0
+
+
+def test_provider():
+    assert get_provider("claude") == "claude"
+    assert get_provider("claude-3-opus") == "claude"
+    assert get_provider("gpt-4") == "openai"
+    assert get_rate_limiter({"run_config": {}}) is None
+    limiter = get_rate_limiter({"run_config": {"rate_limits": {"claude": {"requests_per_minute": 50}}}}, "claude")
+    assert limiter.requests.rate_per_minute == 50
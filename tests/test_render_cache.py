@@ -0,0 +1,61 @@
+import os
+
+from utils.render_cache import RenderCache, get_render_key
+
+
+CODE = 'import bpy\nlight = bpy.data.lights["Key"]\nlight.energy = 5.0\n'
+
+
+def write(path, content):
+    path.write_bytes(content)
+    return str(path)
+
+
+def test_key_ignores_how_code_is_written(tmp_path):
+    blend, script = write(tmp_path/"scene.blend", b"blend"), write(tmp_path/"render.py", b"script")
+    key = get_render_key(blend, script, CODE)
+    reformatted = '# key light\nimport bpy\n\nlight = bpy.data.lights[ "Key" ]\nlight.energy = 5.0  # too dark?\n'
+    assert get_render_key(blend, script, reformatted) == key
+    assert get_render_key(blend, script, CODE.replace("5.0", "8.0")) != key
+
+
+def test_key_tracks_what_is_rendered(tmp_path):
+    blend, script = write(tmp_path/"scene.blend", b"blend"), write(tmp_path/"render.py", b"script")
+    key = get_render_key(blend, script, CODE, {"samples": 32, "threads": 4})
+    # the number of threads doesn't change the image
+    assert get_render_key(blend, script, CODE, {"samples": 32, "threads": 8}) == key
+    assert get_render_key(blend, script, CODE, {"samples": 64, "threads": 4}) != key
+    assert get_render_key(blend, script, CODE) != key
+
+    # the starter blend and the blender_base script count by their content
+    other_blend = write(tmp_path/"other.blend", b"blend")
+    assert get_render_key(other_blend, script, CODE, {"samples": 32}) == key
+    write(tmp_path/"other.blend", b"another blend")
+    assert get_render_key(other_blend, script, CODE, {"samples": 32}) != key
+    other_script = write(tmp_path/"other.py", b"another script")
+    assert get_render_key(blend, other_script, CODE, {"samples": 32}) != key
+
+
+def test_store_and_fetch(tmp_path):
+    cache = RenderCache(str(tmp_path/"cache"))
+    render = write(tmp_path/"render.png", b"pixels")
+    fetched = str(tmp_path/"fetched.png")
+    assert not cache.fetch("abc", fetched)
+    assert not os.path.exists(fetched)
+
+    cache.store("abc", render)
+    # a cache shared by another run sees the entry too
+    assert RenderCache(str(tmp_path/"cache")).fetch("abc", fetched)
+    assert open(fetched, "rb").read() == b"pixels"
+    assert list((tmp_path/"cache").glob("*.tmp")) == []
+
+
+def test_least_recently_used_renders_are_evicted(tmp_path):
+    cache = RenderCache(str(tmp_path/"cache"), max_size_mb=2.5 / (1 << 20)) # 2.5 bytes: room for two renders
+    for idx, key in enumerate(["a", "b"]):
+        cache.store(key, write(tmp_path/f"{key}.png", b"x"))
+        os.utime(tmp_path/"cache"/f"{key}.png", (idx, idx))
+    # fetching "a" makes "b" the least recently used
+    assert cache.fetch("a", str(tmp_path/"fetched.png"))
+    cache.store("c", write(tmp_path/"c.png", b"x"))
+    assert sorted(entry.stem for entry in (tmp_path/"cache").glob("*.png")) == ["a", "c"]
@@ -0,0 +1,111 @@
+import os
+import sys
+import subprocess
+from pathlib import Path
+
+import pytest
+from tasksolver.exceptions import CodeExecutionException
+
+from utils.blender import BlenderExecutionException
+from utils.render_farm import (Broker, FarmRequestException, start_broker, request, submit_render,
+                               check_blend_hash, get_blender_script_path)
+
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+FAKE_BLENDER = f"{sys.executable} {Path(__file__).resolve().parent/'fake_blender.py'}"
+RENDER_TIMEOUT = 30
+
+
+@pytest.fixture
+def make_farm(tmp_path):
+    """ A real broker on localhost, and one worker process rendering with tests/fake_blender.py. """
+    started = []
+    def make(token=None):
+        broker = start_broker(work_dir=str(tmp_path/"broker"), token=token)
+        address = "%s:%d" % broker.server_address
+        command = [sys.executable, "-m", "utils.render_farm", "worker", "--broker", address,
+                   "--blender_command", FAKE_BLENDER, "--work_dir", str(tmp_path/"worker")]
+        if token is not None:
+            command += ["--token", token]
+        worker = subprocess.Popen(command, cwd=str(REPO_DIR), env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path)))
+        started.append((broker, worker))
+        return address
+    yield make
+    for broker, worker in started:
+        worker.kill()
+        worker.wait()
+        broker.shutdown()
+        broker.server_close()
+
+
+@pytest.fixture
+def scene(tmp_path):
+    blend_path = tmp_path/"starter.blend"
+    blend_path.write_bytes(b"BLEND")
+    script_path = tmp_path/"candidate.py"
+    script_path.write_text("bpy.data.objects['Sofa'].location.x = 1.0\n")
+    return str(blend_path), str(script_path)
+
+
+def submit(address, blend_path, script_path, render_path, **kwargs):
+    submit_render(address, blend_path, str(REPO_DIR/"blender_base"/"geonodes.py"), script_path, str(render_path),
+                  timeout=RENDER_TIMEOUT, queue_timeout=RENDER_TIMEOUT, **kwargs)
+
+
+def test_farm_renders(make_farm, scene, tmp_path):
+    address = make_farm()
+    blend_path, script_path = scene
+    submit(address, blend_path, script_path, tmp_path/"render.png")
+    assert (tmp_path/"render.png").read_bytes() == b"geonodes.py\nBLEND\n" + Path(script_path).read_bytes()
+    # the worker's scratch space is cleaned up once the render is sent back
+    assert list((tmp_path/"worker"/"jobs").iterdir()) == []
+
+
+def test_farm_script_failure(make_farm, scene, tmp_path):
+    address = make_farm()
+    blend_path, script_path = scene
+    Path(script_path).write_text("fail()\n")
+    with pytest.raises(BlenderExecutionException):
+        submit(address, blend_path, script_path, tmp_path/"render.png")
+    assert not (tmp_path/"render.png").exists()
+
+
+def test_broker_refuses_paths_outside_its_dirs(make_farm):
+    address = make_farm()
+    header, _ = request(address, {"type": "get_blend", "blend_hash": "../../../etc/passwd"})
+    assert header["status"] == "error"
+    header, _ = request(address, {"type": "put_blend", "blend_hash": "../evil"}, b"x")
+    assert header["status"] == "error"
+    for blender_script in ("../utils/render_farm.py", "/etc/passwd", "../blender_base/../README.md"):
+        header, _ = request(address, {"type": "submit", "blend_hash": "ab12", "blender_script": blender_script,
+                                      "queue_timeout": 1}, b"")
+        assert header["status"] == "error"
+
+
+def test_path_checks():
+    assert check_blend_hash("0123abcdef") == "0123abcdef"
+    for blend_hash in ("", "ABCD", "ab/cd", "../ab", None):
+        with pytest.raises(FarmRequestException):
+            check_blend_hash(blend_hash)
+    assert get_blender_script_path("geonodes.py") == (REPO_DIR/"blender_base"/"geonodes.py").resolve()
+    for blender_script in ("../utils/render_farm.py", "/etc/passwd", "missing.py", "__pycache__"):
+        with pytest.raises(FarmRequestException):
+            get_blender_script_path(blender_script)
+
+
+def test_token(make_farm, scene, tmp_path):
+    address = make_farm(token="secret")
+    blend_path, script_path = scene
+    header, _ = request(address, {"type": "has_blend", "blend_hash": "ab12"})
+    assert header == {"status": "error", "error": "unauthorized", "payload_size": 0}
+    with pytest.raises(CodeExecutionException):
+        submit(address, blend_path, script_path, tmp_path/"render.png", token="wrong")
+    submit(address, blend_path, script_path, tmp_path/"render.png", token="secret")
+    assert (tmp_path/"render.png").is_file()
+
+
+def test_non_local_broker_needs_a_token(tmp_path):
+    with pytest.raises(ValueError):
+        Broker(("0.0.0.0", 0), str(tmp_path))
+    broker = Broker(("127.0.0.1", 0), str(tmp_path))
+    broker.server_close()
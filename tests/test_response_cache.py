@@ -0,0 +1,91 @@
+import pytest
+from tasksolver.common import Question
+
+from utils.question import get_question_parts, UnrecognizedQuestionException
+from utils.response_cache import ResponseCache, hash_question
+
+
+class FakeImage(object):
+    """ Looks like a PIL image to utils.question.is_image. """
+    def __init__(self, pixels:bytes, size=(2, 2), mode="RGB"):
+        self.pixels, self.size, self.mode = pixels, size, mode
+
+    def tobytes(self):
+        return self.pixels
+
+
+def make_question(text="Which render is closer to the target?", pixels=b"\x00" * 12):
+    return Question([text, FakeImage(pixels), "Answer left or right."])
+
+
+class Asker(object):
+    def __init__(self):
+        self.num_requests = 0
+
+    def __call__(self):
+        self.num_requests += 1
+        return f"answer {self.num_requests}"
+
+
+def test_question_parts():
+    question = make_question()
+    parts = get_question_parts(Question([question, "And why?"]))
+    assert [part for part in parts if isinstance(part, str)] == [question.elements[0], question.elements[2], "And why?"]
+    assert parts[1] is question.elements[1]
+
+
+def test_unrecognized_questions():
+    with pytest.raises(UnrecognizedQuestionException):
+        get_question_parts("not a Question")
+    question = make_question()
+    question.elements = None # kept some other way
+    with pytest.raises(UnrecognizedQuestionException):
+        get_question_parts(question)
+    with pytest.raises(UnrecognizedQuestionException):
+        get_question_parts(Question(["text", 42]))
+
+
+def test_cache_key(tmp_path):
+    cache = ResponseCache(str(tmp_path))
+    assert hash_question(make_question()) == hash_question(make_question())
+    assert hash_question(make_question()) != hash_question(make_question(text="Which is brighter?"))
+    # images count by their pixels
+    assert hash_question(make_question()) != hash_question(make_question(pixels=b"\x01" * 12))
+
+    key = cache.make_key(make_question(), "gpt-4o/tuner", params={"max_tokens": 100}, sample=0)
+    base_key, occurrence = key.rsplit("_", 1)
+    assert occurrence == "0"
+    # asked again in the same run, it's the next sample
+    assert cache.make_key(make_question(), "gpt-4o/tuner", params={"max_tokens": 100}, sample=0) == f"{base_key}_1"
+    for other in [dict(scope="gpt-4o/leap"), dict(params={"max_tokens": 200}), dict(sample=1)]:
+        kwargs = dict(dict(scope="gpt-4o/tuner", params={"max_tokens": 100}, sample=0), **other)
+        assert not cache.make_key(make_question(), **kwargs).startswith(base_key)
+
+
+def test_answers_are_replayed_by_a_rerun(tmp_path):
+    ask = Asker()
+    cache = ResponseCache(str(tmp_path))
+    assert [cache.ask(ask, make_question(), "gpt-4o") for _ in range(2)] == ["answer 1", "answer 2"]
+
+    rerun_cache = ResponseCache(str(tmp_path))
+    assert [rerun_cache.ask(ask, make_question(), "gpt-4o") for _ in range(3)] == ["answer 1", "answer 2", "answer 3"]
+    assert ask.num_requests == 3
+
+
+def test_unrecognized_questions_are_not_cached(tmp_path):
+    ask = Asker()
+    question = make_question()
+    question.elements = None
+    cache = ResponseCache(str(tmp_path))
+    assert cache.ask(ask, question, "gpt-4o") == "answer 1"
+    assert ResponseCache(str(tmp_path)).ask(ask, question, "gpt-4o") == "answer 2"
+    assert list(tmp_path.glob("*.pkl")) == []
+
+
+def test_failed_requests_are_not_cached(tmp_path):
+    def fail():
+        raise ConnectionError("rate limited")
+    cache = ResponseCache(str(tmp_path))
+    with pytest.raises(ConnectionError):
+        cache.ask(fail, make_question(), "gpt-4o")
+    assert ResponseCache(str(tmp_path)).ask(Asker(), make_question(), "gpt-4o") == "answer 1"
@@ -0,0 +1,81 @@
+from types import SimpleNamespace
+
+import pytest
+from tasksolver.common import Question
+
+from utils.question import UnrecognizedQuestionException
+from utils.streaming import build_messages, stream_code_answer, StreamAbortedException
+
+
+class FakeStream(object):
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.num_read = 0
+        self.closed = False
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            self.num_read += 1
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=chunk))])
+
+    def close(self):
+        self.closed = True
+
+
+class FakeClient(object):
+    """ Records the requests made through client.chat.completions.create. """
+    def __init__(self, chunks):
+        self.requests = []
+        self.stream = FakeStream(chunks)
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, **kwargs):
+        self.requests.append(kwargs)
+        return self.stream
+
+
+def make_task():
+    return SimpleNamespace(name="Blender code editing", description="Change the code to match the target.",
+                           background=[Question(["Answer format:", "a python code block."])],
+                           answer_type=SimpleNamespace(parser=lambda text: SimpleNamespace(code=text, raw=None)))
+
+
+QUESTION = Question(["Here is the current script:", "```python\nx = 1\n```", "Make it brighter."])
+
+
+def test_messages():
+    assert build_messages(make_task(), QUESTION) == [
+        {"role": "system", "content": "Blender code editing\nChange the code to match the target."},
+        {"role": "user", "content": [{"type": "text", "text": "Answer format:"},
+                                     {"type": "text", "text": "a python code block."},
+                                     {"type": "text", "text": "Here is the current script:"},
+                                     {"type": "text", "text": "```python\nx = 1\n```"},
+                                     {"type": "text", "text": "Make it brighter."}]}]
+
+
+def test_unreadable_background():
+    task = make_task()
+    task.background = "not a Question"
+    with pytest.raises(UnrecognizedQuestionException):
+        build_messages(task, QUESTION)
+
+
+def test_stream_is_cut_once_the_code_block_closes():
+    client = FakeClient(["Brighter:\n```python\n", "light.energy = 8.0\n", "```\n", "Because it was too dark."])
+    p_ans = stream_code_answer(client, "gpt-4o", make_task(), QUESTION, max_tokens=500)
+    assert client.requests == [{"model": "gpt-4o", "messages": build_messages(make_task(), QUESTION),
+                                "max_tokens": 500, "stream": True}]
+    assert client.stream.num_read == 3 and client.stream.closed
+    assert p_ans.raw == "Brighter:\n```python\nlight.energy = 8.0\n```\n"
+
+
+@pytest.mark.parametrize("chunks, reason", [
+    (["```python\n", "light.energy = 8.0\n", "# ... rest of the code\n", "```"], "abbreviated"),
+    (["Let me think about this. " * 10], "no_code"),
+])
+def test_stream_is_aborted(chunks, reason):
+    client = FakeClient(chunks)
+    with pytest.raises(StreamAbortedException) as e:
+        stream_code_answer(client, "gpt-4o", make_task(), QUESTION, max_tokens=500, max_chars_without_code=100)
+    assert e.value.reason == reason
+    assert client.stream.closed
@@ -0,0 +1,56 @@
+import ast
+
+import pytest
+
+from utils.validation import ScriptValidationException, check_truncation, check_names, validate_script
+
+
+def truncation_of(code_str):
+    try:
+        check_truncation(ast.parse(code_str), code_str)
+    except ScriptValidationException as e:
+        return e.reason
+    return None
+
+
+@pytest.mark.parametrize("code_str", [
+    "import numpy as np\narr = np.zeros((4, 4, 3))\nred = arr[..., 0]\n",
+    "def f(): ...\n",
+    "def f(x: int) -> int:\n    '''Stub.'''\n    ...\n",
+    "class Placeholder:\n    ...\n",
+    "def f(default=...):\n    return default\n",
+    "label = 'Loading...'\n",
+    "x = 1 # 0.5 was too bright...\n",
+    "color = '#...'\n",
+])
+def test_valid_uses_of_ellipsis(code_str):
+    assert truncation_of(code_str) is None
+
+
+@pytest.mark.parametrize("code_str, line", [
+    ("import bpy\n...\nbpy.ops.render.render()\n", 2),
+    ("def setup():\n    light = 1\n    ...\n", 3),
+    ("for i in range(3):\n    ...\n", 2),
+    ("import bpy\n# ...\n", 2),
+    ("import bpy\nx = 1  # ... rest unchanged\n", 2),
+    ("import bpy\n# Rest of the code stays the same\n", 2),
+    ("import bpy\n'''... the remainder of the script is unchanged'''\n", 2),
+])
+def test_elided_code(code_str, line):
+    reason = truncation_of(code_str)
+    assert reason is not None and f"line {line}" in reason
+
+
+def test_validate_script():
+    init_code_str = "import bpy\nlight = bpy.data.lights['Key']\nlight.energy = 5.0\n"
+    validate_script(init_code_str.replace("5.0", "8.0"), "lighting", init_code_str)
+    with pytest.raises(ScriptValidationException):
+        validate_script(init_code_str + "...\n", "lighting", init_code_str)
+    with pytest.raises(ScriptValidationException):
+        validate_script(init_code_str + "lihgt.energy = 2.0\nprint(lihgt)\n", "lighting", init_code_str)
+
+
+def test_undefined_names():
+    check_names(ast.parse("x = 1\nprint(x, bpy)\n"), {"bpy"})
+    with pytest.raises(ScriptValidationException):
+        check_names(ast.parse("print(y)\n"), {"bpy"})
@@ -0,0 +1,95 @@
+"""
+asyncio engine for the fan-out of refinement (tree_branch slots, get_top_candidate matches).
+
+One event loop runs in a background thread and is shared by every refinement run of the
+process. Slots and matches are coroutines bounded by semaphores, instead of one OS thread
+each. The provider clients (tasksolver) and the agents on top of them are blocking, so their
+calls are handed to a single thread pool of fixed size; one-shot Blender processes are
+managed by the loop itself (see utils.blender.run_blender_async).
+
+This isn't async I/O end to end: every provider request in flight, and every agent.act
+waiting on its render, holds one of the pool's threads. What the engine saves is the thread
+per slot or match waiting for its turn; how many requests and renders actually run at once
+is bounded by the pool size (run_config.async_max_threads) as well as by the semaphores.
+"""
+
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from loguru import logger
+
+
+_loop = None
+_loop_thread = None
+_executor = None
+_lock = threading.Lock()
+_pool_warnings = set()
+
+
+def get_engine_loop(max_threads:int=32) -> asyncio.AbstractEventLoop:
+    """
+    The engine's event loop, started on first use.
+
+    Args:
+        max_threads: size of the pool running blocking calls (see call_blocking). Only the
+            first call sets it.
+    """
+    global _loop, _loop_thread, _executor
+    with _lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            _executor = ThreadPoolExecutor(max_workers=max_threads, thread_name_prefix="engine")
+            _loop.set_default_executor(_executor)
+            _loop_thread = threading.Thread(target=_loop.run_forever, name="engine-loop", daemon=True)
+            _loop_thread.start()
+            logger.info(f"Started the async engine, with {max_threads} threads for blocking calls")
+        return _loop
+
+
+def get_running_engine():
+    """
+    Returns:
+        the engine's loop if it's running and the caller is one of the engine's blocking-call
+        threads (i.e. it can hand coroutines to the loop and wait), None otherwise.
+    """
+    loop = _loop
+    if loop is None or not loop.is_running():
+        return None
+    if threading.current_thread() is _loop_thread:
+        return None # waiting on the loop from the loop would deadlock
+    if not threading.current_thread().name.startswith("engine"):
+        return None
+    return loop
+
+
+def run_in_engine(coroutine, config:dict=None):
+    """
+    Run coroutine on the engine's loop and block until it's done. Called from regular
+    (non-engine) threads, e.g. refinement().
+
+    Args:
+        config: the run config, for run_config.async_max_threads (default 32).
+    """
+    max_threads = 32 if config is None else config["run_config"].get("async_max_threads", 32)
+    if config is not None:
+        run_config = config["run_config"]
+        num_blocking = (run_config.get("max_concurrent_generator_requests", 0)
+                        + run_config.get("max_concurrent_rendering_processes", 0))
+        if num_blocking > max_threads and (num_blocking, max_threads) not in _pool_warnings:
+            _pool_warnings.add((num_blocking, max_threads))
+            logger.warning(f"Up to {num_blocking} provider requests and renders may run at once, but the async "
+                           f"engine has {max_threads} threads for blocking calls (async_max_threads): the rest wait.")
+    loop = get_engine_loop(max_threads)
+    return asyncio.run_coroutine_threadsafe(coroutine, loop).result()
+
+
+async def call_blocking(func, *args, **kwargs):
+    """ Await a blocking call (LLM request, agent.act, ...) run on the engine's thread pool. """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, partial(func, *args, **kwargs))
+
+
+def use_async_engine(config:dict) -> bool:
+    return config["run_config"].get("async_engine", False)
@@ -0,0 +1,571 @@
+"""
+Long-lived Blender worker processes, so that the starter blend, the blender_base
+script and the Cycles devices are only loaded once instead of once per candidate.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import asyncio
+import shlex
+import queue
+import atexit
+import signal
+import resource
+import itertools
+import threading
+import subprocess
+from pathlib import Path
+from typing import List
+
+from loguru import logger
+from tasksolver.exceptions import CodeExecutionException
+from utils.async_engine import get_running_engine
+
+
+WORKER_SCRIPT = str(Path(__file__).resolve().parent.parent/"blender_base"/"worker.py")
+RESPONSE_PREFIX = "@@BLENDERALCHEMY_WORKER@@ "
+CPU_DEADLINE_POLL_INTERVAL = 1.0
+
+
+class RenderTimeoutException(CodeExecutionException):
+    """
+    A render went past its wall-clock or CPU deadline and its Blender process was killed.
+    """
+    kind = "timeout"
+
+
+# Failure kinds, by the exception at the end of the traceback. The first three are
+# deterministic: the same script fails the same way however often it's rendered.
+FAILURE_KINDS = [("syntax_error", ("SyntaxError", "IndentationError", "TabError")),
+                 ("name_error", ("NameError", "UnboundLocalError", "ImportError", "ModuleNotFoundError", "AttributeError")),
+                 ("scene_state", ("KeyError", "IndexError", "RuntimeError", "ReferenceError"))]
+DETERMINISTIC_FAILURES = ("syntax_error", "name_error", "scene_state")
+EXCEPTION_LINE = re.compile(r"^(?:\w+\.)*(\w+(?:Error|Exception))\b")
+
+
+class BlenderExecutionException(CodeExecutionException):
+    """
+    A candidate script failed in Blender.
+
+    Attributes:
+        kind: "syntax_error", "name_error", "scene_state", "script_error" (any other Python
+            exception) or "crash" (Blender died without a Python traceback).
+        log: Blender's output for the job, with the traceback.
+    """
+    def __init__(self, kind:str, log:str=""):
+        super().__init__(kind)
+        self.kind = kind
+        self.log = log
+
+
+def classify_failure(log:str) -> str:
+    """
+    Returns:
+        the failure kind (see BlenderExecutionException) of a job that didn't produce a render.
+    """
+    lines = log.split("\n")
+    traceback_starts = [idx for idx, line in enumerate(lines) if "Traceback (most recent call last)" in line]
+    if len(traceback_starts) == 0:
+        return "crash"
+    exception_name = None
+    for line in lines[traceback_starts[-1]:]:
+        match = EXCEPTION_LINE.match(line.strip())
+        if match is not None:
+            exception_name = match.group(1)
+    for kind, exception_names in FAILURE_KINDS:
+        if exception_name in exception_names:
+            return kind
+    return "script_error"
+
+
+def kill_process_group(process:subprocess.Popen):
+    """ Blender processes are started in their own session, so this also takes out any children. """
+    try:
+        os.killpg(os.getpgid(process.pid), signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+    process.wait()
+
+
+def get_cpu_seconds(pid:int):
+    """
+    Returns:
+        user + system CPU time of a process, or None where /proc isn't available.
+    """
+    try:
+        with open(f"/proc/{pid}/stat", "r") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+    except (FileNotFoundError, IndexError):
+        return None
+    # utime and stime are the 14th and 15th fields, counted from the pid.
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def limit_cpu(pid:int, cpu_timeout:float):
+    """
+    Put a CPU-time limit on a running process. Applied from the outside rather than through
+    Popen's preexec_fn, which isn't safe to use from a multithreaded program.
+    """
+    cpu_seconds = int(cpu_timeout)
+    try:
+        resource.prlimit(pid, resource.RLIMIT_CPU, (cpu_seconds, cpu_seconds + 5))
+    except (ProcessLookupError, PermissionError):
+        pass # already gone
+
+
+def is_cpu_timeout(returncode:int, cpu_seconds:float, cpu_timeout:float) -> bool:
+    """
+    Whether a process was killed by the kernel for going past its CPU limit (see limit_cpu):
+    SIGXCPU at the soft limit, or SIGKILL at the hard one. A SIGKILL from anything else (e.g.
+    the OOM killer) isn't a timeout, so it also takes the CPU time to have reached the limit.
+    """
+    if cpu_timeout is None:
+        return False
+    if returncode == -signal.SIGXCPU:
+        return True
+    return returncode == -signal.SIGKILL and cpu_seconds is not None and cpu_seconds >= int(cpu_timeout)
+
+
+def wait_with_rusage(process:subprocess.Popen, timeout:float=None):
+    """
+    Popen.wait, also returning the CPU seconds (user + system) the process used in total.
+
+    Raises:
+        subprocess.TimeoutExpired if the process is still running after timeout seconds.
+    """
+    deadline = None if timeout is None else time.time() + timeout
+    while True:
+        pid, status, rusage = os.wait4(process.pid, 0 if deadline is None else os.WNOHANG)
+        if pid != 0:
+            break
+        if time.time() >= deadline:
+            raise subprocess.TimeoutExpired(process.args, timeout)
+        time.sleep(0.05)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return process.returncode, rusage.ru_utime + rusage.ru_stime
+
+
+def run_blender(command:List[str], timeout:float=None, cpu_timeout:float=None):
+    """
+    Run a one-shot Blender command with optional deadlines, capturing its output.
+
+    Args:
+        command: the Blender command line, as a list.
+        timeout: wall-clock deadline in seconds.
+        cpu_timeout: CPU-time deadline in seconds, enforced by the kernel through RLIMIT_CPU
+            (see limit_cpu).
+    Returns:
+        (return code, stdout and stderr of the process).
+    Raises:
+        RenderTimeoutException if either deadline was hit. The whole process group is killed.
+    """
+    engine_loop = get_running_engine()
+    if engine_loop is not None:
+        # under the async engine, the loop manages the process (see run_blender_async)
+        return asyncio.run_coroutine_threadsafe(run_blender_async(command, timeout=timeout, cpu_timeout=cpu_timeout),
+                                                engine_loop).result()
+
+    process = subprocess.Popen(command, start_new_session=True,
+                               stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, errors="replace")
+    if cpu_timeout is not None:
+        limit_cpu(process.pid, cpu_timeout)
+    output = []
+    reader = threading.Thread(target=lambda: output.extend(process.stdout), daemon=True)
+    reader.start()
+    try:
+        returncode, cpu_seconds = wait_with_rusage(process, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        kill_process_group(process)
+        logger.warning(f"Blender went past its {timeout}s deadline and was killed: {' '.join(command)}")
+        raise RenderTimeoutException
+    reader.join()
+
+    if is_cpu_timeout(returncode, cpu_seconds, cpu_timeout):
+        logger.warning(f"Blender went past its {cpu_timeout}s CPU deadline and was killed: {' '.join(command)}")
+        raise RenderTimeoutException
+    return process.returncode, "".join(output)
+
+
+async def run_blender_async(command:List[str], timeout:float=None, cpu_timeout:float=None):
+    """
+    run_blender, as a coroutine: the process and its output are handled by the event loop,
+    without a thread of its own. The loop reaps the process itself, so its CPU time is
+    sampled while it runs.
+
+    Returns:
+        (return code, stdout and stderr of the process).
+    Raises:
+        RenderTimeoutException if either deadline was hit. The whole process group is killed.
+    """
+    process = await asyncio.create_subprocess_exec(*command, start_new_session=True,
+                                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    cpu_samples = [None]
+    async def sample_cpu():
+        while True:
+            cpu_seconds = get_cpu_seconds(process.pid)
+            if cpu_seconds is not None:
+                cpu_samples[0] = cpu_seconds
+            await asyncio.sleep(CPU_DEADLINE_POLL_INTERVAL)
+
+    sampler = None
+    if cpu_timeout is not None:
+        limit_cpu(process.pid, cpu_timeout)
+        sampler = asyncio.ensure_future(sample_cpu())
+    try:
+        output, _ = await asyncio.wait_for(process.communicate(), timeout=timeout)
+    except asyncio.TimeoutError:
+        try:
+            os.killpg(os.getpgid(process.pid), signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+        await process.wait()
+        logger.warning(f"Blender went past its {timeout}s deadline and was killed: {' '.join(command)}")
+        raise RenderTimeoutException
+    finally:
+        if sampler is not None:
+            sampler.cancel()
+
+    # the last sample can be up to one poll interval old, on every core
+    cpu_seconds = cpu_samples[0]
+    if cpu_seconds is not None:
+        cpu_seconds += CPU_DEADLINE_POLL_INTERVAL * (os.cpu_count() or 1)
+    if is_cpu_timeout(process.returncode, cpu_seconds, cpu_timeout):
+        logger.warning(f"Blender went past its {cpu_timeout}s CPU deadline and was killed: {' '.join(command)}")
+        raise RenderTimeoutException
+    return process.returncode, output.decode("utf-8", errors="replace")
+
+
+def get_render_deadlines(config:dict):
+    """
+    Returns:
+        (wall-clock, CPU) deadlines in seconds of a single render, from
+        run_config.render_timeout and run_config.render_cpu_timeout. None means no deadline.
+    """
+    run_config = config["run_config"]
+    return run_config.get("render_timeout"), run_config.get("render_cpu_timeout")
+
+
+class BlenderWorker(object):
+    """
+    One Blender process running `blender_base/worker.py`. Jobs are written to its
+    stdin as JSON lines, and responses are read back from its stdout.
+    """
+    _job_ids = itertools.count()
+
+    def __init__(self, command:List[str], startup_timeout:float=600):
+        """
+        Args:
+            command: the full command line launching the worker. Anything that speaks
+                the same line protocol (e.g. a fake worker in tests) can stand in for Blender.
+            startup_timeout: seconds to wait for the worker to report that it's ready.
+        """
+        self.command = command
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        text=True, bufsize=1, start_new_session=True)
+        self.responses = queue.Queue()
+        self.reader = threading.Thread(target=self._read_stdout, daemon=True)
+        self.reader.start()
+        self.jobs_done = 0
+        self.rss_mb = None # resident memory reported after the last job
+        self.loaded_parent = None # parent script whose scene the worker holds, after a delta job
+
+        try:
+            ready = self.responses.get(timeout=startup_timeout)
+        except queue.Empty:
+            ready = None
+        if ready is None or ready.get("status") != "ready":
+            self.close()
+            raise CodeExecutionException
+        self.pid = ready.get("pid", self.process.pid)
+
+    def _read_stdout(self):
+        for line in self.process.stdout:
+            if line.startswith(RESPONSE_PREFIX):
+                self.responses.put(json.loads(line[len(RESPONSE_PREFIX):]))
+            else:
+                # Blender's own logging passes through, as it did for one-shot renders.
+                sys.stdout.write(line)
+        self.responses.put(None) # EOF: the worker is gone.
+
+    def _next_response(self, timeout:float=None, cpu_timeout:float=None):
+        """
+        Wait for the worker's answer to the current job.
+
+        Raises:
+            RenderTimeoutException if the job went past either deadline. The worker is killed.
+        """
+        start_time = time.time()
+        start_cpu = get_cpu_seconds(self.process.pid) if cpu_timeout is not None else None
+        while True:
+            poll_interval = None
+            if cpu_timeout is not None and start_cpu is not None:
+                poll_interval = CPU_DEADLINE_POLL_INTERVAL
+            if timeout is not None:
+                remaining = timeout - (time.time() - start_time)
+                poll_interval = remaining if poll_interval is None else min(poll_interval, remaining)
+            try:
+                return self.responses.get(timeout=(None if poll_interval is None else max(poll_interval, 0)))
+            except queue.Empty:
+                pass
+
+            if timeout is not None and time.time() - start_time >= timeout:
+                logger.warning(f"Blender worker {self.pid} went past its {timeout}s deadline and is being killed.")
+                kill_process_group(self.process)
+                raise RenderTimeoutException
+            if cpu_timeout is None or start_cpu is None:
+                continue
+            cpu_now = get_cpu_seconds(self.process.pid)
+            if cpu_now is not None and cpu_now - start_cpu >= cpu_timeout:
+                logger.warning(f"Blender worker {self.pid} went past its {cpu_timeout}s CPU deadline and is being killed.")
+                kill_process_group(self.process)
+                raise RenderTimeoutException
+
+    def is_alive(self) -> bool:
+        return self.process.poll() is None
+
+    def run_job(self, script_path:str, render_path:str, render_settings:dict=None,
+                timeout:float=None, cpu_timeout:float=None, delta:dict=None) -> dict:
+        """
+        Args:
+            delta: optional {"parent": [PATH], "statements": [...], "inverse": [...]}, to render
+                `script_path` by replaying its property writes on the parent's scene.
+        Returns:
+            the worker's response, a dict with at least "status" ("ok" or "error").
+        Raises:
+            CodeExecutionException if the worker died before answering.
+            RenderTimeoutException if the job went past its deadline (the worker is killed).
+        """
+        job_id = next(self._job_ids)
+        try:
+            self.process.stdin.write(json.dumps({"id": job_id,
+                                                 "script": script_path,
+                                                 "render": render_path,
+                                                 "render_settings": render_settings,
+                                                 "delta": delta}) + "\n")
+            self.process.stdin.flush()
+        except (BrokenPipeError, OSError):
+            raise CodeExecutionException
+
+        response = self._next_response(timeout=timeout, cpu_timeout=cpu_timeout)
+        if response is None:
+            raise CodeExecutionException
+        assert response["id"] == job_id, f"worker answered job {response['id']} instead of {job_id}"
+        self.jobs_done += 1
+        self.rss_mb = response.get("rss_mb", self.rss_mb)
+        self.loaded_parent = delta["parent"] if (delta is not None and response["status"] == "ok") else None
+        return response
+
+    def close(self, timeout:float=10):
+        if self.is_alive():
+            try:
+                self.process.stdin.write(json.dumps({"command": "shutdown"}) + "\n")
+                self.process.stdin.flush()
+                self.process.wait(timeout=timeout)
+            except (BrokenPipeError, OSError, subprocess.TimeoutExpired):
+                self.process.kill()
+                self.process.wait()
+
+
+class BlenderWorkerPool(object):
+    """
+    A fixed-size pool of BlenderWorkers sharing the same starter blend and base script.
+    Workers are spawned lazily, up to `num_workers`, and replaced if they die: callers
+    waiting for a worker are woken up whenever one is released or a slot frees up.
+
+    Workers are recycled after `max_jobs` jobs, or once their resident memory goes past
+    `max_rss_mb`. So that capacity doesn't dip while a replacement loads the blend,
+    `num_spares` ready workers are kept on the side to take over from retiring ones.
+    """
+    def __init__(self, command:List[str], num_workers:int, max_jobs:int=None,
+                 max_rss_mb:float=None, num_spares:int=1):
+        assert num_workers > 0
+        self.command = command
+        self.num_workers = num_workers
+        self.idle = [] # guarded by lock
+        self.num_spawned = 0
+        self.lock = threading.Lock()
+        self.available = threading.Condition(self.lock) # an idle worker, or a free slot
+
+        self.max_jobs = max_jobs
+        self.max_rss_mb = max_rss_mb
+        self.recycling = max_jobs is not None or max_rss_mb is not None
+        self.num_spares = num_spares if self.recycling else 0
+        self.spares = queue.Queue()
+        self.num_spares_pending = 0 # spawned or being spawned
+        self.closed = False
+
+    def _spawn_spares(self):
+        """ Top the spares up to num_spares, in the background. """
+        def spawn():
+            try:
+                worker = BlenderWorker(self.command)
+            except Exception as e:
+                logger.warning(f"Couldn't spawn a spare Blender worker: {e}")
+                with self.lock:
+                    self.num_spares_pending -= 1
+                return
+            with self.lock:
+                closed = self.closed
+            if closed:
+                worker.close()
+            else:
+                self.spares.put(worker)
+
+        with self.lock:
+            num_missing = self.num_spares - self.num_spares_pending
+            self.num_spares_pending += max(num_missing, 0)
+        for _ in range(num_missing):
+            threading.Thread(target=spawn, daemon=True).start()
+
+    def _needs_recycling(self, worker:BlenderWorker) -> bool:
+        if self.max_jobs is not None and worker.jobs_done >= self.max_jobs:
+            return True
+        return self.max_rss_mb is not None and worker.rss_mb is not None and worker.rss_mb >= self.max_rss_mb
+
+    def _recycle_worker(self, worker:BlenderWorker):
+        logger.info(f"Recycling Blender worker {worker.pid} after {worker.jobs_done} jobs, at {worker.rss_mb} MB")
+        threading.Thread(target=worker.close, daemon=True).start()
+        try:
+            spare = self.spares.get_nowait()
+        except queue.Empty:
+            # no spare ready yet: the slot is freed, and the next caller (waiting already, or
+            # not) spawns a fresh worker in it.
+            self._free_slot()
+            return
+        with self.available:
+            self.num_spares_pending -= 1
+            self.idle.append(spare)
+            self.available.notify()
+        self._spawn_spares()
+
+    def _acquire_worker(self, preferred_parent:str=None) -> BlenderWorker:
+        """
+        Args:
+            preferred_parent: prefer an idle worker that already holds this parent script's scene.
+        """
+        with self.available:
+            while len(self.idle) == 0 and self.num_spawned >= self.num_workers:
+                self.available.wait()
+            if len(self.idle) > 0:
+                chosen = self.idle[0]
+                for worker in self.idle:
+                    if preferred_parent is not None and worker.loaded_parent == preferred_parent:
+                        chosen = worker
+                        break
+                self.idle.remove(chosen)
+                return chosen
+            self.num_spawned += 1
+
+        if self.recycling:
+            try:
+                # a ready spare beats waiting on a fresh worker to load the blend
+                spare = self.spares.get_nowait()
+                with self.lock:
+                    self.num_spares_pending -= 1
+                self._spawn_spares()
+                return spare
+            except queue.Empty:
+                self._spawn_spares()
+        try:
+            return BlenderWorker(self.command)
+        except Exception:
+            self._free_slot()
+            raise
+
+    def _free_slot(self):
+        """ A worker is gone for good: its slot can be taken by a fresh one. """
+        with self.available:
+            self.num_spawned -= 1
+            self.available.notify()
+
+    def _release_worker(self, worker:BlenderWorker):
+        if worker.is_alive() and self._needs_recycling(worker):
+            self._recycle_worker(worker)
+        elif worker.is_alive():
+            with self.available:
+                self.idle.append(worker)
+                self.available.notify()
+        else:
+            self._free_slot()
+
+    def render(self, script_path:str, render_path:str, render_settings:dict=None,
+               timeout:float=None, cpu_timeout:float=None, delta:dict=None):
+        """
+        Render `script_path` into `render_path` on the next free worker. With a `delta` (see
+        BlenderWorker.run_job), a worker already holding the parent's scene is preferred.
+
+        Raises:
+            BlenderExecutionException when the script fails inside Blender, or the worker dies.
+            RenderTimeoutException when the render goes past its deadline. The worker is
+                killed, and its slot in the pool is freed for a fresh one right away.
+        """
+        worker = self._acquire_worker(preferred_parent=(None if delta is None else delta["parent"]))
+        try:
+            response = worker.run_job(script_path, render_path, render_settings,
+                                      timeout=timeout, cpu_timeout=cpu_timeout, delta=delta)
+        except RenderTimeoutException:
+            raise
+        except CodeExecutionException:
+            logger.warning(f"Blender worker {worker.pid} died while rendering {script_path}")
+            worker.close()
+            raise BlenderExecutionException("crash")
+        finally:
+            self._release_worker(worker)
+
+        if response["status"] != "ok":
+            log = response.get("error", "")
+            kind = classify_failure(log)
+            logger.warning(f"The following bpy script failed ({kind}) in blender worker {worker.pid}:{script_path}\n{log}")
+            raise BlenderExecutionException(kind, log)
+
+    def close(self):
+        with self.available:
+            self.closed = True
+            idle_workers = self.idle
+            self.idle = []
+            self.num_spawned -= len(idle_workers)
+            self.available.notify_all()
+        for worker in idle_workers:
+            worker.close()
+        while True:
+            try:
+                self.spares.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_worker_pool(config:dict, blender_file:str, blender_script:str) -> BlenderWorkerPool:
+    """
+    Pools are shared by every refinement run in the process that uses the same
+    (blender binary, starter blend, base script), e.g. all instances of a config.
+    """
+    run_config = config["run_config"]
+    key = (run_config["blender_command"], os.path.abspath(blender_file), os.path.abspath(blender_script))
+    with _pools_lock:
+        if key not in _pools:
+            command = shlex.split(run_config["blender_command"]) + [
+                        "--background", blender_file,
+                        "--python", WORKER_SCRIPT,
+                        "--", blender_script]
+            num_workers = run_config.get("num_blender_workers",
+                                         run_config["max_concurrent_rendering_processes"])
+            _pools[key] = BlenderWorkerPool(command, num_workers,
+                                            max_jobs=run_config.get("worker_max_jobs"),
+                                            max_rss_mb=run_config.get("worker_max_rss_mb"),
+                                            num_spares=run_config.get("num_spare_blender_workers", 1))
+        return _pools[key]
+
+
+@atexit.register
+def close_worker_pools():
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
@@ -2,7 +2,12 @@ import os
 import numpy as np
 import subprocess
 import re
+import io
+import ast
+import math
 import copy
+import tokenize
+import hashlib
 from tasksolver.exceptions import CodeExecutionException, ToolCallException
 from pathlib import Path
 
@@ -47,6 +52,403 @@ def get_code_as_string(script_path):
     return code_str
 
 
+def get_normalized_code(code_str:str) -> str:
+    """
+    Strip comments, blank lines and insignificant whitespace, so that two scripts that
+    only differ in formatting normalize to the same string.
+
+    Args:
+        code_str: a string containing python code.
+    Returns:
+        normalized code string. Falls back to stripping each line if the code doesn't tokenize.
+    """
+    try:
+        lines = []
+        current_line = []
+        for tok in tokenize.generate_tokens(io.StringIO(code_str).readline):
+            if tok.type in (tokenize.COMMENT, tokenize.NL, tokenize.ENCODING, tokenize.ENDMARKER):
+                continue
+            if tok.type == tokenize.NEWLINE:
+                lines.append(" ".join(current_line))
+                current_line = []
+            elif tok.type == tokenize.INDENT:
+                current_line.append("<INDENT>")
+            elif tok.type == tokenize.DEDENT:
+                current_line.append("<DEDENT>")
+            else:
+                current_line.append(tok.string)
+        if len(current_line) > 0:
+            lines.append(" ".join(current_line))
+        return "\n".join(lines)
+    except (tokenize.TokenError, IndentationError, SyntaxError):
+        return "\n".join([line.strip() for line in code_str.split("\n") if len(line.strip()) > 0])
+
+
+def get_code_fingerprint(code_str:str, tolerance:float=None) -> str:
+    """
+    Hash of what a script does, ignoring how it's written: the code is parsed, docstrings
+    are dropped (comments and formatting don't survive parsing anyway), and float literals
+    are snapped to multiples of `tolerance`, so that e.g. 0.5 and 0.5000001 count as the same edit.
+    Ints (indices, counts, enum-like values) and floats too large for the grid (inf, nan,
+    1e308) are compared exactly.
+
+    Args:
+        code_str: the code.
+        tolerance: grid that float literals are snapped to. None compares them exactly.
+    Returns:
+        sha256 hex digest. Code that doesn't parse is hashed by its normalized text.
+    """
+    try:
+        tree = ast.parse(code_str)
+    except SyntaxError:
+        return hashlib.sha256(get_normalized_code(code_str).encode("utf-8")).hexdigest()
+
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.Module, ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            if (len(node.body) > 0 and isinstance(node.body[0], ast.Expr)
+                    and isinstance(node.body[0].value, ast.Constant) and isinstance(node.body[0].value.value, str)):
+                node.body = node.body[1:] or [ast.Pass()]
+        elif tolerance is not None and isinstance(node, ast.Constant) and isinstance(node.value, float):
+            # replaced by the index of the grid point, which sidesteps float formatting
+            grid_index = node.value / tolerance
+            if math.isfinite(grid_index):
+                node.value = ("~", round(grid_index))
+    return hashlib.sha256(ast.dump(tree, annotate_fields=False).encode("utf-8")).hexdigest()
+
+
+def get_assignment_delta(parent_code_str:str, child_code_str:str):
+    """
+    If the child script only differs from the parent in top-level property writes of literal
+    values (e.g. `key_blocks["Mouth open"].value = 0.4`), return those writes, so that they
+    can be replayed on a scene already built by the parent instead of re-running everything.
+
+    Args:
+        parent_code_str: code of the parent script.
+        child_code_str: code of the child script, an edit of the parent.
+    Returns:
+        (delta, inverse): lists of statements (as code strings). `delta` turns the parent's
+        scene into the child's, `inverse` (the parent's version of the same writes) turns it back.
+        None if the edit is anything else than such property writes, or if the rest of the
+        script reads what was written (see get_later_reads), since replaying the writes alone
+        then wouldn't give the child's scene.
+    """
+    try:
+        parent_tree = ast.parse(parent_code_str)
+        child_tree = ast.parse(child_code_str)
+    except SyntaxError:
+        return None
+    if len(parent_tree.body) != len(child_tree.body):
+        return None
+
+    def is_property_write(stmt):
+        if not (isinstance(stmt, ast.Assign) and len(stmt.targets) == 1
+                and isinstance(stmt.targets[0], (ast.Attribute, ast.Subscript))):
+            return False
+        try:
+            ast.literal_eval(stmt.value)
+        except (ValueError, TypeError, SyntaxError, MemoryError, RecursionError):
+            return False
+        return True
+
+    def target_of(stmt):
+        return ast.dump(stmt.targets[0])
+
+    delta, inverse = [], []
+    for idx, (parent_stmt, child_stmt) in enumerate(zip(parent_tree.body, child_tree.body)):
+        if ast.dump(parent_stmt) == ast.dump(child_stmt):
+            continue
+        if not (is_property_write(parent_stmt) and is_property_write(child_stmt)
+                and target_of(parent_stmt) == target_of(child_stmt)):
+            return None
+        delta.append(ast.unparse(child_stmt))
+        inverse.append(ast.unparse(parent_stmt))
+
+        # a later write to the same property would win in a full run, so replaying isn't equivalent.
+        num_writes = sum([1 for stmt in child_tree.body
+                          if isinstance(stmt, ast.Assign) and any([ast.dump(target) == target_of(child_stmt)
+                                                                   for target in stmt.targets])])
+        if num_writes > 1:
+            return None
+        if reads_target(child_stmt.targets[0], get_later_reads(child_tree, idx)):
+            return None
+
+    return delta, inverse
+
+
+def get_assignment_spine(target) -> set:
+    """ ids of the nodes that an assignment target navigates through to reach what it writes. """
+    spine = set()
+    if isinstance(target, (ast.Tuple, ast.List)):
+        for el in target.elts:
+            spine.update(get_assignment_spine(el))
+        return spine
+    if isinstance(target, ast.Starred):
+        return get_assignment_spine(target.value)
+    while isinstance(target, (ast.Attribute, ast.Subscript)):
+        spine.add(id(target))
+        target = target.value
+    spine.add(id(target))
+    return spine
+
+
+def get_later_reads(tree, idx:int) -> list:
+    """
+    Name, Attribute and Subscript nodes read by the statements after tree.body[idx], and
+    anywhere in functions, lambdas and classes (they can be called later), along with the
+    method calls (Call nodes) among them. The chains that assignments navigate to reach what
+    they write (e.g. `bpy.data.shape_keys["Key"]` in
+    `bpy.data.shape_keys["Key"].key_blocks["Smile"].value = 0.2`) don't count as reads.
+    """
+    scopes = list(tree.body[idx + 1:])
+    for stmt in tree.body[:idx + 1]:
+        scopes.extend([node for node in ast.walk(stmt)
+                       if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.Lambda, ast.ClassDef))])
+    reads = []
+    for scope in scopes:
+        spine = set()
+        for node in ast.walk(scope):
+            if isinstance(node, ast.Assign):
+                for target in node.targets:
+                    spine.update(get_assignment_spine(target))
+        for node in ast.walk(scope):
+            if (isinstance(node, (ast.Name, ast.Attribute, ast.Subscript)) and isinstance(node.ctx, ast.Load)
+                    and id(node) not in spine):
+                reads.append(node)
+            elif isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute):
+                reads.append(node)
+    return reads
+
+
+def reads_target(target, reads:list) -> bool:
+    """
+    Whether any of reads (see get_later_reads) may read the value written to target:
+        - the target itself, or something under it;
+        - the object it's written on, as a whole: a prefix of the chain past its first name
+          (e.g. `light.data` for `light.data.energy`) handed on as a value, or whose methods
+          are called. Going through it to something else (`bpy.data.lights` for
+          `bpy.data.worlds[0].color`) isn't a read, and neither is the first name alone:
+          `collection.objects.link(light)` doesn't read `light.data.energy`;
+        - the same attribute or item reached some other way (e.g. through another variable
+          holding the same object);
+        - the scene as a whole, through `bpy.ops`.
+    """
+    chain = [] # the target, and its prefixes past the first name
+    node = target
+    while isinstance(node, (ast.Attribute, ast.Subscript)):
+        chain.append(ast.unparse(node))
+        node = node.value
+    target_code = ast.unparse(target)
+    passed_through = set([id(node.value) for node in reads if isinstance(node, (ast.Attribute, ast.Subscript))])
+
+    for node in reads:
+        if isinstance(node, ast.Call):
+            if ast.unparse(node.func.value) in chain:
+                return True
+            continue
+        if (isinstance(node, ast.Attribute) and node.attr == "ops"
+                and isinstance(node.value, ast.Name) and node.value.id == "bpy"):
+            return True
+        if not isinstance(node, (ast.Attribute, ast.Subscript)):
+            continue
+        read_code = ast.unparse(node)
+        if read_code == target_code: # reads under it go through it
+            return True
+        if read_code in chain and id(node) not in passed_through:
+            return True
+        if isinstance(target, ast.Attribute):
+            if isinstance(node, ast.Attribute) and node.attr == target.attr:
+                return True
+        elif isinstance(node, ast.Subscript) and ast.dump(node.slice) == ast.dump(target.slice):
+            return True
+    return False
+
+
+def get_residual_code(parent_code_str:str, child_code_str:str):
+    """
+    For scripts that build a scene step by step (e.g. placement, where each edit appends more
+    moves), the part of the child that still has to run on a scene the parent already ran on.
+
+    Definitions (imports, functions, classes) and lookups (names bound without any call, e.g.
+    `sofa = bpy.data.objects["Sofa"]`) are kept, as the snapshot only holds the scene, not the
+    script's names. Everything else, property writes included, is an action: of those, the
+    ones the parent already ran are dropped, and the rest run in order.
+
+    Args:
+        parent_code_str: code of the parent script.
+        child_code_str: code of the child script, an edit of the parent.
+    Returns:
+        the residual code, or None if the child isn't the parent plus more statements
+        (e.g. an earlier move or a function was changed).
+    """
+    try:
+        parent_tree = ast.parse(parent_code_str)
+        child_tree = ast.parse(child_code_str)
+    except SyntaxError:
+        return None
+
+    def is_name_target(target):
+        if isinstance(target, ast.Starred):
+            return is_name_target(target.value)
+        if isinstance(target, (ast.Tuple, ast.List)):
+            return all([is_name_target(el) for el in target.elts])
+        return isinstance(target, ast.Name)
+
+    def is_definition(stmt):
+        if isinstance(stmt, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef, ast.Import, ast.ImportFrom)):
+            return True
+        if isinstance(stmt, ast.Assign):
+            # `obj.location.x = 1` or `d["k"] = 1` change state, they aren't definitions
+            return (all([is_name_target(target) for target in stmt.targets])
+                    and not any([isinstance(node, ast.Call) for node in ast.walk(stmt.value)]))
+        if isinstance(stmt, ast.Expr):
+            return isinstance(stmt.value, ast.Constant) # docstrings
+        return False
+
+    parent_definitions = set([ast.dump(stmt) for stmt in parent_tree.body if is_definition(stmt)])
+    child_definitions = set([ast.dump(stmt) for stmt in child_tree.body if is_definition(stmt)])
+    if not parent_definitions.issubset(child_definitions):
+        return None
+
+    parent_actions = [ast.dump(stmt) for stmt in parent_tree.body if not is_definition(stmt)]
+    child_actions = [stmt for stmt in child_tree.body if not is_definition(stmt)]
+    if [ast.dump(stmt) for stmt in child_actions[:len(parent_actions)]] != parent_actions:
+        return None
+    done_actions = child_actions[:len(parent_actions)]
+    new_actions = child_actions[len(parent_actions):]
+
+    # names bound by the dropped statements would be missing (or stale, if a definition
+    # binds them too) in the residual run, unless the new statements bind them again.
+    def bound_names(stmts):
+        return set([node.id for stmt in stmts for node in ast.walk(stmt)
+                    if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Store)])
+    new_loaded = set([node.id for stmt in new_actions for node in ast.walk(stmt)
+                      if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Load)])
+    if len((bound_names(done_actions) - bound_names(new_actions)) & new_loaded) > 0:
+        return None
+
+    residual = [stmt for stmt in child_tree.body
+                if is_definition(stmt) or any([stmt is action for action in new_actions])]
+    return "\n\n".join([ast.unparse(stmt) for stmt in residual]) + "\n"
+
+
+def get_unified_diff(before_code_str:str, after_code_str:str, context:int=2) -> str:
+    """ Unified diff turning before_code_str into after_code_str, empty if they're the same. """
+    import difflib
+
+    diff = difflib.unified_diff(before_code_str.splitlines(), after_code_str.splitlines(),
+                                fromfile="original.py", tofile="current.py", n=context, lineterm="")
+    return "\n".join(diff)
+
+
+def is_unified_diff(text:str) -> bool:
+    lines = text.splitlines()
+    return any([line.startswith("@@") for line in lines]) or (
+        any([line.startswith("-") for line in lines]) and any([line.startswith("+") for line in lines]))
+
+
+def apply_unified_diff(code_str:str, diff_str:str) -> str:
+    """
+    Apply a unified diff written by an LLM. Hunks are located by their content (context and
+    removed lines) rather than by their line numbers, which are seldom right, first exactly
+    and then ignoring indentation and trailing whitespace. Context lines are kept as they
+    are in the code, whichever way they matched.
+
+    Raises:
+        ToolCallException when a hunk can't be found in the code.
+    """
+    hunks = [] # lists of (" ", "-" or "+", line)
+    for line in diff_str.splitlines():
+        if line.startswith("---") or line.startswith("+++"):
+            continue
+        if line.startswith("@@") or len(hunks) == 0:
+            hunks.append([])
+            if line.startswith("@@"):
+                continue
+        if line.startswith("-") or line.startswith("+") or line.startswith(" "):
+            hunks[-1].append((line[0], line[1:]))
+        elif len(line) == 0:
+            hunks[-1].append((" ", ""))
+        # anything else (e.g. "\ No newline at end of file") is ignored
+
+    code_lines = code_str.splitlines()
+    for hunk in hunks:
+        if len(hunk) == 0:
+            continue
+        before = [line for kind, line in hunk if kind != "+"]
+        start = None
+        for same in (lambda a, b: a == b, lambda a, b: a.strip() == b.strip()):
+            for idx in range(len(code_lines) - len(before) + 1):
+                if all([same(code_lines[idx + offset], line) for offset, line in enumerate(before)]):
+                    start = idx
+                    break
+            if start is not None:
+                break
+        if start is None:
+            raise ToolCallException("Hunk of the diff not found in the code:\n" + "\n".join(before))
+        after = []
+        code_idx = start
+        for kind, line in hunk:
+            if kind == "+":
+                after.append(line)
+                continue
+            if kind == " ":
+                after.append(code_lines[code_idx])
+            code_idx += 1
+        code_lines = code_lines[:start] + after + code_lines[start + len(before):]
+    return "\n".join(code_lines) + ("\n" if code_str.endswith("\n") else "")
+
+
+# Lines with which an LLM abbreviates code instead of writing it out.
+ABBREVIATION_PATTERNS = [
+    re.compile(r"^\s*\.\.\.\s*$"),
+    re.compile(r"#\s*\.\.\."),
+    re.compile(r"#.*\b(rest of the (code|script)|remaining code|same as (before|above)|(stays|remains) the same)\b",
+               re.IGNORECASE),
+]
+
+
+class CodeBlockWatcher(object):
+    """
+    Follows a streamed LLM response, to tell as early as possible whether it holds a usable
+    python code block. Feed it the text as it arrives; `state` is then
+        "pending": nothing conclusive yet,
+        "code": the first code block just closed, `code` holds it,
+        "abbreviated": the code block elides code (e.g. `# ... rest of the code`),
+        "no_code": max_chars_without_code went by without a code block opening.
+    """
+    def __init__(self, max_chars_without_code:int=2000):
+        self.max_chars_without_code = max_chars_without_code
+        self.text = ""
+        self.state = "pending"
+        self.code = None
+
+    def feed(self, chunk:str) -> str:
+        if self.state != "pending":
+            return self.state
+        self.text += chunk
+        start = self.text.find("```")
+        if start < 0:
+            if len(self.text) > self.max_chars_without_code:
+                self.state = "no_code"
+            return self.state
+
+        body_start = self.text.find("\n", start)
+        if body_start < 0:
+            return self.state # the language tag isn't complete yet
+        end = self.text.find("```", body_start)
+        body = self.text[body_start + 1:] if end < 0 else self.text[body_start + 1:end]
+        # only judge complete lines, a line in the works may still turn out fine
+        lines = body.split("\n") if end >= 0 else body.split("\n")[:-1]
+        for line in lines:
+            if any([pattern.search(line) for pattern in ABBREVIATION_PATTERNS]):
+                self.state = "abbreviated"
+                return self.state
+        if end >= 0:
+            self.code = body
+            self.state = "code"
+        return self.state
+
+
 def blenderai_uniform_sample(low:float, high:float, num_samples:int):
     """
     Args:
@@ -3,6 +3,7 @@ from PIL import Image
 import matplotlib.pyplot as plt
 import matplotlib
 import io
+import numpy as np
 
 def plot_image_grid(images:List[Image.Image], rows:int, cols:int,
                     titles:Union[None, List[str]]=None) -> matplotlib.figure.Figure:
@@ -87,3 +88,60 @@ def horiz_concat(left:Image.Image, right:Image.Image) -> Image.Image:
 
     return concatenated_image
 
+
+
+def get_dhash(image:Image.Image, hash_size:int=8) -> int:
+    """
+    Difference hash: one bit per horizontally adjacent pair of pixels of a tiny grayscale
+    version of the image, set where the left one is brighter. Near-identical images have
+    hashes a few bits apart.
+    """
+    small = np.asarray(image.convert("L").resize((hash_size + 1, hash_size), Image.BILINEAR), dtype=np.int16)
+    bits = (small[:, :-1] > small[:, 1:]).flatten()
+    return int("".join(["1" if bit else "0" for bit in bits]), 2)
+
+
+def get_hash_distance(hash1:int, hash2:int) -> int:
+    """ Hamming distance between two hashes. """
+    return bin(hash1 ^ hash2).count("1")
+
+
+def get_pixel_difference(image1:Image.Image, image2:Image.Image) -> float:
+    """
+    Images of different sizes (e.g. a preview render of the fidelity ladder against its
+    full-resolution parent) are compared at the smaller size, the larger one being
+    area-averaged down to it, much like a render at that resolution.
+
+    Returns:
+        mean absolute difference of the RGB values (0-255).
+    """
+    if image1.size != image2.size:
+        if image1.size[0] * image1.size[1] > image2.size[0] * image2.size[1]:
+            image1 = image1.convert("RGB").resize(image2.size, Image.BOX)
+        else:
+            image2 = image2.convert("RGB").resize(image1.size, Image.BOX)
+    pixels1 = np.asarray(image1.convert("RGB"), dtype=np.int16)
+    pixels2 = np.asarray(image2.convert("RGB"), dtype=np.int16)
+    return float(np.abs(pixels1 - pixels2).mean())
+
+
+def paste_border(render:Image.Image, background:Image.Image, border) -> Image.Image:
+    """
+    Composite the part of a border render that was actually rendered onto a background.
+
+    Args:
+        render: full-frame image of which only the border region was rendered.
+        background: image of the rest of the frame, resized to the render if needed.
+        border: (min_x, min_y, max_x, max_y) of the rendered region, in normalized frame
+            coordinates with the origin at the bottom left (as Blender's render border).
+    """
+    width, height = render.size
+    box = (int(np.floor(border[0]*width)), int(np.floor((1 - border[3])*height)),
+           int(np.ceil(border[2]*width)), int(np.ceil((1 - border[1])*height)))
+    composite = background.convert("RGBA")
+    if composite.size != render.size:
+        composite = composite.resize(render.size, Image.BILINEAR)
+    else:
+        composite = composite.copy()
+    composite.paste(render.convert("RGBA").crop(box), box)
+    return composite
@@ -0,0 +1,72 @@
+"""
+Reading the content of tasksolver Questions and TaskSpecs, for the code paths that build on it
+outside of tasksolver (response cache keys, streamed requests, diff-mode prompts).
+
+A Question is the list of text and images it was built from (`Question([text, image, ...])`),
+kept as its `elements`, and its str() is its text. Nothing else is guessed at: a Question
+without a list of `elements`, with parts that aren't text, images or nested Questions, or whose
+text parts aren't in its str(), raises, so that a tasksolver whose Question keeps its
+parts some other way is caught (no caching, the full prompt) instead of silently losing them.
+"""
+
+from tasksolver.common import Question
+
+
+class UnrecognizedQuestionException(TypeError):
+    """ The parts of a Question (or the background of a TaskSpec) couldn't be identified. """
+
+
+def is_image(part) -> bool:
+    """ PIL images, duck-typed so that this module doesn't need PIL. """
+    return hasattr(part, "tobytes") and hasattr(part, "size") and hasattr(part, "mode")
+
+
+def get_parts_list(question) -> list:
+    parts = getattr(question, "elements", None)
+    if not isinstance(parts, (list, tuple)):
+        raise UnrecognizedQuestionException(f"{type(question).__name__} doesn't keep its parts as a list of elements")
+    return list(parts)
+
+
+def get_question_parts(question) -> list:
+    """
+    Returns:
+        the text (str) and images (PIL) of question, in order, nested Questions flattened.
+    Raises:
+        UnrecognizedQuestionException if question isn't a Question, or its parts can't be identified.
+    """
+    if not isinstance(question, Question):
+        raise UnrecognizedQuestionException(f"expected a Question, got a {type(question).__name__}")
+    parts = []
+    for part in get_parts_list(question):
+        if isinstance(part, Question):
+            parts.extend(get_question_parts(part))
+        elif isinstance(part, str) or is_image(part):
+            parts.append(part)
+        else:
+            raise UnrecognizedQuestionException(f"unrecognized part of a Question: {type(part).__name__}")
+
+    text = str(question)
+    for part in parts:
+        if isinstance(part, str) and part.strip() not in text:
+            raise UnrecognizedQuestionException("the parts found don't match the Question's text")
+    return parts
+
+
+def get_task_background(task) -> list:
+    """
+    Returns:
+        the parts of the background Questions of task (see TaskSpec.add_background), in order.
+        In this repo, they carry the answer format (docs_for_GPT4 of the answer parser).
+    Raises:
+        UnrecognizedQuestionException if the background can't be identified.
+    """
+    background = getattr(task, "background", None)
+    if isinstance(background, Question):
+        background = [background]
+    if not isinstance(background, (list, tuple)):
+        raise UnrecognizedQuestionException(f"can't find the background of the task {getattr(task, 'name', '')}")
+    parts = []
+    for el in background:
+        parts.extend(get_question_parts(el))
+    return parts
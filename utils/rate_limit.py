@@ -0,0 +1,178 @@
+"""
+Process-wide, per-provider rate limiting of VLM requests.
+
+Every caller reserves its request (and its tokens) ahead of time and is told how long to wait,
+so requests are spread at the provider's quota instead of bursting and stalling. Rate-limit
+errors push everyone back together, and each caller then backs off exponentially with jitter,
+so parallel slots don't all retry at the same moment.
+"""
+
+import re
+import time
+import random
+import threading
+
+from loguru import logger
+
+
+class TokenBucket(object):
+    """
+    Bucket refilled continuously at `rate_per_minute`, holding at most a minute's worth.
+    Reservations can overdraw it, the overdraft being paid back in waiting time.
+    A bucket without a rate doesn't limit anything, until it's given one (see set_rate).
+    """
+    def __init__(self, rate_per_minute:float):
+        self.rate_per_minute = rate_per_minute
+        self.level = rate_per_minute
+        self.updated = time.monotonic()
+
+    def set_rate(self, rate_per_minute:float):
+        if self.level is None:
+            self.level = rate_per_minute # starts full, like a bucket configured with that rate
+        self.rate_per_minute = rate_per_minute
+
+    def reserve(self, amount:float, now:float) -> float:
+        """
+        Returns:
+            seconds to wait before `amount` is available.
+        """
+        if self.rate_per_minute is None:
+            return 0.0
+        rate_per_second = self.rate_per_minute / 60
+        self.level = min(self.rate_per_minute, self.level + (now - self.updated) * rate_per_second)
+        self.updated = now
+        self.level -= amount
+        return max(0.0, -self.level / rate_per_second)
+
+
+_DURATION_PATTERN = re.compile(r"([\d.]+)(ms|s|m|h)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def parse_duration(value:str):
+    """ "1.5s", "6m0s", "20ms" (as in OpenAI's x-ratelimit-reset-* headers) -> seconds, or None. """
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    matches = _DURATION_PATTERN.findall(str(value))
+    if len(matches) == 0:
+        return None
+    return sum([float(number) * _DURATION_UNITS[unit] for number, unit in matches])
+
+
+class RateLimiter(object):
+    """
+    Requests/minute and tokens/minute quota of one provider, shared by every thread (and every
+    coroutine of the async engine) of the process.
+    """
+    def __init__(self, name:str, requests_per_minute:float=None, tokens_per_minute:float=None,
+                 base_backoff:float=2, max_backoff:float=60):
+        self.name = name
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.blocked_until = 0.0
+        self.num_failures = 0 # consecutive rate-limit errors
+        self.lock = threading.Lock()
+
+    def reserve(self, num_tokens:int=0) -> float:
+        """
+        Reserve one request of about num_tokens tokens.
+        Returns:
+            seconds to wait before sending it. Callers wait without holding any concurrency slot.
+        """
+        with self.lock:
+            now = time.monotonic()
+            delay = max(self.requests.reserve(1, now), self.tokens.reserve(num_tokens, now))
+            if self.blocked_until > now:
+                # spread the callers let through once the provider's block is over
+                delay = max(delay, self.blocked_until - now + random.uniform(0, self.base_backoff))
+            return delay
+
+    def wait(self, num_tokens:int=0):
+        time.sleep(self.reserve(num_tokens))
+
+    def on_success(self):
+        with self.lock:
+            self.num_failures = 0
+
+    def on_error(self, exception:Exception) -> float:
+        """
+        Returns:
+            seconds the caller should back off before retrying: exponential in the number of
+            consecutive rate-limit errors, with full jitter, or the provider's retry-after.
+        """
+        headers = get_error_headers(exception)
+        if headers is not None:
+            self.update_from_headers(headers)
+        with self.lock:
+            if not is_rate_limit_error(exception):
+                return random.uniform(0, self.base_backoff)
+            self.num_failures += 1
+            backoff = min(self.max_backoff, self.base_backoff * (2 ** (self.num_failures - 1)))
+            retry_after = None if headers is None else parse_duration(headers.get("retry-after"))
+            if retry_after is not None:
+                backoff = max(backoff, retry_after)
+            # everyone holds off for the base part, then each caller picks its own moment
+            self.blocked_until = max(self.blocked_until, time.monotonic() + backoff / 2)
+            delay = backoff / 2 + random.uniform(0, backoff / 2)
+        logger.warning(f"{self.name} rate limit hit ({self.num_failures} in a row), backing off {delay:.1f}s")
+        return delay
+
+    def update_from_headers(self, headers):
+        """ Adopt the quota reported by the provider (OpenAI-style x-ratelimit-* headers). """
+        with self.lock:
+            for bucket, kind in ((self.requests, "requests"), (self.tokens, "tokens")):
+                limit = headers.get(f"x-ratelimit-limit-{kind}")
+                if limit is not None:
+                    bucket.set_rate(float(limit))
+                remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+                reset = parse_duration(headers.get(f"x-ratelimit-reset-{kind}"))
+                if remaining is not None and float(remaining) <= 0 and reset is not None:
+                    self.blocked_until = max(self.blocked_until, time.monotonic() + reset)
+
+
+def get_error_headers(exception:Exception):
+    response = getattr(exception, "response", None)
+    return getattr(response, "headers", None)
+
+
+def is_rate_limit_error(exception:Exception) -> bool:
+    status = getattr(exception, "status_code", None)
+    if status is None:
+        status = getattr(getattr(exception, "response", None), "status_code", None)
+    if status == 429:
+        return True
+    message = str(exception).lower()
+    return "rate limit" in message or "rate_limit" in message or "429" in message
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_provider(vision_model:str) -> str:
+    """ The provider whose quota requests to vision_model count against: "claude" or "openai". """
+    return "claude" if "claude" in str(vision_model).lower() else "openai"
+
+
+def get_rate_limiter(config:dict, provider:str="openai"):
+    """
+    Args:
+        provider: see get_provider.
+    Returns:
+        the process-wide RateLimiter of provider, configured by run_config.rate_limits[provider]
+        = {requests_per_minute, tokens_per_minute, base_backoff, max_backoff}, or None if
+        run_config.rate_limits isn't set.
+    """
+    rate_limits = config["run_config"].get("rate_limits")
+    if rate_limits is None:
+        return None
+    with _limiters_lock:
+        if provider not in _limiters:
+            _limiters[provider] = RateLimiter(provider, **(rate_limits.get(provider) or {}))
+        return _limiters[provider]
@@ -0,0 +1,143 @@
+"""
+Content-addressed cache of candidate renders, so that scripts that only differ in
+formatting/comments (or that were already rendered by an earlier run) don't launch Blender.
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import threading
+from pathlib import Path
+
+from loguru import logger
+from utils.code import get_normalized_code
+
+
+_file_hashes = {}
+_file_hashes_lock = threading.Lock()
+
+
+def get_file_hash(path:str) -> str:
+    """
+    sha256 of a file's content. Memoized on (path, mtime, size), since starter blends
+    can be large and the same one is hashed for every candidate.
+    """
+    stat = os.stat(path)
+    memo_key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+    with _file_hashes_lock:
+        if memo_key in _file_hashes:
+            return _file_hashes[memo_key]
+
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha.update(chunk)
+    digest = sha.hexdigest()
+
+    with _file_hashes_lock:
+        _file_hashes[memo_key] = digest
+    return digest
+
+
+# Render settings that change how fast a render is made, but not what it looks like.
+SETTINGS_NOT_IN_KEY = ("threads",)
+
+
+def get_render_key(blender_file:str, blender_script:str, code_str:str,
+                   render_settings:dict=None) -> str:
+    """
+    Key of the render of code_str, made by blender_script on blender_file with render_settings.
+    Scripts that only differ in formatting/comments share a key.
+    """
+    sha = hashlib.sha256()
+    sha.update(get_file_hash(blender_file).encode("utf-8"))
+    sha.update(get_file_hash(blender_script).encode("utf-8"))
+    sha.update(get_normalized_code(code_str).encode("utf-8"))
+    if render_settings is not None:
+        render_settings = {key: value for key, value in render_settings.items()
+                           if key not in SETTINGS_NOT_IN_KEY}
+    sha.update(json.dumps(render_settings, sort_keys=True).encode("utf-8"))
+    return sha.hexdigest()
+
+
+class RenderCache(object):
+    """
+    On-disk store of renders keyed by (starter blend content, blender_base script content,
+    normalized candidate code, render settings). Bounded in size, least recently used
+    renders are evicted first. Safe to share between concurrent runs: entries are
+    written atomically, and a hit just copies the png out.
+    """
+    def __init__(self, cache_dir:str, max_size_mb:float=2048):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_size_bytes = max_size_mb * (1 << 20)
+        self.lock = threading.Lock()
+
+    def make_key(self, blender_file:str, blender_script:str, code_str:str,
+                 render_settings:dict=None) -> str:
+        return get_render_key(blender_file, blender_script, code_str, render_settings)
+
+    def _entry_path(self, key:str) -> Path:
+        return self.cache_dir/f"{key}.png"
+
+    def fetch(self, key:str, render_path:str) -> bool:
+        """
+        Copy the cached render for `key` to `render_path`.
+        Returns:
+            True on a cache hit, False otherwise.
+        """
+        entry = self._entry_path(key)
+        try:
+            shutil.copyfile(entry, render_path)
+            os.utime(entry) # mark as recently used
+        except FileNotFoundError:
+            return False
+        return True
+
+    def store(self, key:str, render_path:str):
+        entry = self._entry_path(key)
+        tmp_entry = self.cache_dir/f"{key}.{os.getpid()}.{threading.get_ident()}.tmp"
+        shutil.copyfile(render_path, tmp_entry)
+        os.replace(tmp_entry, entry)
+        self.evict()
+
+    def evict(self):
+        with self.lock:
+            entries = []
+            for entry in self.cache_dir.glob("*.png"):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue # evicted by another run
+                entries.append((stat.st_mtime, stat.st_size, entry))
+
+            total_size = sum([el[1] for el in entries])
+            for _, size, entry in sorted(entries, key=lambda el: el[0]):
+                if total_size <= self.max_size_bytes:
+                    break
+                try:
+                    entry.unlink()
+                except FileNotFoundError:
+                    pass
+                total_size -= size
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_render_cache(config:dict):
+    """
+    Returns:
+        the RenderCache configured by run_config.render_cache_dir, or None if caching is off.
+    """
+    run_config = config["run_config"]
+    cache_dir = run_config.get("render_cache_dir")
+    if cache_dir is None:
+        return None
+    with _caches_lock:
+        if cache_dir not in _caches:
+            _caches[cache_dir] = RenderCache(cache_dir, run_config.get("render_cache_max_mb", 2048))
+            logger.info(f"Render cache enabled at {cache_dir}")
+        return _caches[cache_dir]
@@ -0,0 +1,538 @@
+"""
+Render farm: spread candidate renders from one orchestrator over several render boxes.
+
+A broker hands render jobs out to workers and sends the PNG back to whoever submitted
+the job. Jobs carry the candidate script itself, the content hash of the starter .blend
+and the name of the blender_base script, so workers only need a checkout of this repo:
+starter blends are uploaded to the broker once, and fetched (then cached by content hash)
+by every worker that doesn't have them yet.
+
+    python -m utils.render_farm broker --port 5750 --work_dir /tmp/farm_broker
+    python -m utils.render_farm worker --broker HOST:5750 --blender_command blender --work_dir /tmp/farm_worker
+
+A job is retried on another worker when its worker disconnects or can't set up the render
+(e.g. the blend couldn't be fetched), up to `max_attempts`. A script that fails in Blender,
+or a render that goes past its deadline, is final. Submitters give up on a job that's still
+not rendered after waiting `queue_timeout` for a worker plus every attempt running out (see
+get_submit_timeout), rather than waiting forever on a farm with no workers or a hung one.
+
+Every message is a 4-byte big-endian header length, a JSON header, and optionally
+`header["payload_size"]` bytes of payload (script, blend or PNG).
+
+Brokers bind to localhost unless told otherwise, and refuse any other address without a
+shared token (`--token`, or the BLENDERALCHEMY_FARM_TOKEN environment variable), which every
+message to the broker must then carry. Blend hashes and blender_base script names coming
+from the network are checked before they're used in a path.
+"""
+
+import os
+import re
+import sys
+import hmac
+import json
+import time
+import queue
+import shlex
+import atexit
+import shutil
+import socket
+import struct
+import argparse
+import ipaddress
+import itertools
+import threading
+import subprocess
+import socketserver
+from pathlib import Path
+
+from loguru import logger
+from tasksolver.exceptions import CodeExecutionException
+
+from utils.blender import run_blender, classify_failure, RenderTimeoutException, BlenderExecutionException
+from utils.render_cache import get_file_hash
+
+
+BLENDER_BASE_DIR = Path(__file__).resolve().parent.parent/"blender_base"
+DEFAULT_PORT = 5750
+RECONNECT_INTERVAL = 5.0
+DEFAULT_QUEUE_TIMEOUT = 600.0
+DEFAULT_ATTEMPT_TIMEOUT = 3600.0
+TOKEN_ENV = "BLENDERALCHEMY_FARM_TOKEN"
+
+
+class FarmRequestException(ValueError):
+    """ A message to the farm that's refused: bad token, blend hash or blender_base script. """
+
+
+def get_farm_token(token:str=None):
+    """ The shared token, given explicitly or through the BLENDERALCHEMY_FARM_TOKEN environment variable. """
+    return token if token is not None else os.environ.get(TOKEN_ENV)
+
+
+def is_local_host(host:str) -> bool:
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def check_blend_hash(blend_hash) -> str:
+    """ Blend hashes name files: only hex digests (see render_cache.get_file_hash) are accepted. """
+    if not isinstance(blend_hash, str) or re.fullmatch(r"[0-9a-f]+", blend_hash) is None:
+        raise FarmRequestException(f"invalid blend hash {blend_hash!r}")
+    return blend_hash
+
+
+def get_blender_script_path(blender_script) -> Path:
+    """ The blender_base script a job names, refusing anything that resolves outside of blender_base/. """
+    base_dir = BLENDER_BASE_DIR.resolve()
+    if not isinstance(blender_script, str):
+        raise FarmRequestException(f"invalid blender_base script {blender_script!r}")
+    script_path = (base_dir/blender_script).resolve()
+    if script_path.parent != base_dir or script_path.suffix != ".py" or not script_path.is_file():
+        raise FarmRequestException(f"{blender_script!r} isn't a blender_base script")
+    return script_path
+
+
+def send_message(sock:socket.socket, header:dict, payload:bytes=b""):
+    header = dict(header, payload_size=len(payload))
+    header_bytes = json.dumps(header).encode("utf-8")
+    sock.sendall(struct.pack(">I", len(header_bytes)) + header_bytes + payload)
+
+
+def _recv_exactly(sock:socket.socket, size:int) -> bytes:
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(min(size, 1 << 20))
+        if len(chunk) == 0:
+            raise ConnectionError("connection closed mid-message")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def recv_message(sock:socket.socket):
+    """
+    Returns:
+        (header, payload)
+    Raises:
+        ConnectionError if the other end went away.
+    """
+    header_size, = struct.unpack(">I", _recv_exactly(sock, 4))
+    header = json.loads(_recv_exactly(sock, header_size).decode("utf-8"))
+    payload = _recv_exactly(sock, header["payload_size"])
+    return header, payload
+
+
+def parse_address(address:str):
+    host, port = address.rsplit(":", 1)
+    return host, int(port)
+
+
+def request(address:str, header:dict, payload:bytes=b"", timeout:float=None, token:str=None):
+    """ One request/response round trip with the broker, on a fresh connection. """
+    if token is not None:
+        header = dict(header, token=token)
+    with socket.create_connection(parse_address(address), timeout=timeout) as sock:
+        send_message(sock, header, payload)
+        return recv_message(sock)
+
+
+def get_attempt_timeout(timeout:float=None, cpu_timeout:float=None) -> float:
+    """
+    How long a worker may hold a job before it's presumed lost: past the job's own deadlines
+    (enforced by the worker), with some slack, or DEFAULT_ATTEMPT_TIMEOUT without deadlines.
+    """
+    deadlines = [el for el in (timeout, cpu_timeout) if el is not None]
+    if len(deadlines) == 0:
+        return DEFAULT_ATTEMPT_TIMEOUT
+    return max(deadlines) * 2 + 60
+
+
+def get_submit_timeout(timeout:float=None, cpu_timeout:float=None, max_attempts:int=3,
+                       queue_timeout:float=DEFAULT_QUEUE_TIMEOUT) -> float:
+    """ How long a submitter waits for its render: queueing slack, plus every attempt running out. """
+    return queue_timeout + max_attempts * get_attempt_timeout(timeout, cpu_timeout)
+
+
+class RenderJob(object):
+    _job_ids = itertools.count()
+
+    def __init__(self, header:dict, script:bytes):
+        self.id = next(self._job_ids)
+        self.header = header
+        self.script = script
+        self.attempts = 0
+        self.taken = threading.Event() # by a worker, at least once
+        self.done = threading.Event()
+        self.result = None # (header, png bytes)
+        self.abandoned = False # the submitter stopped waiting
+
+    def finish(self, header:dict, payload:bytes=b""):
+        self.result = (header, payload)
+        self.done.set()
+
+
+class Broker(socketserver.ThreadingTCPServer):
+    """
+    Holds the queue of render jobs and the uploaded starter blends. Every connection is
+    served by its own thread; submitters and workers both block on their connection until
+    there's something for them.
+
+    With a token, messages that don't carry it are refused. Without one, the broker only
+    binds to localhost.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, work_dir:str, max_attempts:int=3, token:str=None):
+        if token is None and not is_local_host(address[0]):
+            raise ValueError(f"Refusing to serve the render farm on {address[0]} without a token "
+                             f"(--token, or {TOKEN_ENV}): anyone who can reach it could run code on the workers.")
+        self.blend_dir = Path(work_dir)/"blends"
+        self.blend_dir.mkdir(parents=True, exist_ok=True)
+        self.max_attempts = max_attempts
+        self.token = token
+        self.jobs = queue.Queue()
+        super().__init__(address, BrokerHandler)
+
+    def blend_path(self, blend_hash:str) -> Path:
+        return self.blend_dir/f"{check_blend_hash(blend_hash)}.blend"
+
+    def is_authorized(self, header:dict) -> bool:
+        if self.token is None:
+            return True
+        token = header.get("token")
+        return isinstance(token, str) and hmac.compare_digest(token.encode("utf-8"), self.token.encode("utf-8"))
+
+    def requeue(self, job:RenderJob, reason:str):
+        if job.abandoned:
+            return
+        if job.attempts < self.max_attempts:
+            logger.warning(f"Render job {job.id} failed on attempt {job.attempts} ({reason}), retrying.")
+            self.jobs.put(job)
+        else:
+            logger.warning(f"Render job {job.id} failed {job.attempts} times ({reason}), giving up.")
+            job.finish({"status": "error", "error": f"gave up after {job.attempts} attempts: {reason}"})
+
+
+class BrokerHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        try:
+            header, payload = recv_message(self.request)
+        except ConnectionError:
+            return
+        if not self.server.is_authorized(header):
+            logger.warning(f"Refused a {header.get('type')} message from {self.client_address[0]}: bad token")
+            send_message(self.request, {"status": "error", "error": "unauthorized"})
+            return
+        header.pop("token", None) # not handed on to workers with the job
+        handler = getattr(self, "handle_" + str(header.get("type")), None)
+        if handler is None:
+            send_message(self.request, {"status": "error", "error": f"unknown message type {header.get('type')}"})
+            return
+        try:
+            handler(header, payload)
+        except FarmRequestException as e:
+            logger.warning(f"Refused a {header['type']} message from {self.client_address[0]}: {e}")
+            send_message(self.request, {"status": "error", "error": str(e)})
+
+    def handle_has_blend(self, header, payload):
+        send_message(self.request, {"status": "ok", "has_blend": self.server.blend_path(header["blend_hash"]).is_file()})
+
+    def handle_put_blend(self, header, payload):
+        blend_path = self.server.blend_path(header["blend_hash"])
+        tmp_path = blend_path.with_suffix(f".{threading.get_ident()}.tmp")
+        tmp_path.write_bytes(payload)
+        os.replace(tmp_path, blend_path)
+        send_message(self.request, {"status": "ok"})
+
+    def handle_get_blend(self, header, payload):
+        blend_path = self.server.blend_path(header["blend_hash"])
+        if not blend_path.is_file():
+            send_message(self.request, {"status": "error", "error": f"unknown blend {header['blend_hash']}"})
+            return
+        send_message(self.request, {"status": "ok"}, blend_path.read_bytes())
+
+    def handle_submit(self, header, payload):
+        check_blend_hash(header.get("blend_hash"))
+        get_blender_script_path(header.get("blender_script"))
+        job = RenderJob(header, payload)
+        wait_timeout = header.get("wait_timeout")
+        deadline = None if wait_timeout is None else time.time() + wait_timeout
+        self.server.jobs.put(job)
+        result = None
+        if not job.taken.wait(header.get("queue_timeout")):
+            result = {"status": "unavailable", "error": "no worker took the job"}
+        elif not job.done.wait(None if deadline is None else max(0.0, deadline - time.time())):
+            result = {"status": "timeout", "error": f"not rendered after {job.attempts} attempts"}
+        if result is not None:
+            job.abandoned = True
+            logger.warning(f"Render job {job.id} given up on by its submitter: {result['error']}")
+            send_message(self.request, result)
+            return
+        send_message(self.request, *job.result)
+
+    def handle_take(self, header, payload):
+        """ A worker asking for its next job. The result comes back on the same connection. """
+        job = self.server.jobs.get()
+        while job.abandoned:
+            job = self.server.jobs.get()
+        job_header = job.header
+        try:
+            send_message(self.request, dict(job_header, type="job", job_id=job.id), job.script)
+        except OSError:
+            # the worker went away while waiting for work, the job never reached it.
+            self.server.jobs.put(job)
+            return
+        job.attempts += 1
+        job.taken.set()
+        # past the job's own deadlines (enforced by the worker), the worker is presumed lost.
+        self.request.settimeout(get_attempt_timeout(job_header.get("timeout"), job_header.get("cpu_timeout")))
+        try:
+            result_header, png = recv_message(self.request)
+        except (ConnectionError, OSError) as e:
+            self.server.requeue(job, f"worker {header.get('worker')} lost: {e}")
+            return
+        if result_header["status"] == "retry":
+            self.server.requeue(job, result_header.get("error", "worker couldn't set up the render"))
+            return
+        job.finish(result_header, png)
+
+
+def start_broker(port:int=0, work_dir:str="farm_broker", host:str="localhost", max_attempts:int=3,
+                 token:str=None) -> Broker:
+    """
+    Start a broker in a background thread.
+    Returns:
+        the broker. `"%s:%d" % broker.server_address` is its address.
+    """
+    broker = Broker((host, port), work_dir, max_attempts=max_attempts, token=token)
+    threading.Thread(target=broker.serve_forever, daemon=True).start()
+    logger.info("Render farm broker listening on %s:%d" % broker.server_address)
+    return broker
+
+
+def ensure_blend(address:str, blend_hash:str, blend_cache_dir:Path, token:str=None) -> Path:
+    """ Starter blends are cached by content hash, so each one is only fetched once per worker. """
+    blend_path = blend_cache_dir/f"{check_blend_hash(blend_hash)}.blend"
+    if not blend_path.is_file():
+        header, payload = request(address, {"type": "get_blend", "blend_hash": blend_hash}, token=token)
+        if header["status"] != "ok":
+            raise ValueError(header["error"])
+        tmp_path = blend_path.with_suffix(f".{os.getpid()}.tmp")
+        tmp_path.write_bytes(payload)
+        os.replace(tmp_path, blend_path)
+    return blend_path
+
+
+def run_job(address:str, job:dict, script:bytes, blender_command:str, work_dir:Path, token:str=None):
+    """
+    Returns:
+        (result header, png bytes) to send back to the broker.
+    """
+    try:
+        blender_script_path = get_blender_script_path(job.get("blender_script"))
+        check_blend_hash(job.get("blend_hash"))
+    except FarmRequestException as e:
+        return {"status": "error", "kind": "crash", "error": str(e)}, b""
+    try:
+        blend_path = ensure_blend(address, job["blend_hash"], work_dir/"blends", token=token)
+    except (ValueError, ConnectionError, OSError) as e:
+        return {"status": "retry", "error": f"couldn't fetch blend {job['blend_hash']}: {e}"}, b""
+
+    job_dir = work_dir/"jobs"/str(int(job["job_id"]))
+    job_dir.mkdir(parents=True, exist_ok=True)
+    try:
+        return render_job(job, script, blend_path, blender_script_path, blender_command, job_dir)
+    finally:
+        shutil.rmtree(job_dir, ignore_errors=True) # scratch space, the PNG is in memory by now
+
+
+def render_job(job:dict, script:bytes, blend_path:Path, blender_script_path:Path, blender_command:str, job_dir:Path):
+    script_path = job_dir/"candidate.py"
+    render_path = job_dir/"render.png"
+    script_path.write_bytes(script)
+    if render_path.exists():
+        render_path.unlink()
+
+    command = shlex.split(blender_command) + [
+                    "--background", str(blend_path),
+                    "--python-exit-code", "1",
+                    "--python", str(blender_script_path),
+                    "--", str(script_path), str(render_path)]
+    if job.get("render_settings") is not None:
+        command.append(json.dumps(job["render_settings"]))
+    try:
+        _, log = run_blender(command, timeout=job.get("timeout"), cpu_timeout=job.get("cpu_timeout"))
+    except RenderTimeoutException:
+        return {"status": "timeout"}, b""
+    except OSError as e:
+        return {"status": "retry", "error": f"couldn't launch blender: {e}"}, b""
+
+    if not render_path.is_file():
+        return {"status": "error", "kind": classify_failure(log), "error": log}, b""
+    return {"status": "ok"}, render_path.read_bytes()
+
+
+def serve_worker(address:str, blender_command:str, work_dir:str, token:str=None):
+    """ Take jobs from the broker and render them, forever. """
+    work_dir = Path(work_dir)
+    (work_dir/"blends").mkdir(parents=True, exist_ok=True)
+    worker_name = f"{socket.gethostname()}:{os.getpid()}"
+    while True:
+        try:
+            with socket.create_connection(parse_address(address)) as sock:
+                send_message(sock, {"type": "take", "worker": worker_name, "token": token})
+                job, script = recv_message(sock)
+                if job.get("type") != "job":
+                    raise ConnectionError(f"the broker refused to hand out jobs: {job.get('error')}")
+                logger.info(f"Rendering job {job['job_id']}")
+                send_message(sock, *run_job(address, job, script, blender_command, work_dir, token=token))
+        except (ConnectionError, OSError) as e:
+            logger.warning(f"Lost the broker at {address} ({e}), reconnecting in {RECONNECT_INTERVAL}s")
+            time.sleep(RECONNECT_INTERVAL)
+
+
+def submit_render(address:str, blender_file:str, blender_script:str, script_path:str, render_path:str,
+                  render_settings:dict=None, timeout:float=None, cpu_timeout:float=None,
+                  max_attempts:int=3, queue_timeout:float=DEFAULT_QUEUE_TIMEOUT, token:str=None):
+    """
+    Render script_path on the farm, and write the PNG to render_path.
+
+    Args:
+        max_attempts, queue_timeout: the broker's attempts per job, and how long to wait for a
+            worker to take it, which bound the wait for the render (see get_submit_timeout).
+        token: the broker's shared token, if it has one (see get_farm_token).
+    Raises:
+        BlenderExecutionException when the script fails in Blender.
+        CodeExecutionException when the broker can't be reached, or no worker took the job.
+        RenderTimeoutException when the render goes past its deadline, or its workers were lost.
+    """
+    wait_timeout = get_submit_timeout(timeout, cpu_timeout, max_attempts=max_attempts, queue_timeout=queue_timeout)
+    blend_hash = get_file_hash(blender_file)
+    try:
+        header, _ = request(address, {"type": "has_blend", "blend_hash": blend_hash}, token=token)
+        if header["status"] == "ok" and not header["has_blend"]:
+            with open(blender_file, "rb") as f:
+                header, _ = request(address, {"type": "put_blend", "blend_hash": blend_hash}, f.read(), token=token)
+        if header["status"] != "ok":
+            logger.warning(f"The render farm at {address} refused the blend: {header.get('error')}")
+            raise CodeExecutionException
+
+        with open(script_path, "rb") as f:
+            script = f.read()
+        header, png = request(address, {"type": "submit",
+                                        "blend_hash": blend_hash,
+                                        "blender_script": Path(blender_script).name,
+                                        "render_settings": render_settings,
+                                        "timeout": timeout,
+                                        "cpu_timeout": cpu_timeout,
+                                        "queue_timeout": queue_timeout,
+                                        "wait_timeout": wait_timeout}, script,
+                              timeout=wait_timeout + RECONNECT_INTERVAL * 6, # the broker answers first
+                              token=token)
+    except (ConnectionError, OSError) as e:
+        logger.warning(f"Couldn't reach the render farm at {address}: {e}")
+        raise CodeExecutionException
+
+    if header["status"] == "unavailable":
+        logger.warning(f"No render farm worker took {script_path} within {queue_timeout}s.")
+        raise CodeExecutionException
+    if header["status"] == "timeout":
+        logger.warning(f"Render of {script_path} timed out on the farm.")
+        raise RenderTimeoutException
+    if header["status"] != "ok":
+        kind = header.get("kind", "crash")
+        logger.warning(f"The following bpy script failed ({kind}) on the render farm:{script_path}\n{header.get('error')}")
+        raise BlenderExecutionException(kind, header.get("error", ""))
+    with open(render_path, "wb") as f:
+        f.write(png)
+
+
+class LocalFarm(object):
+    """
+    A broker plus `num_workers` worker processes on this machine, standing in for a farm.
+    """
+    def __init__(self, blender_command:str, num_workers:int, work_dir:str, max_attempts:int=3):
+        self.broker = start_broker(work_dir=os.path.join(work_dir, "broker"), max_attempts=max_attempts)
+        self.address = "%s:%d" % self.broker.server_address
+        repo_dir = str(Path(__file__).resolve().parent.parent)
+        self.workers = [subprocess.Popen([sys.executable, "-m", "utils.render_farm", "worker",
+                                          "--broker", self.address,
+                                          "--blender_command", blender_command,
+                                          "--work_dir", os.path.join(work_dir, f"worker_{idx}")],
+                                         cwd=repo_dir)
+                        for idx in range(num_workers)]
+
+    def close(self):
+        for worker in self.workers:
+            worker.kill()
+            worker.wait()
+        self.broker.shutdown()
+        self.broker.server_close()
+
+
+_local_farms = {}
+_local_farms_lock = threading.Lock()
+
+
+def get_render_farm_address(config:dict):
+    """
+    run_config.render_farm is either {"address": "HOST:PORT"} of a running broker, or
+    {"local_workers": N} to start a broker and N workers on this machine.
+
+    Returns:
+        the broker's address, or None if the farm is off.
+    """
+    run_config = config["run_config"]
+    farm_config = run_config.get("render_farm")
+    if farm_config is None:
+        return None
+    if farm_config.get("address") is not None:
+        return farm_config["address"]
+
+    work_dir = farm_config.get("work_dir", "farm")
+    with _local_farms_lock:
+        if work_dir not in _local_farms:
+            _local_farms[work_dir] = LocalFarm(run_config["blender_command"], farm_config["local_workers"],
+                                               work_dir, max_attempts=farm_config.get("max_attempts", 3))
+        return _local_farms[work_dir].address
+
+
+@atexit.register
+def close_local_farms():
+    with _local_farms_lock:
+        for farm in _local_farms.values():
+            farm.close()
+        _local_farms.clear()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="BlenderAlchemy render farm")
+    subparsers = parser.add_subparsers(dest="role", required=True)
+    broker_parser = subparsers.add_parser("broker")
+    broker_parser.add_argument("--host", type=str, default="127.0.0.1",
+                               help="any address but localhost needs a token.")
+    broker_parser.add_argument("--token", type=str, default=None,
+                               help=f"shared token that every message must carry (default: ${TOKEN_ENV}).")
+    broker_parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    broker_parser.add_argument("--work_dir", type=str, default="farm_broker", help="where uploaded blends are kept.")
+    broker_parser.add_argument("--max_attempts", type=int, default=3, help="attempts per job before giving up.")
+    worker_parser = subparsers.add_parser("worker")
+    worker_parser.add_argument("--broker", type=str, required=True, help="HOST:PORT of the broker.")
+    worker_parser.add_argument("--blender_command", type=str, default="blender")
+    worker_parser.add_argument("--work_dir", type=str, default="farm_worker", help="blend cache and scratch space.")
+    worker_parser.add_argument("--token", type=str, default=None, help=f"the broker's token (default: ${TOKEN_ENV}).")
+    args = parser.parse_args()
+
+    if args.role == "broker":
+        broker = Broker((args.host, args.port), args.work_dir, max_attempts=args.max_attempts,
+                        token=get_farm_token(args.token))
+        logger.info(f"Render farm broker listening on {args.host}:{args.port}")
+        broker.serve_forever()
+    else:
+        serve_worker(args.broker, args.blender_command, args.work_dir, token=get_farm_token(args.token))
@@ -0,0 +1,156 @@
+"""
+Raw render hand-off: Blender writes the rendered RGBA pixels, uncompressed, to a file in
+shared memory (/dev/shm where available), and the orchestrator maps that file and wraps it
+as a numpy array or PIL image without copying or decoding anything. The PNG at the usual
+render path is still written, in the background, for the records.
+
+Raw files are a 12-byte header (b"BARW", width, height as little-endian uint32) followed by
+height x width x 4 bytes of RGBA, top row first.
+"""
+
+import os
+import struct
+import atexit
+import hashlib
+import tempfile
+import threading
+from pathlib import Path
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+from loguru import logger
+
+
+RAW_MAGIC = b"BARW"
+RAW_HEADER = struct.Struct("<4sII")
+RAW_RENDER_DIR = Path("/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir())/"blenderalchemy"
+MAX_RAW_RENDERS = 128 # at 512x512, 1MB each
+
+_raw_renders = OrderedDict()   # render path -> raw path, oldest first
+_png_writes = {}               # render path -> Future of its png write
+_lock = threading.Lock()
+_png_writer = ThreadPoolExecutor(max_workers=2)
+
+
+def get_raw_render_path(render_path:str) -> str:
+    """ Where Blender should write the raw pixels of the render meant for render_path. """
+    RAW_RENDER_DIR.mkdir(parents=True, exist_ok=True)
+    name = hashlib.sha1(os.path.abspath(render_path).encode("utf-8")).hexdigest()
+    return str(RAW_RENDER_DIR/f"{name}.rgba")
+
+
+def read_raw_render(raw_path:str) -> np.ndarray:
+    """
+    Returns:
+        a read-only (height, width, 4) uint8 view of the mapped file.
+    """
+    with open(raw_path, "rb") as f:
+        magic, width, height = RAW_HEADER.unpack(f.read(RAW_HEADER.size))
+    assert magic == RAW_MAGIC, f"{raw_path} isn't a raw render"
+    return np.memmap(raw_path, dtype=np.uint8, mode="r", offset=RAW_HEADER.size, shape=(height, width, 4))
+
+
+def raw_to_image(pixels:np.ndarray) -> Image.Image:
+    """ PIL image sharing the buffer of `pixels`. """
+    height, width, _ = pixels.shape
+    return Image.frombuffer("RGBA", (width, height), pixels, "raw", "RGBA", 0, 1)
+
+
+def write_raw_image(image:Image.Image, raw_path:str):
+    """ Save image in the raw layout, atomically, e.g. after editing a raw render. """
+    rgba = np.asarray(image.convert("RGBA"), dtype=np.uint8)
+    height, width, _ = rgba.shape
+    tmp_path = raw_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(RAW_HEADER.pack(RAW_MAGIC, width, height))
+        f.write(rgba.tobytes())
+    os.replace(tmp_path, raw_path)
+
+
+def _write_png(raw_path:str, render_path:str, on_png_written=None):
+    image = raw_to_image(read_raw_render(raw_path))
+    tmp_path = render_path + ".tmp.png"
+    image.save(tmp_path, format="PNG", compress_level=1)
+    os.replace(tmp_path, render_path)
+    if on_png_written is not None:
+        on_png_written(render_path)
+
+
+def publish_raw_render(raw_path:str, render_path:str, on_png_written=None):
+    """
+    Make the raw render at raw_path the one open_render returns for render_path, and
+    write render_path as a PNG in the background.
+
+    Args:
+        on_png_written: optional callback, called with render_path once the PNG is there.
+    """
+    with _lock:
+        _raw_renders[render_path] = raw_path
+        _raw_renders.move_to_end(render_path)
+        _png_writes[render_path] = _png_writer.submit(_write_png, raw_path, render_path, on_png_written)
+        evicted = []
+        while len(_raw_renders) > MAX_RAW_RENDERS:
+            evicted.append(_raw_renders.popitem(last=False))
+    for old_render_path, old_raw_path in evicted:
+        # only drop the pixels once they're safely in the png
+        wait_for_png(old_render_path)
+        try:
+            os.unlink(old_raw_path)
+        except FileNotFoundError:
+            pass
+
+
+def render_exists(render_path:str) -> bool:
+    with _lock:
+        if render_path in _raw_renders:
+            return True
+    return os.path.isfile(render_path)
+
+
+def open_render(render_path:str) -> Image.Image:
+    """
+    Image.open for renders: the shared-memory pixels when the render was handed off raw,
+    the PNG otherwise.
+    """
+    with _lock:
+        raw_path = _raw_renders.get(render_path)
+    if raw_path is not None:
+        try:
+            return raw_to_image(read_raw_render(raw_path))
+        except FileNotFoundError:
+            pass # evicted in the meantime
+    wait_for_png(render_path)
+    return Image.open(render_path)
+
+
+def wait_for_png(render_path:str=None):
+    """ Block until the PNG of render_path (or of every render, if None) is written. """
+    with _lock:
+        if render_path is None:
+            futures = list(_png_writes.values())
+        else:
+            futures = [_png_writes[render_path]] if render_path in _png_writes else []
+    for future in futures:
+        try:
+            future.result()
+        except Exception as e:
+            logger.warning(f"Writing a png from a raw render failed: {e}")
+    with _lock:
+        for key in ([render_path] if render_path is not None else list(_png_writes.keys())):
+            if key in _png_writes and _png_writes[key].done():
+                del _png_writes[key]
+
+
+@atexit.register
+def close_render_handoff():
+    wait_for_png()
+    with _lock:
+        raw_paths = list(_raw_renders.values())
+        _raw_renders.clear()
+    for raw_path in raw_paths:
+        try:
+            os.unlink(raw_path)
+        except FileNotFoundError:
+            pass
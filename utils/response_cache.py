@@ -0,0 +1,157 @@
+"""
+Disk-backed cache of VLM answers, keyed by the content of the question (text, and pixels of
+its images), the model, the task, the sampling parameters and the sample index. Reruns of the
+same config (overwrite=False, crash recovery, regression runs) replay the answers instead of
+asking again.
+"""
+
+import os
+import pickle
+import hashlib
+import threading
+from pathlib import Path
+from collections import defaultdict
+
+from loguru import logger
+
+from utils.question import get_question_parts, UnrecognizedQuestionException
+
+
+def hash_question(question) -> str:
+    """
+    Raises:
+        UnrecognizedQuestionException if the text and images of question can't be identified.
+    """
+    sha = hashlib.sha256()
+    for part in get_question_parts(question):
+        if isinstance(part, str):
+            sha.update(b"text:" + part.encode("utf-8"))
+        else:
+            # PIL image: the pixels, not the object
+            sha.update(f"image:{part.mode}:{part.size}:".encode("utf-8"))
+            sha.update(part.tobytes())
+    return sha.hexdigest()
+
+
+class ResponseCache(object):
+    """
+    On-disk store of pickled answers, bounded in size, least recently used first out.
+
+    The same question asked again in one process (a retry, another slot) is a new sample, not
+    a hit on the first one: each key also counts how many times it was asked so far, so a rerun
+    replays the same sequence of answers while every sample within a run stays distinct.
+    """
+    def __init__(self, cache_dir:str, max_size_mb:float=512):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_size_bytes = max_size_mb * (1 << 20)
+        self.lock = threading.Lock()
+        self.num_asked = defaultdict(int)
+
+    def make_key(self, question, scope:str, params:dict=None, sample=None) -> str:
+        """
+        Args:
+            scope: what answers the question, e.g. model name and task.
+            params: sampling parameters (max_tokens, ...).
+            sample: the agent index, so that each branch gets its own samples.
+        """
+        sha = hashlib.sha256()
+        sha.update(scope.encode("utf-8"))
+        sha.update(repr(sorted((params or {}).items())).encode("utf-8"))
+        sha.update(repr(sample).encode("utf-8"))
+        sha.update(hash_question(question).encode("utf-8"))
+        base_key = sha.hexdigest()
+        with self.lock:
+            occurrence = self.num_asked[base_key]
+            self.num_asked[base_key] += 1
+        return f"{base_key}_{occurrence}"
+
+    def _entry_path(self, key:str) -> Path:
+        return self.cache_dir/f"{key}.pkl"
+
+    def fetch(self, key:str):
+        """
+        Returns:
+            (True, answer) on a hit, (False, None) otherwise.
+        """
+        entry = self._entry_path(key)
+        try:
+            with open(entry, "rb") as f:
+                answer = pickle.load(f)
+            os.utime(entry) # mark as recently used
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return False, None
+        return True, answer
+
+    def store(self, key:str, answer):
+        tmp_entry = self.cache_dir/f"{key}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_entry, "wb") as f:
+                pickle.dump(answer, f)
+        except (pickle.PicklingError, TypeError, AttributeError) as e:
+            logger.warning(f"Couldn't cache an answer of type {type(answer).__name__}: {e}")
+            tmp_entry.unlink()
+            return
+        os.replace(tmp_entry, self._entry_path(key))
+        self.evict()
+
+    def evict(self):
+        with self.lock:
+            entries = []
+            for entry in self.cache_dir.glob("*.pkl"):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue # evicted by another run
+                entries.append((stat.st_mtime, stat.st_size, entry))
+
+            total_size = sum([el[1] for el in entries])
+            for _, size, entry in sorted(entries, key=lambda el: el[0]):
+                if total_size <= self.max_size_bytes:
+                    break
+                try:
+                    entry.unlink()
+                except FileNotFoundError:
+                    pass
+                total_size -= size
+
+    def ask(self, request, question, scope:str, params:dict=None, sample=None):
+        """
+        Args:
+            request: function sending the question and returning the answer, called on a miss.
+        Returns:
+            the cached or fresh answer. Failed requests (exceptions) aren't cached, and neither
+            are answers to questions whose content can't be identified (see utils/question.py).
+        """
+        try:
+            key = self.make_key(question, scope, params=params, sample=sample)
+        except UnrecognizedQuestionException as e:
+            logger.warning(f"Not caching the answer for {scope}: {e}")
+            return request()
+        hit, answer = self.fetch(key)
+        if hit:
+            logger.info(f"Response cache hit for {scope}")
+            return answer
+        answer = request()
+        self.store(key, answer)
+        return answer
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_response_cache(config:dict):
+    """
+    Returns:
+        the ResponseCache configured by run_config.response_cache_dir, or None if caching is off.
+    """
+    run_config = config["run_config"]
+    cache_dir = run_config.get("response_cache_dir")
+    if cache_dir is None:
+        return None
+    with _caches_lock:
+        if cache_dir not in _caches:
+            _caches[cache_dir] = ResponseCache(cache_dir, run_config.get("response_cache_max_mb", 512))
+            logger.info(f"Response cache enabled at {cache_dir}")
+        return _caches[cache_dir]
@@ -0,0 +1,106 @@
+"""
+Streamed VLM requests for code-writing agents: the answer is parsed as soon as its code block
+closes, and the stream is cut right there, or as soon as it's clear there won't be usable code.
+Only OpenAI chat models are streamed; the request is assembled from the task (name, description,
+background) and the question, as text and base64 PNG parts. Questions and backgrounds whose
+parts can't be identified raise (see utils/question.py) rather than being sent incomplete.
+
+TaskSolver's own requests (visual_interface.run_once) are laid out by TaskSolver, which doesn't
+expose how: a streamed prompt carries the same task, background and question, but may word
+and lay them out differently. An agent streams all of its requests or none, and the response
+cache keeps the answers to streamed prompts apart (see GeneralAgent.enable_streaming).
+"""
+
+import io
+import base64
+
+from loguru import logger
+from tasksolver.exceptions import GPTOutputParseException
+
+from utils.code import CodeBlockWatcher
+from utils.question import get_question_parts, get_task_background, is_image
+
+
+class StreamAbortedException(GPTOutputParseException):
+    """ The response was cut short because it had no code, or abbreviated it. """
+    def __init__(self, reason:str, raw:str):
+        super().__init__(f"stream aborted: {reason}")
+        self.reason = reason
+        self.raw = raw
+
+
+def is_streamable(vision_model:str) -> bool:
+    return str(vision_model).startswith("gpt")
+
+
+def make_client(api_key:str):
+    """ The OpenAI client of an agent, shared by all its streamed requests. """
+    from openai import OpenAI
+    return OpenAI(api_key=api_key)
+
+
+def to_content(parts) -> list:
+    """ parts as given by get_question_parts: text and PIL images. """
+    content = []
+    for part in parts:
+        if isinstance(part, str):
+            content.append({"type": "text", "text": part})
+        elif is_image(part):
+            buffer = io.BytesIO()
+            part.convert("RGB").save(buffer, format="PNG")
+            encoded = base64.b64encode(buffer.getvalue()).decode("utf-8")
+            content.append({"type": "image_url", "image_url": {"url": f"data:image/png;base64,{encoded}"}})
+        else:
+            raise TypeError(f"can't send a {type(part).__name__} to the model")
+    return content
+
+
+def build_messages(task, question) -> list:
+    """
+    The messages of every streamed request: a system message with the task's name and
+    description, and a user message with the task's background, then the question.
+    Raises:
+        UnrecognizedQuestionException if the task's background or the question can't be read.
+    """
+    system = "\n".join([str(task.name), str(task.description)])
+    user_content = to_content(get_task_background(task)) + to_content(get_question_parts(question))
+    return [{"role": "system", "content": system},
+            {"role": "user", "content": user_content}]
+
+
+def stream_code_answer(client, model:str, task, question, max_tokens:int,
+                       max_chars_without_code:int=2000):
+    """
+    Send question and parse the answer with task.answer_type as soon as the code block closes,
+    closing the stream there (the explanation after the code isn't paid for).
+
+    Args:
+        client: the agent's OpenAI client (see make_client).
+
+    Returns:
+        the parsed answer.
+    Raises:
+        StreamAbortedException when the response has no code block within max_chars_without_code
+        characters, or abbreviates its code.
+        UnrecognizedQuestionException if the request can't be assembled (see build_messages).
+    """
+    stream = client.chat.completions.create(model=model, messages=build_messages(task, question),
+                                            max_tokens=max_tokens, stream=True)
+    watcher = CodeBlockWatcher(max_chars_without_code=max_chars_without_code)
+    try:
+        for event in stream:
+            if len(event.choices) == 0 or event.choices[0].delta.content is None:
+                continue
+            state = watcher.feed(event.choices[0].delta.content)
+            if state in ("no_code", "abbreviated"):
+                logger.warning(f"Cutting the response short, {state}")
+                raise StreamAbortedException(state, watcher.text)
+            if state == "code":
+                break
+    finally:
+        stream.close()
+
+    p_ans = task.answer_type.parser(watcher.text)
+    if getattr(p_ans, "raw", None) is None:
+        p_ans.raw = watcher.text
+    return p_ans
@@ -0,0 +1,208 @@
+"""
+Static checks of candidate scripts, run before they are sent to Blender, so that scripts
+that are bound to fail are rejected in milliseconds instead of after a full Blender launch.
+"""
+
+import io
+import re
+import ast
+import json
+import tokenize
+import builtins
+from functools import partial
+
+from tasksolver.exceptions import CodeExecutionException
+from utils.code import get_code_as_string
+
+
+# Names that the blender_base scripts put into the namespace of every candidate script.
+BASE_SCRIPT_NAMES = {"bpy", "random", "json", "os", "sys", "platform", "__file__", "__name__"}
+TASK_PREDEFINED_NAMES = {"material": {"material_obj"}}
+
+# Comments (and bare strings) with which code is elided, e.g. `# ...` or `# rest of the code`.
+TRUNCATION_PATTERNS = [re.compile(r"^\s*\.\.\."),
+                       re.compile(r"\b(rest|remainder) of (the )?(code|script)\b", re.IGNORECASE)]
+
+
+class ScriptValidationException(CodeExecutionException):
+    """
+    A candidate script was rejected before rendering.
+    """
+    def __init__(self, reason:str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+def get_bound_names(tree:ast.AST) -> set:
+    """
+    Every name the script binds anywhere (assignments, defs, imports, arguments, loop targets...).
+    Scopes are flattened: this catches misspelled and missing names, not scoping mistakes.
+    """
+    bound = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and isinstance(node.ctx, (ast.Store, ast.Del)):
+            bound.add(node.id)
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            bound.add(node.name)
+        elif isinstance(node, ast.arg):
+            bound.add(node.arg)
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            for alias in node.names:
+                bound.add((alias.asname or alias.name).split(".")[0])
+        elif isinstance(node, ast.ExceptHandler) and node.name is not None:
+            bound.add(node.name)
+        elif isinstance(node, (ast.Global, ast.Nonlocal)):
+            bound.update(node.names)
+    return bound
+
+
+def get_string_subscripts(tree:ast.AST, collection:str) -> set:
+    """ String keys used on a collection, e.g. "Mouth open" in `....key_blocks["Mouth open"]`. """
+    keys = set()
+    for node in ast.walk(tree):
+        if (isinstance(node, ast.Subscript) and isinstance(node.value, ast.Attribute)
+                and node.value.attr == collection
+                and isinstance(node.slice, ast.Constant) and isinstance(node.slice.value, str)):
+            keys.add(node.slice.value)
+    return keys
+
+
+def get_entry_point_calls(tree:ast.Module) -> set:
+    """ Names of functions defined in the script and called at the top level, e.g. `apply(material_obj)`. """
+    defined = set([node.name for node in tree.body if isinstance(node, ast.FunctionDef)])
+    calls = set()
+    for node in tree.body:
+        if (isinstance(node, ast.Expr) and isinstance(node.value, ast.Call)
+                and isinstance(node.value.func, ast.Name) and node.value.func.id in defined):
+            calls.add(node.value.func.id)
+    return calls
+
+
+def get_comments(code_str:str) -> list:
+    """ (line number, text after the #) of every comment of the script. """
+    try:
+        return [(token.start[0], token.string[1:]) for token in tokenize.generate_tokens(io.StringIO(code_str).readline)
+                if token.type == tokenize.COMMENT]
+    except (tokenize.TokenError, IndentationError, SyntaxError):
+        return [(line_number + 1, line.split("#", 1)[1]) for line_number, line in enumerate(code_str.split("\n"))
+                if "#" in line]
+
+
+def check_truncation(tree:ast.AST, code_str:str):
+    """
+    Reject scripts with code left out: a bare `...` statement (other than the whole body of
+    a stub, e.g. `def f(): ...`), or a comment or bare string saying so (see TRUNCATION_PATTERNS).
+    `...` as a value (e.g. `arr[..., 0]`) is fine.
+    """
+    def is_ellipsis_statement(stmt):
+        return isinstance(stmt, ast.Expr) and isinstance(stmt.value, ast.Constant) and stmt.value.value is Ellipsis
+
+    stub_bodies = set()
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            body = node.body
+            if ast.get_docstring(node, clean=False) is not None:
+                body = body[1:]
+            if len(body) == 1 and is_ellipsis_statement(body[0]):
+                stub_bodies.add(id(body[0]))
+
+    for node in ast.walk(tree):
+        if is_ellipsis_statement(node) and id(node) not in stub_bodies:
+            raise ScriptValidationException(f"script is abbreviated with '...' (line {node.lineno})")
+        if (isinstance(node, ast.Expr) and isinstance(node.value, ast.Constant) and isinstance(node.value.value, str)
+                and any([pattern.search(node.value.value) for pattern in TRUNCATION_PATTERNS])):
+            raise ScriptValidationException(f"script is abbreviated (line {node.lineno}): {node.value.value.strip()}")
+    for line_number, comment in get_comments(code_str):
+        if any([pattern.search(comment) for pattern in TRUNCATION_PATTERNS]):
+            raise ScriptValidationException(f"script is abbreviated (line {line_number}): #{comment}")
+
+
+def check_names(tree:ast.AST, predefined:set):
+    available = get_bound_names(tree) | set(dir(builtins)) | predefined
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Load) and node.id not in available:
+            raise ScriptValidationException(f"name '{node.id}' is not defined (line {node.lineno})")
+
+
+def check_api_stub(tree:ast.AST, api_stub:dict):
+    """
+    Check imports and attribute accesses against an API surface recorded inside Blender
+    (see blender_base/record_api_stub.py).
+    """
+    modules = api_stub.get("modules", {})
+    attributes = api_stub.get("attributes", {})
+    for node in ast.walk(tree):
+        if isinstance(node, ast.ImportFrom) and node.module in modules:
+            for alias in node.names:
+                if alias.name != "*" and alias.name not in modules[node.module]:
+                    raise ScriptValidationException(f"cannot import name '{alias.name}' from '{node.module}' (line {node.lineno})")
+        elif (isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name)
+                and node.value.id in attributes and node.attr not in attributes[node.value.id]):
+            raise ScriptValidationException(f"'{node.value.id}' has no attribute '{node.attr}' (line {node.lineno})")
+
+    if "objects" in api_stub:
+        # objects that the script creates itself are fine too
+        created = set()
+        for node in ast.walk(tree):
+            if (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and node.func.attr == "new"
+                    and len(node.args) > 0 and isinstance(node.args[0], ast.Constant)):
+                created.add(node.args[0].value)
+        for name in get_string_subscripts(tree, "objects") - set(api_stub["objects"]) - created:
+            raise ScriptValidationException(f"object '{name}' doesn't exist in the scene")
+
+
+def check_task_invariants(tree:ast.Module, init_tree:ast.Module, task_type:str, api_stub:dict=None):
+    # the script's entry points (e.g. `apply(material_obj)`) have to survive the edit.
+    missing_calls = get_entry_point_calls(init_tree) - get_entry_point_calls(tree)
+    if len(missing_calls) > 0:
+        raise ScriptValidationException(f"script no longer calls {', '.join(sorted(missing_calls))}(...) at the top level")
+
+    if task_type == "shapekey":
+        # shape keys can't be invented -- only the ones listed in the starter script exist.
+        known_shape_keys = get_string_subscripts(init_tree, "key_blocks")
+        if api_stub is not None:
+            known_shape_keys |= set(api_stub.get("shape_keys", []))
+        unknown = get_string_subscripts(tree, "key_blocks") - known_shape_keys
+        if len(unknown) > 0:
+            raise ScriptValidationException(f"unknown shape keys: {', '.join(sorted(unknown))}")
+
+
+def validate_script(code_str:str, task_type:str, init_code_str:str, api_stub:dict=None):
+    """
+    Args:
+        code_str: candidate script.
+        task_type: config["task"]["type"], e.g. "material" or "shapekey".
+        init_code_str: the starter script the candidate descends from.
+        api_stub: optional API surface recorded by blender_base/record_api_stub.py.
+    Raises:
+        ScriptValidationException with the reason when the script would fail in Blender.
+    """
+    try:
+        tree = ast.parse(code_str)
+    except SyntaxError as e:
+        raise ScriptValidationException(f"syntax error (line {e.lineno}): {e.msg}")
+
+    check_truncation(tree, code_str)
+    check_names(tree, BASE_SCRIPT_NAMES | TASK_PREDEFINED_NAMES.get(task_type, set()))
+    if api_stub is not None:
+        check_api_stub(tree, api_stub)
+    check_task_invariants(tree, ast.parse(init_code_str), task_type, api_stub=api_stub)
+
+
+def get_script_validator(config:dict, init_code:str):
+    """
+    Returns:
+        a function validating a candidate code string against the starter script `init_code`,
+        or None if run_config.validate_scripts is off.
+    """
+    run_config = config["run_config"]
+    if not run_config.get("validate_scripts", False):
+        return None
+    api_stub = None
+    if run_config.get("api_stub") is not None:
+        with open(run_config["api_stub"], "r") as f:
+            api_stub = json.load(f)
+    return partial(validate_script,
+                   task_type=config["task"]["type"],
+                   init_code_str=get_code_as_string(init_code),
+                   api_stub=api_stub)